@@ -1,11 +1,35 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+import counters
+import follow_graph
+from conditional import (REVALIDATE, apply_cache_policy, cache_policy,
+                         follower_versions, following_versions, not_modified)
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
+from fragment_cache import fragment_cache
+from hydration import (hydrate, load_messages, serialize, serialize_user,
+                       with_authors)
+from identity import identity
+from jobs import jobs, jobs_cli
+from likes import set_likes, toggle_like
+from live import live
+from metrics import metrics
+from message_search import message_search
+from migrate import schema_cli
 from models import db, connect_db, User, Message, Likes
+from pagination import cursor_from_request, make_page, page_size, paginate
+from passwords import passwords
+from response_cache import (anonymous_cache, message_tag, response_cache,
+                            user_tag)
+from throttle import throttle
+from timeline import timelines
+from user_search import (user_search, decode_browse_cursor,
+                         decode_search_cursor)
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +44,34 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 20))
+app.config['LIKES_BATCH_MAX'] = 100
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# background jobs are queued for `flask jobs work`; JOBS_INLINE=1 runs
+# them in the request instead, for development without a worker
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE') == '1'
+
+# How many reverse proxies in front of the app add to X-Forwarded-For.
+# request.remote_addr is then the client's address as the outermost proxy
+# saw it, which per-IP throttling (throttle.py) keys on. Set 0 when
+# clients connect directly, or they could pick their own address.
+app.wsgi_app = ProxyFix(app.wsgi_app,
+                        x_for=int(os.environ.get('TRUSTED_PROXIES', 1)))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+metrics.init_app(app)
+timelines.init_app(app)
+user_search.init_app(app)
+fragment_cache.init_app(app)
+response_cache.init_app(app)
+identity.init_app(app)
+passwords.init_app(app)
+throttle.init_app(app)
+live.init_app(app)
+jobs.init_app(app)
+app.jinja_env.globals['follows'] = follow_graph.viewer_follows
 
 
 ##############################################################################
@@ -31,18 +80,26 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-    g.form = MessageForm()
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Static files don't need a user. Everyone else gets theirs from the
+    identity cache rather than a query per request.
+    """
 
+    if request.endpoint == 'static':
+        return
 
-    else:
-        g.user = None
+    g.user = identity.load(session.get(CURR_USER_KEY))
 
 
+@app.template_global()
+def message_form():
+    """The new-message form in base.html, built the first time it's used."""
 
+    if 'form' not in g:
+        g.form = MessageForm()
+
+    return g.form
 
 
 def do_login(user):
@@ -58,6 +115,15 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def too_many_attempts(template, form, retry_after):
+    """Re-show a login/signup form to a client that's been throttled."""
+
+    flash(f"Too many attempts. Try again in {retry_after} seconds.", 'danger')
+
+    return (render_template(template, form=form), 429,
+            {'Retry-After': str(retry_after)})
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -73,6 +139,11 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        retry_after = throttle.attempt('signup', form.username.data)
+
+        if retry_after:
+            return too_many_attempts('users/signup.html', form, retry_after)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -83,9 +154,12 @@ def signup():
             db.session.commit()
 
         except IntegrityError:
+            db.session.rollback()
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        user_search.index_user(user)
+
         do_login(user)
 
         return redirect("/")
@@ -101,10 +175,18 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        retry_after = throttle.attempt('login', form.username.data)
+
+        if retry_after:
+            return too_many_attempts('users/login.html', form, retry_after)
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            # saves a rehashed password, if authenticate made one
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -132,40 +214,55 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio and
+    location; results are paged with an 'after' cursor.
     """
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    decode = decode_search_cursor if search else decode_browse_cursor
+    users = user_search.search(search,
+                               after=cursor_from_request('after', decode),
+                               size=request.args.get('per_page', type=int))
+
+    if g.user:
+        follow_graph.following_among(g.user.id, [user.id for user in users])
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, search=search)
 
 
 @app.route('/users/<int:user_id>')
+@cache_policy(REVALIDATE)
+@anonymous_cache(lambda user_id: [user_tag(user_id)])
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
+    cached = not_modified('profile', user.id, user.version)
+    if cached:
+        return cached
+
+    return render_template('users/show.html', user=user,
+                           messages=user_messages(user_id))
+
+
+def user_messages(user_id):
+    """One page of a user's messages, newest first, for the viewer."""
+
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-
-    liked_msg_ids = {messages.id for messages in g.user.likes}
+    messages = paginate(with_authors(Message.query)
+                        .filter(Message.user_id == user_id),
+                        Message.timestamp, Message.id,
+                        cursor=cursor_from_request())
+    messages.items = hydrate(messages.items, g.user)
 
-    return render_template('users/show.html', user=user, messages=messages, likes = liked_msg_ids)
+    return messages
 
 
 @app.route('/users/<int:user_id>/following')
+@cache_policy(REVALIDATE)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -174,10 +271,23 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+
+    cached = not_modified('following', user.id, user.version,
+                          following_versions(user.id))
+    if cached:
+        return cached
+
+    # answer every follow/unfollow button, the header's too, in one query
+    shown = [u.id for u in user.following]
+    if user.id != g.user.id:
+        shown.append(user.id)
+    follow_graph.following_among(g.user.id, shown)
+
     return render_template('users/following.html', user=user)
 
 
 @app.route('/users/<int:user_id>/followers')
+@cache_policy(REVALIDATE)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -186,6 +296,18 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+
+    cached = not_modified('followers', user.id, user.version,
+                          follower_versions(user.id))
+    if cached:
+        return cached
+
+    # answer every follow/unfollow button, the header's too, in one query
+    shown = [u.id for u in user.followers]
+    if user.id != g.user.id:
+        shown.append(user.id)
+    follow_graph.following_among(g.user.id, shown)
+
     return render_template('users/followers.html', user=user)
 
 
@@ -199,6 +321,10 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    follow_graph.forget(g.user.id)
+    db.session.flush()
+    counters.followed(g.user.id, followed_user.id)
+    timelines.follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -214,6 +340,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    follow_graph.forget(g.user.id)
+    counters.followed(g.user.id, followed_user.id, -1)
+    timelines.unfollow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -233,14 +362,16 @@ def profile():
         
         password = form.password.data
 
-        if User.authenticate(g.user.username, password):
+        if g.user.check_password(password):
             
             g.user.email = form.email.data
             g.user.image_url = form.image_url.data
             g.user.header_image_url = form.header_image_url.data
             g.user.bio = form.bio.data
+            counters.profile_changed(g.user.id)
 
             db.session.commit()
+            user_search.index_user(g.user)
             return redirect(f'/users/{g.user.id}')
 
         else:
@@ -260,8 +391,12 @@ def delete_user():
 
     do_logout()
 
+    user_id = g.user.id
+
+    counters.user_deleted(user_id)
     db.session.delete(g.user)
     db.session.commit()
+    user_search.remove_user(user_id)
 
     return redirect("/signup")
 
@@ -274,7 +409,15 @@ def list_all_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+
+    liked = (with_authors(Message.query)
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id)
+             .order_by(Likes.id.desc())
+             .all())
+
+    return render_template('users/likes.html', user=user,
+                           messages=hydrate(liked, g.user))
 
 
 ##############################################################################
@@ -296,6 +439,10 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        counters.adjust(g.user.id, messages=1)
+        jobs.enqueue('timeline.fan_out', message_id=msg.id)
+        live.publish(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -303,12 +450,63 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+def search_messages():
+    """Run the message search described by the query string.
+
+    Takes 'q', plus optional 'author' (a username), 'following' (only
+    people the current user follows) and 'before' (cursor) params.
+    Returns a Page of MessageViews, or None if there's nothing to search.
+    """
+
+    following_of = None
+    if g.user and request.args.get('following'):
+        following_of = g.user.id
+
+    query = message_search.query(request.args.get('q'),
+                                 author=request.args.get('author'),
+                                 following_of=following_of)
+
+    if query is None:
+        return None
+
+    messages = paginate(with_authors(query), Message.timestamp, Message.id,
+                        cursor=cursor_from_request())
+    messages.items = hydrate(messages.items, g.user)
+
+    return messages
+
+
+@app.route('/messages/search')
+def messages_search():
+    """Search page for messages."""
+
+    return render_template('messages/search.html', messages=search_messages())
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@cache_policy(REVALIDATE)
+@anonymous_cache(lambda message_id: [message_tag(message_id)])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    # the author's version changes with their messages and likes received
+    author_version = (db.session.query(User.version)
+                      .join(Message, Message.user_id == User.id)
+                      .filter(Message.id == message_id)
+                      .scalar())
+
+    if author_version is None:
+        abort(404)
+
+    cached = not_modified('message', message_id, author_version)
+    if cached:
+        return cached
+
+    msg = with_authors(Message.query).filter_by(id=message_id).first_or_404()
+    message, = hydrate([msg], g.user)
+    response_cache.tag(user_tag(msg.user_id))
+
+    return render_template('messages/show.html', message=message)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -320,69 +518,96 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
+    timelines.remove_message(msg)
+    counters.message_deleted(msg)
+    response_cache.invalidate(message_tag(msg.id))
     db.session.delete(msg)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
 
+def do_toggle_like(message_id):
+    """Like or unlike a message for the current user and commit.
+
+    Returns (liked, like_count). 404s if the message doesn't exist.
+    """
+
+    try:
+        liked, like_count = toggle_like(g.user.id, message_id)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(404)
+
+    return liked, like_count
+
+
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def like_message(message_id):
     """Toggle liking a message."""
-    
+
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Likes.query.filter_by(user_id=g.user.id, message_id=message_id).first()
-    
-    if liked_message:
-        db.session.delete(liked_message)
-        db.session.commit()
-
-        return redirect("/")
-
-    else:
-        new_like = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(new_like)
-        db.session.commit()
+    liked, _ = do_toggle_like(message_id)
 
+    if liked:
         return redirect(f'/users/{g.user.id}/likes')
 
+    return redirect("/")
+
 
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@cache_policy(REVALIDATE)
+@anonymous_cache()
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        users_following_id = [following.id for following in g.user.following] + [g.user.id]
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(users_following_id)) 
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        liked_msg_ids = {messages.id for messages in g.user.likes}
+        cached = not_modified('home', following_versions(g.user.id))
+        if cached:
+            return cached
 
-        return render_template('home.html', messages=messages, likes=liked_msg_ids )
+        return render_template('home.html', messages=home_timeline())
 
     else:
         return render_template('home-anon.html')
 
 
+def home_timeline():
+    """One page of the current user's home timeline."""
+
+    size = page_size()
+    before = cursor_from_request()
+
+    # the first read of a timeline that was never built builds it
+    if not before and timelines.build(g.user.id):
+        db.session.commit()
+
+    message_ids = timelines.message_ids(g.user.id, size + 1, before=before)
+
+    messages = make_page(load_messages(message_ids), size)
+    messages.items = hydrate(messages.items, g.user)
+
+    return messages
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     # note that we set the 404 status explicitly
+    if request.path.startswith('/api/'):
+        return jsonify(error="Not found."), 404
+
     return render_template('404.html'), 404
 
 ##############################################################################
@@ -417,72 +642,230 @@ def sending_DM():
 
 
 
-@app.route('/messages/new', methods=["GET", "POST"])
-def messages_add():
-    """Add a message:
+##############################################################################
+# API Endpoints
 
-    Show form if GET. If valid, update message and redirect to user page.
+@app.route('/api/messages/<int:message_id>/like', methods=["POST"])
+def api_like_message(message_id):
+    """Toggle liking a message.
+
+    Returns JSON: {"message_id": 1, "liked": true, "likes": 3}
     """
 
     if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return jsonify(error="Access unauthorized."), 401
 
-    form = MessageForm()
+    liked, like_count = do_toggle_like(message_id)
 
-    if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+    return jsonify(message_id=message_id, liked=liked, likes=like_count)
 
-        return redirect(f"/users/{g.user.id}")
 
-    return render_template('messages/new.html', form=form)
+@app.route('/api/likes', methods=["POST"])
+def api_set_likes():
+    """Like and unlike a batch of messages in one transaction.
 
+    Takes JSON: {"likes": [{"message_id": 1, "liked": true}, ...]}; for a
+    message listed more than once, the last entry wins.
 
-    
+    Returns JSON with each existing message's state afterwards:
+    {"likes": [{"message_id": 1, "liked": true, "likes": 3}, ...]}
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    operations = (request.get_json(silent=True) or {}).get('likes')
+
+    if (not isinstance(operations, list)
+            or len(operations) > app.config['LIKES_BATCH_MAX']):
+        return jsonify(error="Expected a list of likes."), 400
+
+    wanted = {}
+
+    for op in operations:
+        message_id = op.get('message_id') if isinstance(op, dict) else None
+        liked = op.get('liked') if isinstance(op, dict) else None
+
+        if type(message_id) is not int or type(liked) is not bool:
+            return jsonify(error="Each like needs a message_id and liked."), 400
+
+        wanted[message_id] = liked
+
+    states = set_likes(g.user.id, wanted)
+    db.session.commit()
+
+    return jsonify(likes=[
+        dict(message_id=id, liked=liked, likes=like_count)
+        for id, (liked, like_count) in states.items()
+    ])
+
+
+@app.route('/api/messages/search')
+def api_messages_search():
+    """Search messages; same params as /messages/search.
+
+    Returns JSON: {"messages": [...], "authors": {...}, "next_cursor": ...}
+    """
+
+    messages = search_messages()
+
+    if messages is None:
+        return jsonify(error="Missing search query."), 400
+
+    return jsonify(next_cursor=messages.next_cursor, **serialize(messages))
+
+
+@app.route('/api/timeline')
+def api_timeline():
+    """The current user's home timeline, a page at a time.
+
+    Takes an optional 'before' cursor. Returns JSON:
+    {"messages": [...], "authors": {...}, "next_cursor": ...}
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    messages = home_timeline()
+
+    return jsonify(next_cursor=messages.next_cursor, **serialize(messages))
+
+
+@app.route('/api/timeline/stream')
+def api_timeline_stream():
+    """New messages for the current user's home timeline, as they're posted.
+
+    A text/event-stream of events shaped like `/api/timeline` pages, one
+    message each; see live.py.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    author_ids = follow_graph.following_ids(g.user.id) | {g.user.id}
+
+    subscriber = live.subscribe(author_ids)
+
+    if subscriber is None:
+        resp = jsonify(error="Too many open streams.")
+        resp.headers['Retry-After'] = app.config['LIVE_HEARTBEAT']
+        return resp, 503
+
+    # a reconnect: catch up on what was posted while it was away
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    missed = ()
+
+    if last_event_id is not None:
+        missed = live.missed(author_ids, last_event_id)
+
+    # the stream can stay open for minutes; don't keep a connection for it
+    db.session.remove()
+
+    return app.response_class(live.stream(subscriber, missed),
+                              mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache',
+                                       'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A user's messages, a page at a time; same shape as /api/timeline."""
+
+    User.query.get_or_404(user_id)
+    messages = user_messages(user_id)
+
+    return jsonify(next_cursor=messages.next_cursor, **serialize(messages))
+
+
+def api_follows(user_id, list_page):
+    """JSON for one page of a user's followers or followed users.
+
+    Takes optional 'after' (cursor) and 'per_page' params. Returns JSON:
+    {"users": [...], "next_cursor": ...}
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    User.query.get_or_404(user_id)
+
+    users = list_page(user_id,
+                      after=cursor_from_request('after', decode_browse_cursor),
+                      size=user_search.page_size(
+                          request.args.get('per_page', type=int)))
+
+    return jsonify(users=[serialize_user(user) for user in users],
+                   next_cursor=users.next_cursor)
+
+
+@app.route('/api/users/<int:user_id>/followers')
+def api_followers(user_id):
+    """Users following this user, a page at a time."""
+
+    return api_follows(user_id, follow_graph.followers_page)
+
+
+@app.route('/api/users/<int:user_id>/following')
+def api_following(user_id):
+    """Users this user follows, a page at a time."""
+
+    return api_follows(user_id, follow_graph.following_page)
 
 
 ##############################################################################
-# API Endpoints
+# Metrics
 
-@app.route('/api/messages/<int:message_id>/like', methods=["POST"])
-def api_like_message(message_id):
-    """Toggle liking a message."""
-    
-    if g.user:
-        liked_message = Likes.query.filter_by(user_id=g.user.id, message_id=message_id).first()
-        
-        if liked_message:
-            db.session.delete(liked_message)
-            db.session.commit()
 
-        else:
-            new_like = Likes(user_id=g.user.id, message_id=message_id)
-            db.session.add(new_like)
-            db.session.commit()
+@app.route('/metrics')
+def show_metrics():
+    """Request, SQL, pool and cache metrics in the Prometheus text format.
+
+    Only for scrapers sending METRICS_TOKEN; see metrics.py.
+    """
 
-            ##TODO: factor that out to a helper function , have one method handle both api and web request
-            ##delete web reuqest for like ## make a test one for API change one that we had for web one to api 
-                
-    return ""
+    if not metrics.authorized():
+        abort(404)
+
+    return app.response_class(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Management commands
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+#   FLASK_APP=app.py flask recount
+#   FLASK_APP=app.py flask throttle-stats
+#   FLASK_APP=app.py flask schema upgrade
+#   FLASK_APP=app.py flask jobs work
+
+app.cli.add_command(schema_cli)
+app.cli.add_command(jobs_cli)
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+@app.cli.command('recount')
+def recount_command():
+    """Repair drifted follower/following/message/like counters."""
+
+    fixed = counters.recount()
+    db.session.commit()
+
+    print(f"Recounted; {fixed} user(s) had drifted.")
+
+
+@app.cli.command('throttle-stats')
+def throttle_stats_command():
+    """Show allowed vs. throttled login and signup attempts."""
+
+    for name, count in sorted(throttle.metrics().items()):
+        print(f"{name:24} {count}")
+
+
+##############################################################################
+# Caching headers
+#
+# Views pick their Cache-Control with @cache_policy and answer conditional
+# GETs with not_modified(); everything else isn't cached (see conditional.py)
+
+app.after_request(apply_cache_policy)
 
 
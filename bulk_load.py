@@ -0,0 +1,326 @@
+"""Load large CSV datasets into the database quickly.
+
+seed.py used to read each CSV whole and insert it with one ORM bulk
+insert and one commit, which is fine for the 1,000-message sample but
+runs out of memory on the multi-million-row datasets used for capacity
+tests. Here each CSV is streamed in chunks of `chunk_size` rows:
+
+- PostgreSQL: each chunk goes in with `COPY ... FROM STDIN`;
+- SQLite (and anything else): with one executemany INSERT per chunk.
+
+Secondary indexes (and, on SQLite, the triggers that keep the message
+search index current) on the tables being loaded are dropped first and
+rebuilt once at the end, which is much faster than updating them row by
+row. Unique constraints and indexes and primary keys stay, so bad data
+still fails.
+
+The CSVs don't carry ids: rows in messages.csv, follows.csv and the
+optional likes.csv refer to users by their line number in users.csv,
+counting from 1, and likes refer to messages the same way. Users and
+messages get explicit ids to match. When appending to a database that
+already has data, ids in the files are shifted past the existing ones,
+so the same generator output can be loaded alongside earlier data.
+
+Progress (rows so far and rows/sec) is reported through `echo`.
+"""
+
+import csv
+import io
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime, Integer, func, select, text
+
+from models import db, Follows, Likes, Message, User
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# secondary indexes: not primary keys, not unique, not backing a constraint
+PG_INDEXES = text("""
+    SELECT c.relname, pg_get_indexdef(i.indexrelid)
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = CAST(:table AS regclass)
+      AND NOT i.indisprimary
+      AND NOT i.indisunique
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint k
+                      WHERE k.conindid = i.indexrelid)
+""")
+
+# autoindexes for UNIQUE / PRIMARY KEY constraints have no sql; unique
+# indexes the migrations created do, and are left out by `_is_unique`
+SQLITE_SCHEMA = text("""
+    SELECT name, sql FROM sqlite_master
+    WHERE type = :kind AND tbl_name = :table AND sql IS NOT NULL
+""")
+
+
+def _is_unique(ddl):
+    return ddl.upper().split()[:2] == ['CREATE', 'UNIQUE']
+
+
+def _is_postgres(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _converters(table, columns):
+    """Functions turning CSV strings into values for `columns`."""
+
+    def convert(column):
+        if isinstance(column.type, Integer):
+            return lambda value: None if value == '' else int(value)
+        if isinstance(column.type, DateTime):
+            return lambda value: datetime.fromisoformat(value)
+        return lambda value: value
+
+    return {name: convert(table.c[name]) for name in columns}
+
+
+def _defaults(table, columns):
+    """Python-side defaults for the columns the CSV doesn't have.
+
+    COPY only applies server defaults, so fill these in ourselves.
+    """
+
+    defaults = {}
+
+    for column in table.c:
+        default = column.default
+
+        if column.name in columns or default is None:
+            continue
+
+        if default.is_scalar:
+            defaults[column.name] = default.arg
+        elif default.is_callable:
+            defaults[column.name] = default.arg(None)
+
+    return defaults
+
+
+def _copy_field(value):
+    # quoted values are never NULL, so '' and None stay apart
+    if value is None:
+        return r'\N'
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_rows(conn, table, columns, rows):
+    """Insert `rows` (lists of values in `columns` order) with COPY."""
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(_copy_field(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN "
+        f"WITH (FORMAT csv, NULL '\\N')",
+        buffer)
+
+
+def insert_rows(conn, table, columns, rows):
+    """Insert `rows` with a single executemany."""
+
+    conn.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def load_csv(conn, table, path, prepare=None, chunk_size=DEFAULT_CHUNK_SIZE,
+             echo=print):
+    """Stream the CSV at `path` into `table`, a chunk at a time.
+
+    `prepare(row, number)` may adjust each row dict (numbered from 1)
+    before it's written. Returns the number of rows loaded.
+    """
+
+    write = copy_rows if _is_postgres(conn) else insert_rows
+    started = time.perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        converters = None
+
+        for chunk in _chunks(reader, chunk_size):
+            rows = []
+
+            for row in chunk:
+                loaded += 1
+                if prepare:
+                    prepare(row, loaded)
+
+                if converters is None:
+                    columns = list(row)
+                    converters = _converters(table, columns)
+                    defaults = _defaults(table, columns)
+                    columns += list(defaults)
+
+                rows.append([converters[name](row[name]) for name in row]
+                            + list(defaults.values()))
+
+            write(conn, table, columns, rows)
+
+            elapsed = time.perf_counter() - started
+            echo(f"{table.name}: {loaded:,} rows "
+                 f"({loaded / elapsed:,.0f} rows/sec)")
+
+    return loaded
+
+
+@contextmanager
+def deferred_indexes(conn, table_names, echo=print):
+    """Drop secondary indexes on `table_names`; rebuild them on exit.
+
+    Unique indexes stay, so duplicates fail as they're loaded. The drops
+    and rebuilds commit on their own, outside any transaction the load
+    runs in, so the indexes come back even if the load fails. Every
+    rebuild is attempted; if any fails, a RuntimeError lists the DDL to
+    re-create them by hand.
+    """
+
+    postgres = _is_postgres(conn)
+    dropped = []
+    triggers = []
+
+    for table in table_names:
+        if postgres:
+            dropped += conn.execute(PG_INDEXES, table=table).fetchall()
+        else:
+            dropped += [(name, ddl) for name, ddl in
+                        conn.execute(SQLITE_SCHEMA, kind='index', table=table)
+                        if not _is_unique(ddl)]
+            triggers += conn.execute(SQLITE_SCHEMA, kind='trigger',
+                                     table=table).fetchall()
+
+    for name, _ in dropped:
+        conn.execute(f'DROP INDEX "{name}"')
+    for name, _ in triggers:
+        conn.execute(f'DROP TRIGGER "{name}"')
+
+    try:
+        yield
+    finally:
+        lost = []
+
+        def rebuild(name, ddl):
+            try:
+                conn.execute(ddl)
+            except Exception as error:
+                echo(f"Couldn't rebuild {name}: {error}")
+                lost.append(ddl)
+                return False
+
+            return True
+
+        for name, ddl in dropped:
+            started = time.perf_counter()
+            if rebuild(name, ddl):
+                echo(f"Rebuilt index {name} "
+                     f"({time.perf_counter() - started:.1f}s)")
+
+        for name, ddl in triggers:
+            rebuild(name, ddl)
+
+        # the triggers missed everything just loaded
+        if triggers and conn.execute(text(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE name = 'messages_fts'")).scalar():
+            conn.execute(text(
+                "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+            echo("Rebuilt messages_fts")
+
+        if lost:
+            raise RuntimeError("Not rebuilt after the load; re-create "
+                               "with:\n" + ';\n'.join(lost))
+
+
+def _reset_sequences(conn):
+    """Point PostgreSQL id sequences past ids we inserted ourselves."""
+
+    if _is_postgres(conn):
+        for table in ('users', 'messages'):
+            conn.execute(text(f"""
+                SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                              COALESCE(MAX(id), 0) + 1, false)
+                FROM {table}
+            """))
+
+
+def load(directory, append=False, chunk_size=DEFAULT_CHUNK_SIZE, echo=print):
+    """Load users.csv, messages.csv, follows.csv and likes.csv (if there
+    is one) from `directory`.
+
+    Without `append` the tables are dropped and recreated first.
+    Returns {table name: rows loaded}.
+    """
+
+    if not append:
+        db.drop_all()
+        if db.engine.dialect.name == 'sqlite':
+            # create_all won't bring back its triggers; let search rebuild it
+            db.session.execute("DROP TABLE IF EXISTS messages_fts")
+            db.session.commit()
+        db.create_all()
+
+    users, messages, follows, likes = (User.__table__, Message.__table__,
+                                       Follows.__table__, Likes.__table__)
+    loaded = {}
+
+    def next_id(conn, table):
+        return conn.execute(
+            select([func.coalesce(func.max(table.c.id), 0)])).scalar()
+
+    with db.engine.connect() as conn:
+        user_offset = next_id(conn, users)
+        message_offset = next_id(conn, messages)
+
+        def prepare_user(row, number):
+            row['id'] = user_offset + number
+
+        def prepare_message(row, number):
+            row['id'] = message_offset + number
+            row['user_id'] = user_offset + int(row['user_id'])
+
+        def prepare_follow(row, number):
+            for key in ('user_being_followed_id', 'user_following_id'):
+                row[key] = user_offset + int(row[key])
+
+        def prepare_like(row, number):
+            row['user_id'] = user_offset + int(row['user_id'])
+            row['message_id'] = message_offset + int(row['message_id'])
+
+        files = [(users, 'users.csv', prepare_user),
+                 (messages, 'messages.csv', prepare_message),
+                 (follows, 'follows.csv', prepare_follow),
+                 (likes, 'likes.csv', prepare_like)]
+
+        # older datasets have no likes
+        if not os.path.exists(os.path.join(directory, 'likes.csv')):
+            files.pop()
+
+        with deferred_indexes(conn, [table.name for table, _, _ in files],
+                              echo):
+            with conn.begin():
+                for table, filename, prepare in files:
+                    loaded[table.name] = load_csv(
+                        conn, table, os.path.join(directory, filename),
+                        prepare, chunk_size, echo)
+
+        _reset_sequences(conn)
+
+    return loaded
@@ -0,0 +1,150 @@
+"""Conditional GET (ETags) and per-route Cache-Control.
+
+Pages used to be sent with no-cache headers on every response, so the
+browser re-downloaded the full page every time. Views covered here
+compute an ETag from cheap version stamps before doing any real work:
+
+    user = User.query.get_or_404(user_id)
+
+    cached = not_modified('profile', user.id, user.version)
+    if cached:
+        return cached
+
+If the browser already has that version, it gets an empty 304 and the
+view never queries messages or renders a template. Otherwise the ETag is
+attached to the full response on the way out.
+
+Every ETag also covers the viewer (their id and version, since like and
+follow buttons depend on them) and the current CSRF token period, so a
+revalidated page never carries an expired token for the message form.
+Pages with pending flash messages are always rendered in full.
+
+Routes choose their Cache-Control with `@cache_policy(...)`; the rest get
+DEFAULT_CACHE_POLICY. Responses that already set one (static files) keep
+theirs.
+"""
+
+import time
+from hashlib import sha1
+
+from flask import current_app, g, request, session
+from sqlalchemy import func
+
+from models import db, Follows, User
+
+DEFAULT_CACHE_POLICY = 'no-cache, no-store, must-revalidate'
+
+# personalized pages: the browser may keep them, but must revalidate
+REVALIDATE = 'private, no-cache'
+
+
+def cache_policy(value):
+    """Decorate a view to send `Cache-Control: value`."""
+
+    def decorator(view):
+        view.cache_policy = value
+        return view
+
+    return decorator
+
+
+def _csrf_period():
+    """Which half of a CSRF token lifetime we're in, if tokens expire."""
+
+    config = current_app.config
+
+    if not config.get('WTF_CSRF_ENABLED', True):
+        return None
+
+    limit = config.get('WTF_CSRF_TIME_LIMIT', 3600)
+
+    if not limit:
+        return None
+
+    return int(time.time() // (limit / 2))
+
+
+def make_etag(*parts):
+    """An ETag for a page built from `parts` by the current viewer."""
+
+    viewer = None
+
+    if g.get('user'):
+        # read fresh: g.user may come from another process's identity cache
+        version = (db.session.query(User.version)
+                   .filter(User.id == g.user.id)
+                   .scalar())
+        viewer = (g.user.id, version)
+    raw = repr((viewer, _csrf_period()) + parts)
+
+    return sha1(raw.encode('utf-8')).hexdigest()
+
+
+def not_modified(*parts):
+    """Return a 304 response if the browser's copy is current, else None.
+
+    `parts` are the version stamps of everything on the page besides the
+    viewer. When this returns None the view should render as usual; the
+    ETag is added to its response.
+    """
+
+    if session.get('_flashes'):
+        return None
+
+    etag = make_etag(*parts)
+    g.etag = etag
+
+    if not request.if_none_match.contains(etag):
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def versions_of(user_ids):
+    """(count, sum of versions) for the users in `user_ids` (a select).
+
+    Versions only go up, so the pair changes whenever any of those users
+    changes or one joins or leaves the set.
+    """
+
+    count, total = (db.session
+                    .query(func.count(User.id),
+                           func.coalesce(func.sum(User.version), 0))
+                    .filter(User.id.in_(user_ids))
+                    .one())
+
+    return count, total
+
+
+def following_versions(user_id):
+    return versions_of(db.session
+                       .query(Follows.user_being_followed_id)
+                       .filter(Follows.user_following_id == user_id))
+
+
+def follower_versions(user_id):
+    return versions_of(db.session
+                       .query(Follows.user_following_id)
+                       .filter(Follows.user_being_followed_id == user_id))
+
+
+def apply_cache_policy(response):
+    """after_request hook: set Cache-Control and the view's ETag."""
+
+    view = current_app.view_functions.get(request.endpoint)
+    policy = getattr(view, 'cache_policy', None)
+
+    if policy:
+        response.headers['Cache-Control'] = policy
+        response.vary.add('Cookie')
+
+        etag = g.get('etag')
+        if etag and response.status_code == 200:
+            response.set_etag(etag)
+
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = DEFAULT_CACHE_POLICY
+
+    return response
@@ -0,0 +1,198 @@
+"""Maintain the denormalized counters on User.
+
+`messages_count`, `following_count`, `followers_count` and `likes_count`
+are adjusted with a single `UPDATE ... SET n = n + delta` in the same
+transaction as the write that changes them, so they commit or roll back
+together. `recount` repairs any drift (e.g. after a bulk load).
+
+Every change also bumps the user's `version`, which conditional.py uses
+for ETags, and drops the user from caches: anonymous pages (see
+response_cache.py) and the logged-in identity (see identity.py). `touch`
+does all that for changes that don't move a counter.
+"""
+
+from sqlalchemy import func, or_, select
+
+from identity import identity
+from models import db, Follows, Likes, Message, User
+from response_cache import response_cache, user_tag
+
+COUNTERS = {
+    'messages': User.messages_count,
+    'following': User.following_count,
+    'followers': User.followers_count,
+    'likes': User.likes_count,
+}
+
+
+def _changed(*user_ids):
+    response_cache.invalidate(*(user_tag(id) for id in user_ids))
+    identity.forget(*user_ids)
+
+
+def adjust(user_id, **deltas):
+    """Add to one user's counters, e.g. `adjust(5, likes=1)`."""
+
+    changes = {COUNTERS[name]: COUNTERS[name] + delta
+               for name, delta in deltas.items() if delta}
+
+    if changes:
+        changes[User.version] = User.version + 1
+        (User.query
+         .filter(User.id == user_id)
+         .update(changes, synchronize_session='evaluate'))
+        _changed(user_id)
+
+
+def touch(*user_ids):
+    """Bump users' versions, e.g. after a profile edit."""
+
+    if not user_ids:
+        return
+
+    # or_ rather than in_, which 'evaluate' can't apply to loaded users
+    (User.query
+     .filter(or_(*(User.id == id for id in user_ids)))
+     .update({User.version: User.version + 1},
+             synchronize_session='evaluate'))
+    _changed(*user_ids)
+
+
+def profile_changed(user_id):
+    """Bump a user's version and profile version after a profile edit.
+
+    `profile_version` keys the cached message cards (see
+    templates/messages/card.html), which show the author's name and avatar
+    but none of the counters.
+    """
+
+    (User.query
+     .filter(User.id == user_id)
+     .update({User.version: User.version + 1,
+              User.profile_version: User.profile_version + 1},
+             synchronize_session='evaluate'))
+    _changed(user_id)
+
+
+def touch_authors(*message_ids):
+    """Bump the versions of whoever wrote `message_ids` (likes changed)."""
+
+    author_ids = {id for id, in (db.session
+                  .query(Message.user_id)
+                  .filter(Message.id.in_(message_ids)))}
+
+    touch(*author_ids)
+
+
+def followed(follower_id, followed_id, delta=1):
+    """Record `follower_id` starting (or, with -1, stopping) a follow."""
+
+    adjust(follower_id, following=delta)
+    adjust(followed_id, followers=delta)
+
+
+def user_deleted(user_id):
+    """Take a user's follows and received likes off other users' counters.
+
+    Call before deleting the user; the database cascades remove the rows
+    themselves but not the counts other users hold for them.
+    """
+
+    follows = Follows.__table__.c
+    likes = Likes.__table__.c
+
+    followed_ids = [id for id, in db.session.execute(
+        select([follows.user_being_followed_id])
+        .where(follows.user_following_id == user_id))]
+    follower_ids = [id for id, in db.session.execute(
+        select([follows.user_following_id])
+        .where(follows.user_being_followed_id == user_id))]
+
+    if followed_ids:
+        (User.query
+         .filter(User.id.in_(followed_ids))
+         .update({User.followers_count: User.followers_count - 1,
+                  User.version: User.version + 1},
+                 synchronize_session=False))
+
+    if follower_ids:
+        (User.query
+         .filter(User.id.in_(follower_ids))
+         .update({User.following_count: User.following_count - 1,
+                  User.version: User.version + 1},
+                 synchronize_session=False))
+
+    # people who liked this user's messages lose those likes, all in one
+    # UPDATE with each liker's count correlated to their row
+    received = Likes.__table__.join(Message.__table__)
+    liker_ids = [id for id, in db.session.execute(
+        select([likes.user_id]).select_from(received).distinct()
+        .where(Message.user_id == user_id))]
+
+    if liker_ids:
+        lost = (select([func.count()])
+                .select_from(received)
+                .where(Message.user_id == user_id)
+                .where(likes.user_id == User.id)
+                .as_scalar())
+
+        (User.query
+         .filter(User.id.in_(liker_ids))
+         .update({User.likes_count: User.likes_count - lost,
+                  User.version: User.version + 1},
+                 synchronize_session=False))
+
+    _changed(user_id, *followed_ids, *follower_ids, *liker_ids)
+
+
+def message_deleted(message):
+    """Take a message, and the likes it got, off its users' counters.
+
+    Call before deleting the message; the likes rows cascade away with it.
+    """
+
+    likes = Likes.__table__.c
+
+    likers = select([likes.user_id]).where(likes.message_id == message.id)
+    liker_ids = [id for id, in db.session.execute(likers)]
+
+    adjust(message.user_id, messages=-1)
+
+    if liker_ids:
+        (User.query
+         .filter(User.id.in_(likers))
+         .update({User.likes_count: User.likes_count - 1,
+                  User.version: User.version + 1},
+                 synchronize_session=False))
+        _changed(*liker_ids)
+
+
+def recount():
+    """Recompute every user's counters from the underlying tables.
+
+    Returns the number of users whose counters had drifted.
+    """
+
+    follows = Follows.__table__.c
+    users = User.__table__.c
+
+    actual = {
+        users.messages_count: (select([func.count()])
+                               .where(Message.user_id == users.id)
+                               .as_scalar()),
+        users.following_count: (select([func.count()])
+                                .where(follows.user_following_id == users.id)
+                                .as_scalar()),
+        users.followers_count: (select([func.count()])
+                                .where(follows.user_being_followed_id == users.id)
+                                .as_scalar()),
+        users.likes_count: (select([func.count()])
+                            .where(Likes.user_id == users.id)
+                            .as_scalar()),
+    }
+
+    drifted = or_(*(column != count for column, count in actual.items()))
+    result = db.session.execute(
+        User.__table__.update().where(drifted).values(actual))
+
+    return result.rowcount
@@ -0,0 +1,111 @@
+"""Follow-graph membership checks.
+
+`User.is_following` used to scan the viewer's whole `following` collection,
+and follower/following pages called it once per card. Lookups here go
+straight to the `follows` primary key instead, can be batched for every
+user on a page in one query, and are cached for the rest of the request.
+
+`followers_page` / `following_page` list one side of the graph a page at
+a time, in user id order.
+"""
+
+from flask import g, has_app_context
+
+from models import db, Follows, User
+from pagination import Page, encode_key
+
+
+def _cache(viewer_id):
+    """Per-request {user_id: bool} answers for `viewer_id`."""
+
+    if not has_app_context():
+        return {}
+
+    if '_follow_graph' not in g:
+        g._follow_graph = {}
+
+    return g._follow_graph.setdefault(viewer_id, {})
+
+
+def following_among(viewer_id, user_ids):
+    """Which of `user_ids` does `viewer_id` follow? Returns a set.
+
+    Anything not already cached for this request is fetched in a single
+    indexed query.
+    """
+
+    cache = _cache(viewer_id)
+    missing = {id for id in user_ids if id not in cache}
+
+    if missing:
+        found = {followed_id for followed_id, in (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == viewer_id,
+                         Follows.user_being_followed_id.in_(missing)))}
+
+        for id in missing:
+            cache[id] = id in found
+
+    return {id for id in user_ids if cache[id]}
+
+
+def is_following(viewer_id, user_id):
+    """Does `viewer_id` follow `user_id`?"""
+
+    return user_id in following_among(viewer_id, [user_id])
+
+
+def forget(viewer_id):
+    """Drop cached answers after `viewer_id` follows or unfollows someone."""
+
+    _cache(viewer_id).clear()
+
+
+def viewer_follows(user):
+    """Template helper: does the logged-in user follow `user`?"""
+
+    if not g.user:
+        return False
+
+    return is_following(g.user.id, getattr(user, 'id', user))
+
+
+def following_ids(user_id):
+    """Ids of everyone `user_id` follows."""
+
+    return {id for id, in (db.session
+                           .query(Follows.user_being_followed_id)
+                           .filter(Follows.user_following_id == user_id))}
+
+
+def _users_page(user_id, mine, theirs, after=None, size=20):
+    """Users at the `theirs` end of `user_id`'s follows, after `after`."""
+
+    query = (User.query
+             .join(Follows, theirs == User.id)
+             .filter(mine == user_id))
+
+    if after:
+        query = query.filter(User.id > after[0])
+
+    users = query.order_by(User.id).limit(size + 1).all()
+
+    if len(users) <= size:
+        return Page(users)
+
+    users = users[:size]
+    return Page(users, encode_key(users[-1].id))
+
+
+def followers_page(user_id, after=None, size=20):
+    """One page of the users following `user_id`."""
+
+    return _users_page(user_id, Follows.user_being_followed_id,
+                       Follows.user_following_id, after, size)
+
+
+def following_page(user_id, after=None, size=20):
+    """One page of the users `user_id` follows."""
+
+    return _users_page(user_id, Follows.user_following_id,
+                       Follows.user_being_followed_id, after, size)
@@ -0,0 +1,139 @@
+"""Cache rendered template fragments in memory.
+
+Message cards look the same on every page that shows them, but were
+rendered again (including a `strftime`) each time. Templates can wrap
+the parts that don't depend on the viewer in a `cache` block:
+
+    {% cache 'message-card', msg.id, msg.author.id,
+             msg.author.profile_version %}
+      ...
+    {% endcache %}
+
+The key is every expression after the tag; anything that can change the
+fragment must be part of it. (A message's author bumps their
+`profile_version` on profile edits, see counters.py, so new avatars and
+usernames show up straight away; their counters, which cards don't show,
+leave it alone.) Viewer-specific markup, like the like button, belongs
+outside the block.
+
+Entries live in a per-process LRU bounded by FRAGMENT_CACHE_ENTRIES and
+FRAGMENT_CACHE_MAX_BYTES. Set FRAGMENT_CACHE_ENABLED = False to render
+everything every time.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class LRUCache:
+    """A size-bounded least-recently-used map of keys to strings."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+
+            self._entries[key] = value
+            self._size += len(value)
+
+            while (len(self._entries) > self.max_entries
+                   or self._size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class FragmentCacheExtension(Extension):
+    """The `{% cache key, ... %}...{% endcache %}` tag."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render', [nodes.List(key)])
+
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        app = current_app._get_current_object()
+
+        if not app.config['FRAGMENT_CACHE_ENABLED']:
+            return caller()
+
+        cache = fragment_cache.cache
+        key = tuple(key)
+
+        fragment = cache.get(key)
+
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment)
+
+        return fragment
+
+
+class FragmentCache:
+    """Set up the `cache` template tag and hold its LRU for an app."""
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('FRAGMENT_CACHE_ENTRIES', 10000)
+        app.config.setdefault('FRAGMENT_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+
+        app.jinja_env.add_extension(FragmentCacheExtension)
+
+    @property
+    def cache(self):
+        app = current_app._get_current_object()
+
+        if 'fragment_cache' not in app.extensions:
+            app.extensions['fragment_cache'] = LRUCache(
+                app.config['FRAGMENT_CACHE_ENTRIES'],
+                app.config['FRAGMENT_CACHE_MAX_BYTES'])
+
+        return app.extensions['fragment_cache']
+
+
+fragment_cache = FragmentCache()
@@ -2,76 +2,271 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a dataset shaped
+like production for capacity tests:
+
+    python generator/create_csvs.py --users 1000000 --workers 8 --out big/
+    python seed.py --dir big/
+
+The same arguments and --seed always give the same files, however many
+workers run, and nothing is fetched from the network.
+
+Users are generated in shards of --shard-size, each in a worker process
+writing its own part files, which are then joined in order. Ids are
+line numbers (see bulk_load.py), so no shard needs another's output.
+
+Shape:
+
+- each user has a popularity drawn from a Pareto distribution; who
+  people follow is sampled in proportion to it, so follower counts are
+  heavy-tailed: most users have a few followers, a handful have a large
+  share of everyone. Sampling uses an alias table, so the follow graph
+  costs O(edges), not O(users²);
+- how many people each user follows, how many messages they post and how
+  many they like are lognormal around the --*-per-user means;
+- likes go to messages in proportion to their author's popularity.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import accumulate
+
+from helpers import (AliasTable, DOMAINS, FIRST_NAMES, HEADER_IMAGE_URLS,
+                     IMAGE_URLS, LAST_NAMES, PASSWORD_HASH, PLACE_SUFFIXES,
+                     WORDS, get_random_datetime, lognormal_count, paragraph,
+                     sentence)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+# spread of the per-user lognormal counts; higher is more skewed
+ACTIVITY_SIGMA = 1.2
+
+# give up on a user's remaining follows or likes after this many misses
+# per wanted row (only matters when nearly everyone is already taken)
+MAX_MISSES_PER_ROW = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler CSVs.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--follows-per-user', type=float, default=16)
+    parser.add_argument('--messages-per-user', type=float, default=3.3)
+    parser.add_argument('--likes-per-user', type=float, default=10)
+    parser.add_argument('--popularity-alpha', type=float, default=1.5,
+                        help="Pareto shape of user popularity; lower is "
+                             "more lopsided")
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime(2025, 1, 1),
+                        help="messages are dated in the two years before")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shard-size', type=int, default=50000)
+    parser.add_argument('--out', default='generator')
+    return parser.parse_args()
+
+
+##############################################################################
+# Worker processes
+#
+# Each worker builds the samplers it needs once, from the seed, in
+# `_start_worker`; shards then each get their own seeded Random.
+
+_args = None
+_popular = None
+_likeable = None
+_first_message_ids = None
+
+
+def _rng(*parts):
+    return random.Random(':'.join(str(part) for part in (_args.seed,) + parts))
+
+
+def _popularity(args):
+    rng = random.Random(f'{args.seed}:popularity')
+    return [rng.paretovariate(args.popularity_alpha)
+            for _ in range(args.users)]
+
+
+def _start_worker(args, message_counts=None):
+    global _args, _popular, _likeable, _first_message_ids
+
+    _args = args
+    popularity = _popularity(args)
+
+    if message_counts is None:
+        _popular = AliasTable(popularity)
+    else:
+        # a message's chance of a like follows its author's popularity
+        _likeable = AliasTable([weight * count for weight, count
+                                in zip(popularity, message_counts)])
+        _first_message_ids = list(accumulate(message_counts, initial=1))
+
+
+def _part(kind, shard):
+    return os.path.join(_args.out, 'parts', f'{kind}-{shard:05d}.csv')
+
+
+def _sample_distinct(rng, sampler, wanted, exclude):
+    """Up to `wanted` distinct draws from `sampler`, none in `exclude`."""
+
+    chosen = set()
+    misses = 0
+
+    while len(chosen) < wanted and misses < MAX_MISSES_PER_ROW * wanted:
+        pick = sampler(rng)
+
+        if pick in chosen or pick in exclude:
+            misses += 1
+        else:
+            chosen.add(pick)
+
+    return chosen
+
+
+def generate_people(shard):
+    """Users, messages and follows for one shard of user ids.
+
+    Returns how many messages each of the shard's users posted.
+    """
+
+    first = shard * _args.shard_size + 1
+    last = min(first + _args.shard_size - 1, _args.users)
+    rng = _rng('people', shard)
+    message_counts = []
+
+    with open(_part('users', shard), 'w', newline='') as users_csv, \
+            open(_part('messages', shard), 'w', newline='') as messages_csv, \
+            open(_part('follows', shard), 'w', newline='') as follows_csv:
+        users = csv.writer(users_csv)
+        messages = csv.writer(messages_csv)
+        follows = csv.writer(follows_csv)
+
+        for user_id in range(first, last + 1):
+            username = (rng.choice(FIRST_NAMES) + rng.choice(LAST_NAMES)
+                        + str(user_id))
+            users.writerow([
+                f'{username}@{rng.choice(DOMAINS)}',
+                username,
+                rng.choice(IMAGE_URLS),
+                PASSWORD_HASH,
+                sentence(rng),
+                rng.choice(HEADER_IMAGE_URLS),
+                rng.choice(WORDS).capitalize() + rng.choice(PLACE_SUFFIXES),
+            ])
+
+            count = lognormal_count(rng, _args.messages_per_user,
+                                    ACTIVITY_SIGMA)
+            message_counts.append(count)
+
+            for _ in range(count):
+                messages.writerow([
+                    paragraph(rng, MAX_WARBLER_LENGTH),
+                    get_random_datetime(rng, _args.until),
+                    user_id,
+                ])
+
+            wanted = min(_args.users - 1,
+                         lognormal_count(rng, _args.follows_per_user,
+                                         ACTIVITY_SIGMA))
+            followed = _sample_distinct(
+                rng, lambda rng: _popular.sample(rng) + 1, wanted, {user_id})
+
+            follows.writerows([followed_id, user_id]
+                              for followed_id in sorted(followed))
+
+    return message_counts
+
+
+def generate_likes(shard):
+    """Likes by one shard of users."""
+
+    first = shard * _args.shard_size + 1
+    last = min(first + _args.shard_size - 1, _args.users)
+    rng = _rng('likes', shard)
+
+    def message_id(rng):
+        while True:
+            author = _likeable.sample(rng)
+            start = _first_message_ids[author]
+            count = _first_message_ids[author + 1] - start
+
+            # only a rounding leftover in the alias table can pick these
+            if count:
+                return start + int(rng.random() * count)
+
+    with open(_part('likes', shard), 'w', newline='') as likes_csv:
+        likes = csv.writer(likes_csv)
+
+        for user_id in range(first, last + 1):
+            own = range(_first_message_ids[user_id - 1],
+                        _first_message_ids[user_id])
+            wanted = lognormal_count(rng, _args.likes_per_user,
+                                     ACTIVITY_SIGMA)
+            liked = _sample_distinct(rng, message_id, wanted, own)
+
+            likes.writerows([user_id, id] for id in sorted(liked))
+
+
+##############################################################################
+# Putting it together
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
 
-fake = Faker()
+def join_parts(args, kind, headers, shards):
+    """Concatenate the shards' part files into one CSV, in shard order."""
 
-# Generate random profile image URLs to use for users
+    with open(os.path.join(args.out, f'{kind}.csv'), 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+        for shard in range(shards):
+            path = os.path.join(args.out, 'parts', f'{kind}-{shard:05d}.csv')
+            with open(path, newline='') as part:
+                shutil.copyfileobj(part, out)
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def main():
+    args = parse_args()
+    shards = -(-args.users // args.shard_size)
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    os.makedirs(os.path.join(args.out, 'parts'), exist_ok=True)
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+    with ProcessPoolExecutor(args.workers, initializer=_start_worker,
+                             initargs=(args,)) as pool:
+        message_counts = [count for counts in
+                          pool.map(generate_people, range(shards))
+                          for count in counts]
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    if sum(message_counts):
+        with ProcessPoolExecutor(args.workers, initializer=_start_worker,
+                                 initargs=(args, message_counts)) as pool:
+            list(pool.map(generate_likes, range(shards)))
+    else:
+        for shard in range(shards):
+            open(os.path.join(args.out, 'parts', f'likes-{shard:05d}.csv'),
+                 'w').close()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+    for kind, headers in [('users', USERS_CSV_HEADERS),
+                          ('messages', MESSAGES_CSV_HEADERS),
+                          ('follows', FOLLOWS_CSV_HEADERS),
+                          ('likes', LIKES_CSV_HEADERS)]:
+        join_parts(args, kind, headers, shards)
 
-# Generate follows.csv from random pairings of users
+    shutil.rmtree(os.path.join(args.out, 'parts'))
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    print(f"{args.users:,} users, {sum(message_counts):,} messages "
+          f"in {args.out}/")
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,244 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything here is offline and takes its randomness from a
+`random.Random` passed in, so the same seed gives the same data.
+"""
 
+import math
+from array import array
+from datetime import timedelta
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+# A fixed set, rather than fetched from splashbase.co on every run
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+HEADER_IMAGE_URLS = [
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh0n9pHJW1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh0uemhCk1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh121HEWa1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh17lfd9R1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1d7s3UD1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1jdFvHR1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh1uhYnog1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh25vNOvI1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh29fxz111st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mnh2m1hnS81st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo1h6tGOZf1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2wz2LTCs1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x3aAnRH1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x80NkDu1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2x9xqeef1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xbk8JUK1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xdqmle51st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xfarCvW1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xgqdEFn1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mo2xijE2nr1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq4kHmAg1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq69jlcS1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopq8fyQwI1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqamedKu1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqc3ZZcz1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqdfx05t1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqfpSTPN1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqhxFulr1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqj9QUeq1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mopqkkwK2M1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6rzyNlAN1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s1hAudo1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s32zb6l1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s4dzqHA1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s661UgK1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s7lR1lS1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6s995bvI1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6sasSvPZ1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mp6scv2xrZ1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6f50W261st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6gwrYvm1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6l06zXi1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6poZxE51st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6tjdFhf1st5lhmo1_1280.jpg',
+    'https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_mpp6w0dxAm1st5lhmo1_1280.jpg',
+]
 
-    return datetime.fromtimestamp(random_timestamp)
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+FIRST_NAMES = """
+    james mary robert patricia john jennifer michael linda david elizabeth
+    william barbara richard susan joseph jessica thomas sarah charles karen
+    chris nancy daniel lisa matthew betty anthony helen mark sandra donald
+    ashley steven kimberly paul emily andrew donna joshua michelle kevin
+    carol brian amanda george melissa edward deborah ronald laura
+""".split()
+
+LAST_NAMES = """
+    smith johnson williams brown jones garcia miller davis rodriguez
+    martinez hernandez lopez gonzalez wilson anderson thomas taylor moore
+    jackson martin lee perez thompson white harris sanchez clark ramirez
+    lewis robinson walker young allen king wright scott torres nguyen hill
+    flores green adams nelson baker hall rivera campbell mitchell carter
+""".split()
+
+DOMAINS = ['gmail.com', 'yahoo.com', 'hotmail.com', 'example.com',
+           'example.org', 'example.net']
+
+PLACE_SUFFIXES = ['ton', 'burgh', 'ville', 'side', 'mouth', 'port', 'field',
+                  'haven', 'view', ' City']
+
+WORDS = """
+    able about above across act add after again against age ago agree air
+    all allow almost alone along already also although always among amount
+    and animal answer any appear area argue arm around art article ask
+    attack author away baby back bad bag ball bank bar base be beat
+    beautiful because become bed before begin behind believe best better
+    between beyond big bird black blood blue board body book born both box
+    boy break bring brother build building business but buy call camera
+    campaign can car card care career carry case cat catch cause cell
+    center central century certain chair chance change character charge
+    check child choice choose church city civil claim class clear close
+    coach cold collection college color come common community company
+    computer concern condition consider contain continue control cost could
+    country couple course court cover create crime cultural culture cup
+    current cut dark data daughter day dead deal death debate decade decide
+    decision deep defense degree describe design despite detail develop
+    difference different difficult dinner direction discover discuss
+    disease do doctor dog door down draw dream drive drop during each early
+    east easy eat economic economy edge effect effort eight either election
+    else end energy enjoy enough enter entire environment especially even
+    evening event ever every evidence exactly example executive exist expect
+    experience expert explain eye face fact factor fail fall family far fast
+    father fear feel few field fight figure fill film final finally find
+    fine finish fire firm first fish five floor fly focus follow food foot
+    force foreign forget form forward four free friend from front full fund
+    future game garden gas general generation get girl give glass go goal
+    good great green ground group grow growth guess gun guy hair half hand
+    happen happy hard have head health hear heart heat heavy help here high
+    history hit hold home hope hospital hot hotel hour house however huge
+    human hundred idea identify image imagine impact important improve
+    include increase indeed industry information inside instead interest
+    international into investment issue item itself job join just keep key
+    kid kind kitchen know land language large last late laugh law lawyer
+    lay lead leader learn least leave left leg legal less let letter level
+    lie life light like likely line list listen little live local long look
+    lose loss lot love low machine magazine main maintain major make manage
+    many market marriage material matter maybe mean measure media medical
+    meet meeting member memory mention message method middle might military
+    million mind minute miss mission model modern moment money month more
+    morning most mother mouth move movement movie much music must myself
+    name nation natural nature near nearly necessary need network never new
+    news newspaper next nice night none nor north not note nothing notice
+    now number occur off offer office officer official often oil old once
+    one only onto open operation option order organization other our out
+    outside over own owner page pain painting paper parent part partner
+    party pass past patient pattern pay peace people perform perhaps period
+    person personal phone physical pick picture piece place plan plant play
+    player point police policy political poor popular population position
+    positive possible power practice prepare present president pressure
+    pretty prevent price private probably problem process produce product
+    professional program project property protect prove provide public pull
+    purpose push put quality question quickly quite race radio raise range
+    rate rather reach read ready real reality realize really reason receive
+    recent recently record red reduce reflect region relate relationship
+    remain remember remove report represent require research resource
+    respond response rest result return reveal rich right rise risk road
+    rock role room rule run safe same save say scene school science score
+    sea season seat second section security see seek seem sell send senior
+    sense series serious serve service set seven several shake share short
+    shot should shoulder show side sign significant similar simple simply
+    since sing single sister sit site situation six size skill skin small
+    smile social society soldier some somebody someone something sometimes
+    son song soon sort sound source south southern space speak special
+    specific speech spend sport spring staff stage stand standard star
+    start state statement station stay step still stock stop store story
+    strategy street strong structure student study stuff style subject
+    success successful such suddenly suffer suggest summer support sure
+    surface system table take talk task tax teach teacher team technology
+    television tell ten tend term test than thank that their them then
+    theory there these they thing think third this those though thought
+    thousand threat three through throughout throw thus time today together
+    tonight too top total tough toward town trade traditional training
+    travel treat treatment tree trial trip trouble true truth try turn two
+    type under understand unit until upon use usually value various very
+    victim view violence visit voice vote wait walk wall want war watch
+    water way weapon wear week weight well west western what whatever when
+    where whether which while white whole whom whose why wide wife will win
+    wind window wish with within without woman wonder word work worker
+    world worry would write writer wrong yard yeah year yes yet you young
+    your yourself
+""".split()
+
+
+def sentence(rng, min_words=4, max_words=12):
+    """A capitalized run of random words ending in a full stop."""
+
+    words = [rng.choice(WORDS)
+             for _ in range(rng.randint(min_words, max_words))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def paragraph(rng, max_length):
+    """Sentences up to `max_length` characters."""
+
+    text = sentence(rng)
+
+    while len(text) < max_length and rng.random() < 0.6:
+        text += ' ' + sentence(rng)
+
+    return text[:max_length]
+
+
+def get_random_datetime(rng, until, year_gap=2):
+    """Get a random datetime within the `year_gap` years before `until`."""
+
+    span = timedelta(days=365 * year_gap).total_seconds()
+    return until - timedelta(seconds=rng.uniform(0, span))
+
+
+def lognormal_count(rng, mean, sigma):
+    """A whole number drawn from a lognormal with the given mean.
+
+    Most draws are near the mean but a few are many times larger, which is
+    how activity on real social sites is spread.
+    """
+
+    if mean <= 0:
+        return 0
+
+    mu = math.log(mean) - sigma ** 2 / 2
+    return int(round(rng.lognormvariate(mu, sigma)))
+
+
+class AliasTable:
+    """Draw indexes in proportion to fixed weights in O(1) each.
+
+    Vose's alias method: O(n) to build, then every draw is one uniform
+    index and one coin flip, however skewed the weights are.
+    """
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+
+        self.n = n
+        self.prob = array('d', (w * n / total for w in weights))
+        self.alias = array('l', bytes(8 * n))
+
+        small = [i for i in range(n) if self.prob[i] < 1]
+        large = [i for i in range(n) if self.prob[i] >= 1]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.alias[less] = more
+            self.prob[more] -= 1 - self.prob[less]
+            (small if self.prob[more] < 1 else large).append(more)
+
+        # leftovers are 1 up to rounding error
+        for i in small + large:
+            self.prob[i] = 1
+
+    def sample(self, rng):
+        i = int(rng.random() * self.n)
+        return i if rng.random() < self.prob[i] else self.alias[i]
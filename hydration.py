@@ -0,0 +1,107 @@
+"""Turn pages of messages into view models for templates.
+
+Templates used to walk `msg.user` for every message, a lazy relationship
+that issued one SELECT per card. Everything a message card needs is
+loaded here instead, in a fixed number of queries per page:
+
+1. the messages themselves, with their authors joined in
+2. which of those messages the viewer has liked (see likes.py)
+3. how many likes each of those messages has
+"""
+
+from collections import namedtuple
+
+from sqlalchemy.orm import joinedload
+
+from likes import like_counts, liked_message_ids
+from models import Message
+
+MessageView = namedtuple('MessageView', [
+    'id',
+    'text',
+    'timestamp',
+    'author',
+    'liked',
+    'like_count',
+])
+
+
+def with_authors(query):
+    """Have a Message query load each author in the same SELECT."""
+
+    return query.options(joinedload(Message.user))
+
+
+def load_messages(message_ids):
+    """Fetch messages (and authors) by id, in the order of `message_ids`."""
+
+    if not message_ids:
+        return []
+
+    by_id = {msg.id: msg for msg in
+             with_authors(Message.query).filter(Message.id.in_(message_ids))}
+
+    return [by_id[id] for id in message_ids if id in by_id]
+
+
+def hydrate(messages, viewer=None):
+    """Build MessageViews for `messages`, as seen by `viewer`.
+
+    `messages` should already have their authors loaded (see
+    `with_authors` / `load_messages`). `viewer` is the logged-in User, or
+    None for anonymous visitors.
+    """
+
+    message_ids = [msg.id for msg in messages]
+
+    if not message_ids:
+        return []
+
+    liked_ids = liked_message_ids(viewer.id if viewer else None, message_ids)
+    counts = like_counts(message_ids)
+
+    return [
+        MessageView(
+            id=msg.id,
+            text=msg.text,
+            timestamp=msg.timestamp,
+            author=msg.user,
+            liked=msg.id in liked_ids,
+            like_count=counts.get(msg.id, 0),
+        )
+        for msg in messages
+    ]
+
+
+def serialize_user(user):
+    """Compact JSON for a user: enough to draw an avatar and a link."""
+
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+    }
+
+
+def serialize(views):
+    """Compact JSON for a page of MessageViews.
+
+    Messages refer to their author by id; each author's details appear once
+    per page under "authors", however many of their messages are on it.
+    """
+
+    authors = {}
+    messages = []
+
+    for view in views:
+        authors[str(view.author.id)] = serialize_user(view.author)
+        messages.append({
+            'id': view.id,
+            'text': view.text,
+            'timestamp': view.timestamp.isoformat(),
+            'author_id': view.author.id,
+            'liked': view.liked,
+            'likes': view.like_count,
+        })
+
+    return {'messages': messages, 'authors': authors}
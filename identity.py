@@ -0,0 +1,142 @@
+"""Resolve the logged-in user without a query on every request.
+
+`add_user_to_g` used to run `User.query.get(...)` on each request. This
+keeps each user's column values in a small per-process cache for
+IDENTITY_CACHE_TTL seconds and rebuilds the User from them, attached to
+the request's session, without a SELECT. Relationships, and the password
+hash (never cached), still load lazily when used.
+
+counters.py calls `forget` whenever it changes a user (profile edits,
+deletes, counters), so this process never serves a stale user after its
+own writes. Other processes may keep an old copy for up to the TTL;
+conditional.py reads the viewer's version fresh for that reason.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+PENDING_FORGETS = 'identity_forgets'
+
+
+class IdentityStore:
+    """user id -> column values, LRU with a TTL."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._entries.get(user_id)
+
+            if item is None:
+                return None
+
+            values, expires = item
+
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return values
+
+    def set(self, user_id, values):
+        with self._lock:
+            self._entries[user_id] = (values, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+
+# never cached: only checked at login and profile edits, where it's loaded
+# fresh, and rehashed on login without any other change to the user
+UNCACHED_COLUMNS = {'password'}
+
+
+def _columns(user):
+    return {attr.key: getattr(user, attr.key)
+            for attr in inspect(User).column_attrs
+            if attr.key not in UNCACHED_COLUMNS}
+
+
+def _forget_committed(db_session):
+    user_ids = db_session.info.pop(PENDING_FORGETS, None)
+
+    if user_ids and has_app_context():
+        identity.store.discard(user_ids)
+
+
+def _drop_forgets(db_session):
+    db_session.info.pop(PENDING_FORGETS, None)
+
+
+class Identity:
+    """Look up the current user through the identity cache."""
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_TTL', 5)
+        app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+
+        event.listen(db.session, 'after_commit', _forget_committed)
+        event.listen(db.session, 'after_rollback', _drop_forgets)
+
+    @property
+    def store(self):
+        app = current_app._get_current_object()
+
+        if 'identity_cache' not in app.extensions:
+            app.extensions['identity_cache'] = IdentityStore(
+                app.config['IDENTITY_CACHE_TTL'],
+                app.config['IDENTITY_CACHE_SIZE'])
+
+        return app.extensions['identity_cache']
+
+    def load(self, user_id):
+        """The User with `user_id` in the current session, or None."""
+
+        if user_id is None:
+            return None
+
+        values = None
+
+        if current_app.config['IDENTITY_CACHE_TTL']:
+            values = self.store.get(user_id)
+
+        if values is None:
+            user = User.query.get(user_id)
+
+            if user is not None and current_app.config['IDENTITY_CACHE_TTL']:
+                self.store.set(user_id, _columns(user))
+
+            return user
+
+        user = User(**values)
+        make_transient_to_detached(user)
+
+        # merge() hands back the copy already in the session, if any
+        return db.session.merge(user, load=False)
+
+    def forget(self, *user_ids):
+        """Drop cached users now, and again once this transaction commits."""
+
+        self.store.discard(user_ids)
+        db.session.info.setdefault(PENDING_FORGETS, set()).update(user_ids)
+
+
+identity = Identity()
@@ -0,0 +1,298 @@
+"""Background jobs for work that needn't hold up the response.
+
+Tasks are plain functions registered by name:
+
+    @jobs.task('timeline.fan_out')
+    def fan_out_message(message_id):
+        ...
+
+and queued from a view with `jobs.enqueue('timeline.fan_out',
+message_id=msg.id)`. The job is a row in the `jobs` table, inserted in
+the view's own transaction: it exists only if the view's writes commit,
+and it isn't lost if the process dies right after. Payloads are JSON, so
+pass ids rather than objects.
+
+Workers run with
+
+    FLASK_APP=app.py flask jobs work --concurrency 4
+
+Each worker thread claims the oldest job that's due, runs it in its own
+transaction and deletes it. A job that raises is retried after an
+exponential backoff (JOBS_RETRY_BASE seconds, doubling, at most
+JOBS_RETRY_MAX, with jitter) until it has run JOBS_MAX_ATTEMPTS times,
+then is kept with status 'failed' and its traceback. A worker that dies
+mid-job leaves it claimed for JOBS_LEASE_SECONDS, after which another
+worker picks it up. Jobs may therefore run more than once, so tasks must
+be safe to repeat.
+
+Web processes only queue jobs, so a deployment needs at least one worker
+running alongside them; without one, nothing is fanned out. For tests
+and development, JOBS_INLINE = True (JOBS_INLINE=1 in the environment,
+see app.py) does without a worker: each request runs the jobs it
+committed once its view returns, at the cost of the request's latency.
+"""
+
+import json
+import logging
+import random
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, g, has_request_context
+from flask.cli import AppGroup
+from sqlalchemy import and_, event, func, inspect, or_, select
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+PENDING_JOBS = 'jobs_pending'
+
+# longest traceback kept on a failed job
+MAX_ERROR_LENGTH = 4000
+
+
+def backoff(attempts, base, cap):
+    """Seconds to wait before running a job again after `attempts` tries.
+
+    Doubles each time up to `cap`, then picks a random point in the upper
+    half so jobs that failed together don't all retry together.
+    """
+
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _committed(db_session):
+    queued = db_session.info.pop(PENDING_JOBS, None)
+
+    if queued and has_request_context() and current_app.config['JOBS_INLINE']:
+        ids = [inspect(job).identity[0] for job in queued]
+        g.setdefault('jobs_ready', []).extend(ids)
+
+
+def _drop_jobs(db_session):
+    db_session.info.pop(PENDING_JOBS, None)
+
+
+class Jobs:
+    """Queue tasks from requests and run them in workers."""
+
+    def __init__(self):
+        self.tasks = {}
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_INLINE', False)
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOBS_RETRY_BASE', 2)
+        app.config.setdefault('JOBS_RETRY_MAX', 3600)
+        app.config.setdefault('JOBS_LEASE_SECONDS', 300)
+        app.config.setdefault('JOBS_POLL_INTERVAL', 1)
+
+        event.listen(db.session, 'after_commit', _committed)
+        event.listen(db.session, 'after_rollback', _drop_jobs)
+        app.after_request(self._run_inline)
+
+    def task(self, name):
+        """Register the decorated function as the task called `name`."""
+
+        def decorator(fn):
+            self.tasks[name] = fn
+            return fn
+
+        return decorator
+
+    def enqueue(self, name, **payload):
+        """Queue task `name` to run with `payload` once this commits."""
+
+        if name not in self.tasks:
+            raise ValueError(f"Unknown task {name!r}")
+
+        job = Job(name=name, payload=json.dumps(payload),
+                  run_at=datetime.utcnow())
+        db.session.add(job)
+        db.session.info.setdefault(PENDING_JOBS, []).append(job)
+
+        return job
+
+    def claim(self, job_id=None):
+        """Take the oldest due job (or job `job_id`) for this worker.
+
+        Returns the claimed Job, or None if there's nothing to do.
+        """
+
+        jobs = Job.__table__
+        now = datetime.utcnow()
+        config = current_app.config
+
+        claimable = or_(
+            and_(jobs.c.status == 'queued', jobs.c.run_at <= now),
+            # claimed by a worker that hasn't finished in time
+            and_(jobs.c.status == 'running', jobs.c.locked_until < now),
+        )
+
+        candidate = (select([jobs.c.id])
+                     .where(claimable)
+                     .order_by(jobs.c.run_at, jobs.c.id)
+                     .limit(1))
+
+        if job_id is not None:
+            candidate = candidate.where(jobs.c.id == job_id)
+
+        if db.engine.dialect.name == 'postgresql':
+            candidate = candidate.with_for_update(skip_locked=True)
+
+        while True:
+            found = db.session.execute(candidate).scalar()
+
+            if found is None:
+                db.session.commit()
+                return None
+
+            # someone else may have got there between the two statements
+            claimed = db.session.execute(
+                jobs.update()
+                .where(and_(jobs.c.id == found, claimable))
+                .values(status='running',
+                        attempts=jobs.c.attempts + 1,
+                        locked_until=now + timedelta(
+                            seconds=config['JOBS_LEASE_SECONDS'])))
+            db.session.commit()
+
+            if claimed.rowcount:
+                return Job.query.get(found)
+
+    def run(self, job):
+        """Run a claimed job; True if it succeeded."""
+
+        job_id, name, attempts = job.id, job.name, job.attempts
+        config = current_app.config
+
+        try:
+            task = self.tasks.get(name)
+
+            if task is None:
+                raise LookupError(f"Unknown task {name!r}")
+
+            task(**json.loads(job.payload))
+
+            Job.query.filter_by(id=job_id).delete()
+            db.session.commit()
+            return True
+
+        except Exception:
+            db.session.rollback()
+            logger.exception("Job %s (%s) failed", job_id, name)
+
+            changes = {'last_error': traceback.format_exc()[-MAX_ERROR_LENGTH:],
+                       'locked_until': None}
+
+            if attempts >= config['JOBS_MAX_ATTEMPTS']:
+                changes['status'] = 'failed'
+            else:
+                delay = backoff(attempts, config['JOBS_RETRY_BASE'],
+                                config['JOBS_RETRY_MAX'])
+                changes['status'] = 'queued'
+                changes['run_at'] = datetime.utcnow() + timedelta(seconds=delay)
+
+            Job.query.filter_by(id=job_id).update(changes)
+            db.session.commit()
+            return False
+
+    def work(self, app, concurrency=1, burst=False, stop=None):
+        """Run jobs in `concurrency` threads until `stop` is set.
+
+        With `burst`, each thread returns once there's nothing due.
+        """
+
+        stop = stop or threading.Event()
+        workers = [threading.Thread(target=self._work, args=(app, burst, stop),
+                                    name=f'jobs-{n}')
+                   for n in range(concurrency)]
+
+        for worker in workers:
+            worker.start()
+
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1)
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    def _work(self, app, burst, stop):
+        with app.app_context():
+            while not stop.is_set():
+                job = self.claim()
+
+                if job is None:
+                    # don't keep a connection open while idle
+                    db.session.remove()
+
+                    if burst:
+                        return
+
+                    stop.wait(app.config['JOBS_POLL_INTERVAL'])
+                    continue
+
+                self.run(job)
+
+    def _run_inline(self, response):
+        for job_id in g.pop('jobs_ready', ()):
+            job = self.claim(job_id)
+
+            if job is not None:
+                self.run(job)
+
+        return response
+
+    def counts(self):
+        """{status: number of jobs} for the jobs still in the table."""
+
+        return dict(db.session
+                    .query(Job.status, func.count())
+                    .group_by(Job.status))
+
+
+jobs = Jobs()
+
+
+##############################################################################
+# flask jobs ...
+
+jobs_cli = AppGroup('jobs', help="Run and inspect background jobs.")
+
+
+@jobs_cli.command('work')
+@click.option('--concurrency', '-c', default=1, help="Worker threads.")
+@click.option('--burst', is_flag=True,
+              help="Exit once there's nothing left to do.")
+def work_command(concurrency, burst):
+    """Run queued jobs."""
+
+    jobs.work(current_app._get_current_object(), concurrency, burst)
+
+
+@jobs_cli.command('status')
+def status_command():
+    """Count jobs by status."""
+
+    for status, count in sorted(jobs.counts().items()):
+        print(f"{status:10} {count}")
+
+
+@jobs_cli.command('retry')
+def retry_command():
+    """Queue failed jobs to run again."""
+
+    retried = (Job.query
+               .filter_by(status='failed')
+               .update({'status': 'queued', 'attempts': 0,
+                        'run_at': datetime.utcnow()}))
+    db.session.commit()
+
+    print(f"Queued {retried} failed job(s) again.")
@@ -0,0 +1,179 @@
+"""Like state for the messages on screen.
+
+Pages used to build `{m.id for m in g.user.likes}`, loading every message
+the viewer had ever liked as a full ORM object. These helpers only ask
+about the message ids actually being shown, and only read the
+(user_id, message_id) columns, so the database can answer from the likes
+index without touching the table or the messages.
+
+`toggle_like` flips a like in a single statement, relying on the unique
+(user_id, message_id) key so double-submits can't create duplicate rows.
+`set_likes` applies a batch of likes and unlikes with one DELETE and one
+INSERT ... SELECT.
+"""
+
+from sqlalchemy import Integer, func, literal, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+import counters
+from models import db, Likes, Message
+from response_cache import message_tag, response_cache
+
+TOGGLE_LIKE_SQL = text("""
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING id
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, :message_id
+        WHERE NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT (user_id, message_id) DO NOTHING
+        RETURNING id
+    )
+    SELECT (SELECT count(*) FROM added), (SELECT count(*) FROM removed)
+""")
+
+
+def liked_message_ids(user_id, message_ids):
+    """Which of `message_ids` has `user_id` liked? Returns a set."""
+
+    message_ids = set(message_ids)
+
+    if user_id is None or not message_ids:
+        return set()
+
+    return {message_id for message_id, in (db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user_id,
+                    Likes.message_id.in_(message_ids)))}
+
+
+def like_counts(message_ids):
+    """How many likes does each of `message_ids` have? Returns a dict."""
+
+    message_ids = set(message_ids)
+
+    if not message_ids:
+        return {}
+
+    return dict(db.session
+                .query(Likes.message_id, func.count())
+                .filter(Likes.message_id.in_(message_ids))
+                .group_by(Likes.message_id))
+
+
+def _toggle_postgres(user_id, message_id):
+    """Toggle with one DELETE ... RETURNING / INSERT ... ON CONFLICT."""
+
+    params = dict(user_id=user_id, message_id=message_id)
+    added, removed = db.session.execute(TOGGLE_LIKE_SQL, params).first()
+
+    return added, removed
+
+
+def _toggle_fallback(user_id, message_id):
+    """Toggle for SQLite, which has no writable CTEs.
+
+    Still no SELECT first: try the DELETE, and only if nothing was there
+    INSERT, ignoring a row a concurrent request inserted in the meantime.
+    """
+
+    likes = Likes.__table__
+
+    removed = db.session.execute(likes.delete().where(
+        (likes.c.user_id == user_id) &
+        (likes.c.message_id == message_id))).rowcount
+
+    added = 0
+
+    if not removed:
+        added = db.session.execute(
+            likes.insert().prefix_with('OR IGNORE'),
+            dict(user_id=user_id, message_id=message_id)).rowcount
+
+    return added, removed
+
+
+def toggle_like(user_id, message_id):
+    """Like `message_id` for `user_id`, or unlike it if already liked.
+
+    Keeps the user's likes_count (and the author's version) in step, in the
+    caller's transaction.
+    Returns (liked, like_count) as they stand after the toggle.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        added, removed = _toggle_postgres(user_id, message_id)
+    else:
+        added, removed = _toggle_fallback(user_id, message_id)
+
+    counters.adjust(user_id, likes=added - removed)
+
+    if added or removed:
+        counters.touch_authors(message_id)
+        response_cache.invalidate(message_tag(message_id))
+
+    # a concurrent double-submit may have inserted it first: still liked
+    liked = not removed
+
+    return liked, like_counts([message_id]).get(message_id, 0)
+
+
+def set_likes(user_id, wanted):
+    """Make `user_id`'s likes match `wanted`, a {message_id: liked} dict.
+
+    Ids of messages that don't exist are ignored. Counters, author
+    versions and cached pages are kept in step, in the caller's
+    transaction. Returns {message_id: (liked, like_count)} for the
+    messages that exist, as they stand afterwards.
+    """
+
+    if not wanted:
+        return {}
+
+    likes = Likes.__table__
+    already = liked_message_ids(user_id, wanted)
+
+    to_add = {id for id, liked in wanted.items() if liked} - already
+    to_remove = {id for id, liked in wanted.items() if not liked} & already
+
+    removed = added = 0
+
+    if to_remove:
+        removed = db.session.execute(likes.delete().where(
+            (likes.c.user_id == user_id) &
+            likes.c.message_id.in_(to_remove))).rowcount
+
+    if to_add:
+        # only messages that exist; a concurrent like is left alone
+        new_likes = select([literal(user_id, Integer), Message.id]).where(
+            Message.id.in_(to_add))
+        columns = ['user_id', 'message_id']
+
+        if db.engine.dialect.name == 'postgresql':
+            insert = (pg_insert(likes)
+                      .from_select(columns, new_likes)
+                      .on_conflict_do_nothing(index_elements=columns))
+        else:
+            insert = (likes.insert()
+                      .from_select(columns, new_likes)
+                      .prefix_with('OR IGNORE'))
+
+        added = db.session.execute(insert).rowcount
+
+    counters.adjust(user_id, likes=added - removed)
+
+    changed = to_add | to_remove
+    if changed:
+        counters.touch_authors(*changed)
+        response_cache.invalidate(*(message_tag(id) for id in changed))
+
+    existing = {id for id, in (db.session
+                .query(Message.id)
+                .filter(Message.id.in_(wanted)))}
+
+    liked = (already | to_add) - to_remove
+    counts = like_counts(existing)
+
+    return {id: (id in liked, counts.get(id, 0)) for id in existing}
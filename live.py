@@ -0,0 +1,375 @@
+"""Push new messages to open home timelines.
+
+`/api/timeline/stream` is a Server-Sent Events stream: while the home
+page is open, each new message by someone the viewer follows arrives as
+an event in the same JSON shape as `/api/timeline`, so the page can
+prepend it without reloading.
+
+Publishing: `messages_add` calls `live.publish(message)`; the event goes
+out once the transaction commits (and not at all if it rolls back), to
+the broker picked by LIVE_BROKER:
+
+- 'local': straight to this process's hub. Fine for one process, and
+  what tests use;
+- 'redis': PUBLISHed on LIVE_REDIS_CHANNEL at LIVE_REDIS_URL. Each
+  process runs one listener thread SUBSCRIBEd to it, which hands what it
+  receives to that process's hub, so every process sees every message.
+
+The hub keeps, per author, the streams of everyone who follows them. A
+stream's follows are read once when it opens; the stream then gives up
+its database connection and only waits on its queue. It ends after
+LIVE_STREAM_SECONDS, and the browser's automatic reconnect picks up any
+follows changed since. The reconnect sends the id of the last message
+it got (Last-Event-ID), and the new stream starts with whatever was
+posted in between; too much of it and the stream resets instead.
+
+Slow clients can't hold events up: each stream's queue holds at most
+LIVE_QUEUE_SIZE events, and a stream that falls that far behind is sent
+a 'reset' event and closed (the page then reloads its timeline). Idle
+streams get a comment every LIVE_HEARTBEAT seconds so proxies don't
+time them out and dead clients are noticed. At most LIVE_MAX_STREAMS are
+open per process; past that the endpoint answers 503.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from hydration import serialize_user, with_authors
+from models import db, Message
+from response_cache import RedisConnection
+
+logger = logging.getLogger(__name__)
+
+PENDING_EVENTS = 'live_events'
+
+# seconds to wait before resubscribing after losing the Redis connection
+RECONNECT_DELAY = 1
+
+
+def message_event(message):
+    """The event for a new message, shaped like a page of `/api/timeline`."""
+
+    return {
+        'messages': [{
+            'id': message.id,
+            'text': message.text,
+            'timestamp': message.timestamp.isoformat(),
+            'author_id': message.user_id,
+            'liked': False,
+            'likes': 0,
+        }],
+        'authors': {str(message.user_id): serialize_user(message.user)},
+    }
+
+
+def sse(data=None, event=None, id=None, comment=None):
+    """One Server-Sent Events frame."""
+
+    lines = []
+
+    if comment is not None:
+        lines.append(f': {comment}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    if id is not None:
+        lines.append(f'id: {id}')
+    if data is not None:
+        lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+
+    return '\n'.join(lines) + '\n\n'
+
+
+##############################################################################
+# The hub
+
+
+class Subscriber:
+    """One open stream: the authors it wants and a bounded queue of events."""
+
+    def __init__(self, author_ids, max_queued):
+        self.author_ids = frozenset(author_ids)
+        self.events = queue.Queue(max_queued)
+        self.overflowed = False
+
+    def offer(self, event):
+        """Queue `event`; False if the queue is full."""
+
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            return False
+
+        return True
+
+
+class Hub:
+    """In-process fan-out of events to the subscribers of their author."""
+
+    def __init__(self, max_subscribers, max_queued):
+        self.max_subscribers = max_subscribers
+        self.max_queued = max_queued
+        self._by_author = defaultdict(set)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, author_ids):
+        """A new Subscriber for `author_ids`, or None if the hub is full."""
+
+        subscriber = Subscriber(author_ids, self.max_queued)
+
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+
+            self._subscribers.add(subscriber)
+            for author_id in subscriber.author_ids:
+                self._by_author[author_id].add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+
+            self._subscribers.discard(subscriber)
+
+            for author_id in subscriber.author_ids:
+                subscribers = self._by_author[author_id]
+                subscribers.discard(subscriber)
+
+                if not subscribers:
+                    del self._by_author[author_id]
+
+    def dispatch(self, author_id, event):
+        """Hand `event` to everyone following `author_id`.
+
+        Subscribers whose queue is full are dropped, and told so by their
+        stream, rather than making the sender wait.
+        """
+
+        with self._lock:
+            subscribers = list(self._by_author.get(author_id, ()))
+
+        for subscriber in subscribers:
+            if not subscriber.offer(event):
+                subscriber.overflowed = True
+                self.unsubscribe(subscriber)
+
+
+##############################################################################
+# Brokers
+
+
+class LocalBroker:
+    """Deliver events within this process only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, author_id, event):
+        self.hub.dispatch(author_id, event)
+
+    def start(self):
+        pass
+
+
+class RedisBroker:
+    """Deliver events to every process through Redis pub/sub."""
+
+    def __init__(self, hub, url, channel):
+        self.hub = hub
+        self.channel = channel
+        self.connection = RedisConnection.from_url(url)
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def publish(self, author_id, event):
+        payload = json.dumps({'author_id': author_id, 'event': event})
+
+        try:
+            self.connection.execute('PUBLISH', self.channel, payload)
+        except Exception:
+            logger.warning("Couldn't publish a live event", exc_info=True)
+
+    def start(self):
+        """Start the listener thread, if it isn't running yet."""
+
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen, name='live-listener', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                for _, payload in self.connection.subscribe(self.channel):
+                    message = json.loads(payload)
+                    self.hub.dispatch(message['author_id'], message['event'])
+            except Exception:
+                logger.warning("Lost the live event subscription",
+                               exc_info=True)
+
+            time.sleep(RECONNECT_DELAY)
+
+
+BROKERS = {
+    'local': lambda app, hub: LocalBroker(hub),
+    'redis': lambda app, hub: RedisBroker(hub, app.config['LIVE_REDIS_URL'],
+                                          app.config['LIVE_REDIS_CHANNEL']),
+}
+
+
+##############################################################################
+# Streams
+
+
+def _publish_committed(db_session):
+    events = db_session.info.pop(PENDING_EVENTS, None)
+
+    if events and has_app_context():
+        for author_id, event in events:
+            live.broker.publish(author_id, event)
+
+
+def _drop_events(db_session):
+    db_session.info.pop(PENDING_EVENTS, None)
+
+
+class Live:
+    """The hub and broker for an app, and the streams built on them."""
+
+    def init_app(self, app):
+        app.config.setdefault('LIVE_BROKER', 'local')
+        app.config.setdefault('LIVE_REDIS_URL', 'redis://localhost:6379/0')
+        app.config.setdefault('LIVE_REDIS_CHANNEL', 'warbler:live')
+        app.config.setdefault('LIVE_HEARTBEAT', 15)
+        app.config.setdefault('LIVE_STREAM_SECONDS', 300)
+        app.config.setdefault('LIVE_QUEUE_SIZE', 100)
+        app.config.setdefault('LIVE_MAX_STREAMS', 1000)
+
+        event.listen(db.session, 'after_commit', _publish_committed)
+        event.listen(db.session, 'after_rollback', _drop_events)
+
+    @property
+    def hub(self):
+        app = current_app._get_current_object()
+
+        if 'live_hub' not in app.extensions:
+            app.extensions['live_hub'] = Hub(app.config['LIVE_MAX_STREAMS'],
+                                             app.config['LIVE_QUEUE_SIZE'])
+
+        return app.extensions['live_hub']
+
+    @property
+    def broker(self):
+        app = current_app._get_current_object()
+
+        if 'live_broker' not in app.extensions:
+            kind = app.config['LIVE_BROKER']
+            app.extensions['live_broker'] = BROKERS[kind](app, self.hub)
+
+        return app.extensions['live_broker']
+
+    def publish(self, message):
+        """Send `message` to its author's followers once this commits."""
+
+        db.session.info.setdefault(PENDING_EVENTS, []).append(
+            (message.user_id, message_event(message)))
+
+    def subscribe(self, author_ids):
+        """A Subscriber for new messages by `author_ids`, or None if full."""
+
+        self.broker.start()
+        return self.hub.subscribe(author_ids)
+
+    def missed(self, author_ids, last_event_id):
+        """Events for messages by `author_ids` after `last_event_id`.
+
+        What a reconnecting browser missed, oldest first; None if that's
+        more than a stream's queue would hold, when it should reset.
+        """
+
+        limit = current_app.config['LIVE_QUEUE_SIZE']
+
+        messages = (with_authors(Message.query)
+                    .filter(Message.user_id.in_(author_ids))
+                    .filter(Message.id > last_event_id)
+                    .order_by(Message.id)
+                    .limit(limit + 1)
+                    .all())
+
+        if len(messages) > limit:
+            return None
+
+        return [message_event(message) for message in messages]
+
+    def stream(self, subscriber, missed=()):
+        """The SSE body for `subscriber`, as a generator of strings.
+
+        Starts with the `missed` events (see `missed`; None sends a
+        reset). Runs after the request has finished, so it reads
+        everything it needs from the app up front and never touches the
+        database.
+        """
+
+        hub = self.hub
+        config = current_app.config
+        heartbeat = config['LIVE_HEARTBEAT']
+        ends = time.monotonic() + config['LIVE_STREAM_SECONDS']
+
+        def generate():
+            try:
+                yield f'retry: {heartbeat * 1000}\n\n'
+
+                if missed is None:
+                    yield sse({}, event='reset')
+                    return
+
+                # subscribed before `missed` was read, so may come twice
+                replayed = set()
+
+                for event in missed:
+                    message_id = event['messages'][0]['id']
+                    replayed.add(message_id)
+                    yield sse(event, id=message_id)
+
+                while True:
+                    left = ends - time.monotonic()
+
+                    if left <= 0:
+                        return
+
+                    if subscriber.overflowed:
+                        yield sse({}, event='reset')
+                        return
+
+                    try:
+                        event = subscriber.events.get(
+                            timeout=min(heartbeat, left))
+                    except queue.Empty:
+                        yield sse(comment='heartbeat')
+                        continue
+
+                    message_id = event['messages'][0]['id']
+
+                    if message_id not in replayed:
+                        yield sse(event, id=message_id)
+            finally:
+                hub.unsubscribe(subscriber)
+
+        return generate()
+
+
+live = Live()
@@ -0,0 +1,392 @@
+"""Load-test Warbler over HTTP and report latency percentiles.
+
+    python loadtest.py --users 10000 --clients 32 --duration 60 \\
+        --mix home=4,users_show=3,list_users=1,like=2 --out run.json
+
+Seeds a database at the chosen scale (generator/create_csvs.py, then
+bulk_load.py; --no-seed reuses what's there), serves the app from a
+local threaded WSGI server, and has --clients concurrent clients run
+scenarios picked at random, weighted by --mix, until --duration runs out.
+A share of clients (--anonymous) browse logged out and only run
+scenarios that make sense without an account; the rest are each logged
+in as a random user.
+
+The report is JSON: per scenario, the request count, errors, throughput,
+p50/p95/p99 latency and SQL statements per request (from the server's
+Server-Timing header; see metrics.py), plus the run's settings and git
+commit, so runs can be compared across commits.
+
+App settings can be overridden for a run with --config, e.g.
+--config RESPONSE_CACHE_BACKEND=null.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SEARCH_TERMS = ['an', 'er', 'jo', 'smith', 'ma', 'li', 'son']
+
+
+##############################################################################
+# Scenarios
+#
+# Each takes the client and a Random and returns (method, path, body).
+# `LOGGED_IN_ONLY` ones are skipped by anonymous clients.
+
+
+def home(client, rng):
+    return 'GET', '/', None
+
+
+def users_show(client, rng):
+    return 'GET', f'/users/{client.random_user(rng)}', None
+
+
+def list_users(client, rng):
+    query = urlencode({'q': rng.choice(SEARCH_TERMS)})
+    return 'GET', f'/users?{query}', None
+
+
+def message_show(client, rng):
+    return 'GET', f'/messages/{client.random_message(rng)}', None
+
+
+def followers(client, rng):
+    return 'GET', f'/users/{client.random_user(rng)}/followers', None
+
+
+def timeline_api(client, rng):
+    return 'GET', '/api/timeline', None
+
+
+def like(client, rng):
+    return 'POST', f'/api/messages/{client.random_message(rng)}/like', None
+
+
+def search(client, rng):
+    query = urlencode({'q': rng.choice(SEARCH_TERMS)})
+    return 'GET', f'/messages/search?{query}', None
+
+
+SCENARIOS = {
+    'home': home,
+    'users_show': users_show,
+    'list_users': list_users,
+    'message_show': message_show,
+    'followers': followers,
+    'timeline_api': timeline_api,
+    'like': like,
+    'search': search,
+}
+
+LOGGED_IN_ONLY = {'timeline_api', 'like', 'followers'}
+
+DEFAULT_MIX = 'home=4,users_show=3,list_users=1,message_show=1,like=2'
+
+
+##############################################################################
+# Reading the server's numbers
+
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def server_queries(header):
+    """SQL statements the server ran, from its Server-Timing header."""
+
+    match = SERVER_TIMING_QUERIES.search(header or '')
+    return int(match.group(1)) if match else 0
+
+
+##############################################################################
+# Clients
+
+
+class Client:
+    """One simulated visitor, logged in as `user_id` or anonymous."""
+
+    def __init__(self, host, port, cookie, max_user_id, max_message_id):
+        self.host = host
+        self.port = port
+        self.cookie = cookie
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+
+    def random_user(self, rng):
+        return rng.randint(1, self.max_user_id)
+
+    def random_message(self, rng):
+        return rng.randint(1, self.max_message_id)
+
+    def request(self, method, path, body=None):
+        """Returns (status, seconds, queries)."""
+
+        headers = {'Accept': 'text/html,application/json'}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+        finally:
+            conn.close()
+
+        elapsed = time.perf_counter() - started
+        queries = server_queries(response.getheader('Server-Timing'))
+
+        return response.status, elapsed, queries
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+
+    rank = max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_client(client, mix, rng, until, warm_until, results):
+    names = [name for name in mix
+             if client.cookie or name not in LOGGED_IN_ONLY]
+    weights = [mix[name] for name in names]
+
+    while time.monotonic() < until:
+        name = rng.choices(names, weights)[0]
+        method, path, body = SCENARIOS[name](client, rng)
+
+        try:
+            status, elapsed, queries = client.request(method, path, body)
+            error = status >= 500
+        except (OSError, http.client.HTTPException):
+            status, elapsed, queries, error = None, None, 0, True
+
+        if time.monotonic() >= warm_until:
+            results.append((name, status, elapsed, queries, error))
+
+
+##############################################################################
+# Putting it together
+
+
+def parse_mix(text):
+    mix = {}
+
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(
+                f"unknown scenario {name!r}; choose from "
+                f"{', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+
+    return mix
+
+
+def parse_config(text):
+    key, _, value = text.partition('=')
+
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+
+    return key, value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load-test Warbler over HTTP.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'warbler-loadtest.sqlite3'))
+    parser.add_argument('--users', type=int, default=1000,
+                        help="dataset scale, for generator/create_csvs.py")
+    parser.add_argument('--no-seed', dest='seed_data', action='store_false',
+                        help="reuse the data already in --database")
+    parser.add_argument('--seed', default='warbler',
+                        help="random seed for the data and the clients")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--anonymous', type=float, default=0.3,
+                        help="share of clients that aren't logged in")
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5,
+                        help="seconds at the start left out of the report")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX)
+    parser.add_argument('--config', type=parse_config, action='append',
+                        default=[], metavar='KEY=VALUE',
+                        help="override an app setting (JSON or string)")
+    parser.add_argument('--out', help="write the report here, not stdout")
+    return parser.parse_args(argv)
+
+
+def seed(args):
+    """Generate a dataset at the requested scale and load it."""
+
+    from app import app, db
+    from bulk_load import load
+    from counters import recount
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable,
+                        os.path.join(HERE, 'generator', 'create_csvs.py'),
+                        '--users', str(args.users), '--seed', args.seed,
+                        '--out', directory], check=True)
+
+        with app.app_context():
+            load(directory, echo=lambda msg: None)
+            recount()
+            db.session.commit()
+
+
+def session_cookie(app, user_id):
+    """A signed session cookie logging in as `user_id`, without a login."""
+
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({CURR_USER_KEY: user_id})
+
+    return f"{app.session_cookie_name}={value}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(args, results, seconds):
+    by_scenario = defaultdict(list)
+    for row in results:
+        by_scenario[row[0]].append(row)
+
+    scenarios = {}
+
+    for name, rows in sorted(by_scenario.items()):
+        latencies = sorted(elapsed * 1000 for _, _, elapsed, _, error in rows
+                           if not error)
+        queries = [queries for _, _, _, queries, error in rows if not error]
+
+        scenarios[name] = {
+            'requests': len(rows),
+            'errors': sum(error for *_, error in rows),
+            'throughput_rps': round(len(rows) / seconds, 2),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'queries_per_request': (round(sum(queries) / len(queries), 2)
+                                    if queries else None),
+            'max_queries': max(queries, default=None),
+        }
+
+    for numbers in scenarios.values():
+        for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if numbers[key] is not None:
+                numbers[key] = round(numbers[key], 2)
+
+    return {
+        'commit': git_commit(),
+        'settings': {
+            'users': args.users,
+            'clients': args.clients,
+            'anonymous': args.anonymous,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'mix': args.mix,
+            'config': dict(args.config),
+            'database': args.database.split(':', 1)[0],
+        },
+        'total': {
+            'requests': len(results),
+            'errors': sum(row[-1] for row in results),
+            'throughput_rps': round(len(results) / seconds, 2),
+        },
+        'scenarios': scenarios,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # app.py picks its database when it's imported
+    os.environ['DATABASE_URL'] = args.database
+
+    from werkzeug.serving import make_server
+
+    from app import app
+    from models import db, Message, User
+
+    app.config['DEBUG_TB_ENABLED'] = False
+    app.config.update(dict(args.config))
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    if args.seed_data:
+        seed(args)
+
+    with app.app_context():
+        max_user_id = db.session.query(db.func.max(User.id)).scalar() or 1
+        max_message_id = (db.session.query(db.func.max(Message.id)).scalar()
+                          or 1)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rng = random.Random(args.seed)
+    results = []
+    started = time.monotonic()
+    warm_until = started + args.warmup
+    until = warm_until + args.duration
+    clients = []
+
+    for n in range(args.clients):
+        cookie = None
+        if rng.random() >= args.anonymous:
+            cookie = session_cookie(app, rng.randint(1, max_user_id))
+
+        client = Client('127.0.0.1', server.server_port, cookie,
+                        max_user_id, max_message_id)
+        clients.append(threading.Thread(
+            target=run_client,
+            args=(client, args.mix, random.Random(f'{args.seed}:{n}'),
+                  until, warm_until, results)))
+
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    server.shutdown()
+
+    output = json.dumps(report(args, results, args.duration), indent=2)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""Full-text search over message text.
+
+Queries are a few words, matched as a whole:
+
+    bird song        messages containing both words (stemmed)
+    "bird song"      the exact phrase
+    bird*            words starting with "bird"
+
+and can be narrowed to one author or to people the viewer follows.
+Results come newest first, paginated with the same (timestamp, id) cursor
+as every other message list.
+
+The index behind it depends on the database:
+
+- PostgreSQL: a `search_vector` tsvector column kept current by a trigger,
+  with a GIN index (migrations/0007_message_search.py). Databases created
+  with db.create_all() don't have the column; they fall back to computing
+  to_tsvector() per row, which is correct but unindexed.
+- SQLite: an FTS5 table, `messages_fts`, kept current by triggers. It is
+  created on first use if missing.
+"""
+
+import re
+
+from flask import current_app
+from sqlalchemy import func, literal_column, select, text
+
+from models import db, Follows, Message, User
+
+TOKEN = re.compile(r'"([^"]*)"|(\w+\*?)')
+WORD = re.compile(r'\w+')
+
+SQLITE_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE messages_fts USING fts5(
+        text, content='messages', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+]
+
+
+class SearchQuery:
+    """A parsed search string: plain terms, prefixes and phrases."""
+
+    def __init__(self, raw):
+        self.terms = []
+        self.prefixes = []
+        self.phrases = []
+
+        for phrase, word in TOKEN.findall(raw or ''):
+            if phrase:
+                words = WORD.findall(phrase)
+                if len(words) > 1:
+                    self.phrases.append(words)
+                elif words:
+                    self.terms.append(words[0])
+            elif word.endswith('*'):
+                self.prefixes.append(word[:-1])
+            else:
+                self.terms.append(word)
+
+    def __bool__(self):
+        return bool(self.terms or self.prefixes or self.phrases)
+
+    def to_tsquery(self):
+        """PostgreSQL to_tsquery() syntax; every part must match."""
+
+        parts = list(self.terms)
+        parts += [f"{prefix}:*" for prefix in self.prefixes]
+        parts += [f"({' <-> '.join(words)})" for words in self.phrases]
+        return ' & '.join(parts)
+
+    def to_fts5(self):
+        """SQLite FTS5 MATCH syntax; every part must match."""
+
+        parts = [f'"{term}"' for term in self.terms]
+        parts += [f'"{prefix}" *' for prefix in self.prefixes]
+        parts += [f'"{" ".join(words)}"' for words in self.phrases]
+        return ' AND '.join(parts)
+
+
+class PostgresMessageSearch:
+    """tsvector / tsquery matching."""
+
+    def __init__(self, indexed):
+        self.indexed = indexed
+
+    def matches(self, query):
+        tsquery = func.to_tsquery('english', query.to_tsquery())
+
+        if self.indexed:
+            vector = literal_column('messages.search_vector')
+        else:
+            vector = func.to_tsvector('english', Message.text)
+
+        return vector.op('@@')(tsquery)
+
+
+class SqliteMessageSearch:
+    """FTS5 matching."""
+
+    def matches(self, query):
+        matching_ids = (select([literal_column('rowid')])
+                        .select_from(text('messages_fts'))
+                        .where(text('messages_fts MATCH :fts_query')
+                               .bindparams(fts_query=query.to_fts5())))
+
+        return Message.id.in_(matching_ids)
+
+
+def _has_search_vector():
+    query = text("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'messages' AND column_name = 'search_vector'
+    """)
+    return db.session.execute(query).scalar() is not None
+
+
+def _ensure_sqlite_fts():
+    """Create and fill messages_fts if this database doesn't have it."""
+
+    with db.engine.begin() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")).scalar()
+
+        if not exists:
+            for statement in SQLITE_FTS_DDL:
+                conn.execute(text(statement))
+
+
+class MessageSearch:
+    """Pick the search backend for the app's database and run searches."""
+
+    @property
+    def backend(self):
+        app = current_app._get_current_object()
+
+        if 'message_search' not in app.extensions:
+            if db.engine.dialect.name == 'postgresql':
+                backend = PostgresMessageSearch(_has_search_vector())
+            else:
+                _ensure_sqlite_fts()
+                backend = SqliteMessageSearch()
+
+            app.extensions['message_search'] = backend
+
+        return app.extensions['message_search']
+
+    def query(self, q, author=None, following_of=None):
+        """A Message query for `q`, or None if `q` has nothing to search.
+
+        `author` limits results to one username; `following_of` to people
+        that user id follows.
+        """
+
+        parsed = SearchQuery(q)
+
+        if not parsed:
+            return None
+
+        query = Message.query.filter(self.backend.matches(parsed))
+
+        if author:
+            author_id = select([User.id]).where(User.username == author)
+            query = query.filter(Message.user_id.in_(author_id))
+
+        if following_of:
+            followed_ids = (select([Follows.user_being_followed_id])
+                            .where(Follows.user_following_id == following_of))
+            query = query.filter(Message.user_id.in_(followed_ids))
+
+        return query
+
+
+message_search = MessageSearch()
@@ -0,0 +1,311 @@
+"""Per-request SQL timing and Prometheus metrics.
+
+Every statement run during a request is counted and timed (SQLAlchemy
+cursor events), and each response says what it cost in a Server-Timing
+header, which browsers show in their network panel:
+
+    Server-Timing: db;dur=4.1;desc="3 queries", app;dur=12.8
+
+The same numbers feed per-endpoint histograms served at /metrics in the
+Prometheus text format, alongside:
+
+- database pool gauges: connections checked out, idle and in overflow,
+  and a histogram of how long requests waited to check one out;
+- login/signup throttling counts (throttle.py) and fragment cache hits
+  and misses (fragment_cache.py);
+- open live timeline streams (live.py).
+
+The work per request is a few clock reads and dictionary updates, so
+it's meant to stay on in production; METRICS_ENABLED = False turns it
+off entirely. Metrics are per process: scrape each worker, or let the
+load balancer's spread even out.
+
+/metrics answers only scrapers that send METRICS_TOKEN as a bearer
+token (`Authorization: Bearer <token>`); everyone else, and everyone if
+no token is set, gets a 404, so the page's existence isn't advertised.
+"""
+
+import hmac
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# seconds; Prometheus client defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75,
+                   1.0, 2.5, 5.0, 7.5, 10.0)
+
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+
+    pairs = ','.join(f'{name}="{_escape(value)}"'
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    """Cumulative buckets, sum and count per combination of labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+
+            if series is None:
+                series = self._series[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = {labels: (list(counts), total)
+                      for labels, (counts, total) in self._series.items()}
+
+        for labels, (counts, total) in sorted(series.items()):
+            running = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                running += count
+                yield ('_bucket', self.labels + ('le',), labels + (bound,),
+                       running)
+
+            yield '_sum', self.labels, labels, total
+            yield '_count', self.labels, labels, running
+
+
+class Gauge:
+    """Values read when scraped, from `read()` -> {labels: value}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.read = read
+
+    def samples(self):
+        for labels, value in sorted(self.read().items()):
+            yield '', self.labels, labels, value
+
+
+class Counter(Gauge):
+    """Like Gauge, but for totals that only go up."""
+
+    kind = 'counter'
+
+
+def render(metrics):
+    """The Prometheus text exposition of `metrics`."""
+
+    lines = []
+
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+
+        for suffix, names, values, value in metric.samples():
+            lines.append(f'{metric.name}{suffix}{_labels(names, values)} '
+                         f'{value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+##############################################################################
+# Collecting
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_request_context() and 'metrics_sql' in g:
+        context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = getattr(context, '_metrics_started', None)
+
+    if started is not None:
+        g.metrics_sql[0] += 1
+        g.metrics_sql[1] += time.perf_counter() - started
+
+
+def _time_checkouts(pool, histogram):
+    """Time how long getting a connection from `pool` waits.
+
+    Only QueuePool ever waits (for a free connection); there's no event
+    for the start of a checkout, so this wraps the pool's own getter.
+    """
+
+    if not isinstance(pool, QueuePool) or getattr(pool, '_metrics', False):
+        return
+
+    get = pool._do_get
+
+    def timed_get():
+        started = time.perf_counter()
+        try:
+            return get()
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    pool._do_get = timed_get
+    pool._metrics = True
+
+
+class Metrics:
+    """Time requests and their SQL, and serve the results."""
+
+    def __init__(self):
+        self.request_seconds = Histogram(
+            'warbler_request_duration_seconds',
+            "Time to build a response, by endpoint.",
+            ('endpoint', 'method', 'status'))
+        self.sql_seconds = Histogram(
+            'warbler_request_sql_duration_seconds',
+            "Time spent in SQL per request, by endpoint.",
+            ('endpoint',))
+        self.sql_queries = Histogram(
+            'warbler_request_sql_queries',
+            "SQL statements per request, by endpoint.",
+            ('endpoint',), buckets=QUERY_BUCKETS)
+        self.pool_wait_seconds = Histogram(
+            'warbler_db_pool_checkout_wait_seconds',
+            "Time spent waiting for a database connection.")
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _start(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql = [0, 0.0]
+
+        if not getattr(self, '_pool_timed', False):
+            from models import db
+            _time_checkouts(db.engine.pool, self.pool_wait_seconds)
+            self._pool_timed = True
+
+    def _finish(self, response):
+        started = g.get('metrics_started')
+
+        if started is None:
+            return response
+
+        elapsed = time.perf_counter() - started
+        queries, sql_seconds = g.metrics_sql
+        endpoint = request.endpoint or 'none'
+
+        self.request_seconds.observe(elapsed, endpoint, request.method,
+                                     str(response.status_code))
+        self.sql_seconds.observe(sql_seconds, endpoint)
+        self.sql_queries.observe(queries, endpoint)
+
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={sql_seconds * 1000:.1f};desc="{queries} queries", '
+            f'app;dur={elapsed * 1000:.1f}')
+
+        return response
+
+    def authorized(self):
+        """Does this request carry the METRICS_TOKEN bearer token?"""
+
+        token = current_app.config['METRICS_TOKEN']
+        header = request.headers.get('Authorization', '')
+        scheme, _, sent = header.partition(' ')
+
+        if not token or scheme.lower() != 'bearer':
+            return False
+
+        return hmac.compare_digest(sent.encode(), token.encode())
+
+    def collect(self):
+        """Every metric this app exposes, for `render`."""
+
+        from fragment_cache import fragment_cache
+        from live import live
+        from models import db
+        from throttle import throttle
+
+        pool = db.engine.pool
+        cache = fragment_cache.cache
+
+        def pool_state():
+            if not isinstance(pool, QueuePool):
+                return {}
+
+            return {('checked_out',): pool.checkedout(),
+                    ('idle',): pool.checkedin(),
+                    ('overflow',): max(0, pool.overflow())}
+
+        def attempts():
+            counts = {}
+            for name, count in throttle.metrics().items():
+                action, _, result = name.rpartition('_')
+                counts[(action, result)] = count
+            return counts
+
+        return [
+            self.request_seconds,
+            self.sql_seconds,
+            self.sql_queries,
+            self.pool_wait_seconds,
+            Gauge('warbler_db_pool_connections',
+                  "Database connections by state.", pool_state, ('state',)),
+            Gauge('warbler_db_pool_size', "Configured pool size.",
+                  lambda: {(): pool.size()} if isinstance(pool, QueuePool)
+                  else {}),
+            Counter('warbler_auth_attempts_total',
+                    "Login and signup attempts, allowed or throttled.",
+                    attempts, ('action', 'result')),
+            Counter('warbler_fragment_cache_requests_total',
+                    "Fragment cache lookups.",
+                    lambda: {('hit',): cache.hits, ('miss',): cache.misses},
+                    ('result',)),
+            Gauge('warbler_live_streams', "Open live timeline streams.",
+                  lambda: {(): len(live.hub)}),
+        ]
+
+    def render(self):
+        return render(self.collect())
+
+
+metrics = Metrics()
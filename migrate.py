@@ -0,0 +1,320 @@
+"""Versioned schema migrations for Warbler.
+
+Migrations live in migrations/ as NNNN_description.py files, each with an
+`upgrade(ctx)` function, and are applied in order. Applied versions are
+recorded in the `schema_migrations` table. Run them with:
+
+    FLASK_APP=app.py flask schema upgrade
+    FLASK_APP=app.py flask schema status
+
+Upgrading is meant to be safe against a live database:
+
+- only one upgrader runs at a time (a PostgreSQL advisory lock);
+- DDL gives up after MIGRATION_LOCK_TIMEOUT instead of queueing behind
+  long transactions and stalling every query behind it;
+- migrations that set `TRANSACTIONAL = False` run in autocommit mode so
+  they can build indexes with CREATE INDEX CONCURRENTLY, which doesn't
+  block writes. These migrations must be idempotent: every step checks
+  for its own work first, so a half-finished run can simply be re-run.
+"""
+
+import importlib.util
+import os
+import re
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import inspect, text
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+# arbitrary key for pg_advisory_lock, shared by every upgrader
+ADVISORY_LOCK_KEY = 7263_1001
+
+
+class Migration:
+    """One migration file."""
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        self._module = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            spec = importlib.util.spec_from_file_location(
+                f'migrations.m{self.version:04d}', self.path)
+            self._module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(self._module)
+        return self._module
+
+    @property
+    def transactional(self):
+        return getattr(self.module, 'TRANSACTIONAL', True)
+
+    def __repr__(self):
+        return f"<Migration {self.version:04d}_{self.name}>"
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """All migrations in `directory`, oldest first."""
+
+    migrations = []
+
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2),
+                                        os.path.join(directory, filename)))
+
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions in {directory}")
+
+    return migrations
+
+
+class MigrationContext:
+    """What a migration's `upgrade(ctx)` gets to work with."""
+
+    def __init__(self, connection, lock_timeout):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+        self.lock_timeout = lock_timeout
+
+        # in a transaction, SET LOCAL ends with it; in autocommit mode the
+        # setting is the session's, and `close` resets it so it doesn't
+        # follow the connection back into the pool
+        self._reset_lock_timeout = False
+
+        if self.is_postgres and lock_timeout:
+            if connection.in_transaction():
+                self.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            else:
+                self.execute(f"SET lock_timeout = '{lock_timeout}'")
+                self._reset_lock_timeout = True
+
+    def close(self):
+        """Undo session settings made for the migration."""
+
+        if self._reset_lock_timeout:
+            self.execute("RESET lock_timeout")
+            self._reset_lock_timeout = False
+
+    @property
+    def is_postgres(self):
+        return self.dialect == 'postgresql'
+
+    def execute(self, sql, **params):
+        return self.connection.execute(text(sql), **params)
+
+    def has_table(self, table):
+        return inspect(self.connection).has_table(table)
+
+    def has_column(self, table, column):
+        columns = inspect(self.connection).get_columns(table)
+        return any(c['name'] == column for c in columns)
+
+    def has_index(self, table, name):
+        inspector = inspect(self.connection)
+        names = {i['name'] for i in inspector.get_indexes(table)}
+        names |= {c['name'] for c in inspector.get_unique_constraints(table)}
+        return name in names
+
+    def add_column(self, table, column, definition):
+        """ALTER TABLE ... ADD COLUMN, unless the column is already there.
+
+        On PostgreSQL 11+ adding a column with a constant DEFAULT only
+        touches the catalog, not every row.
+        """
+
+        if not self.has_column(table, column):
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def create_index(self, name, table, columns, unique=False, using=None):
+        """Create an index without blocking writes to `table`.
+
+        `columns` is the SQL inside the parentheses, e.g.
+        "user_id, timestamp DESC"; `using` picks the index method (e.g.
+        'gin'). On PostgreSQL this uses CONCURRENTLY, so the migration must
+        set TRANSACTIONAL = False. An index left INVALID by an earlier failed
+        concurrent build is dropped and rebuilt.
+        """
+
+        kind = 'UNIQUE INDEX' if unique else 'INDEX'
+        method = f'USING {using} ' if using else ''
+
+        if not self.is_postgres:
+            if not self.has_index(table, name):
+                self.execute(f"CREATE {kind} {name} ON {table} ({columns})")
+            return
+
+        valid = self.execute("""
+            SELECT i.indisvalid
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name
+        """, name=name).scalar()
+
+        if valid:
+            return
+
+        if valid is False:
+            self.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+        self.execute(
+            f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} "
+            f"ON {table} {method}({columns})")
+
+    def batched_update(self, table, assignments, where=None,
+                       batch_size=10000):
+        """Run `UPDATE table SET assignments [WHERE where]` in id batches.
+
+        Each batch commits on its own (the migration must set
+        TRANSACTIONAL = False), so no single transaction holds row locks on
+        the whole table.
+        """
+
+        bounds = self.execute(f"SELECT min(id), max(id) FROM {table}").first()
+        low, high = bounds if bounds and bounds[0] is not None else (1, 0)
+
+        condition = f" AND ({where})" if where else ''
+
+        for start in range(low, high + 1, batch_size):
+            self.execute(
+                f"UPDATE {table} SET {assignments} "
+                f"WHERE id >= :start AND id < :end{condition}",
+                start=start, end=start + batch_size)
+
+
+    def batched_delete(self, table, where, batch_size=10000):
+        """Run `DELETE FROM table WHERE where` in id batches.
+
+        Like `batched_update`, each batch commits on its own, so the
+        migration must set TRANSACTIONAL = False.
+        """
+
+        bounds = self.execute(f"SELECT min(id), max(id) FROM {table}").first()
+        low, high = bounds if bounds and bounds[0] is not None else (1, 0)
+
+        for start in range(low, high + 1, batch_size):
+            self.execute(
+                f"DELETE FROM {table} "
+                f"WHERE id >= :start AND id < :end AND ({where})",
+                start=start, end=start + batch_size)
+
+
+def _ensure_version_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL
+            )
+        """))
+
+
+def applied_versions(engine):
+    """Versions already recorded in schema_migrations."""
+
+    _ensure_version_table(engine)
+
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT version FROM schema_migrations"))
+        return {version for version, in rows}
+
+
+def _record(conn, migration):
+    conn.execute(text("""
+        INSERT INTO schema_migrations (version, name, applied_at)
+        VALUES (:version, :name, :applied_at)
+    """), version=migration.version, name=migration.name,
+        applied_at=datetime.utcnow())
+
+
+def _apply(engine, migration, lock_timeout):
+    if migration.transactional:
+        with engine.begin() as conn:
+            migration.module.upgrade(MigrationContext(conn, lock_timeout))
+            _record(conn, migration)
+        return
+
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        ctx = MigrationContext(conn, lock_timeout)
+
+        try:
+            migration.module.upgrade(ctx)
+            _record(conn, migration)
+        finally:
+            ctx.close()
+
+
+def upgrade(engine, target=None, lock_timeout='5s', echo=print):
+    """Apply pending migrations up to `target` (default: all of them).
+
+    Returns the list of migrations applied.
+    """
+
+    lock_conn = engine.connect()
+    postgres = engine.dialect.name == 'postgresql'
+
+    try:
+        if postgres:
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"),
+                              key=ADVISORY_LOCK_KEY)
+
+        done = applied_versions(engine)
+        pending = [m for m in discover()
+                   if m.version not in done
+                   and (target is None or m.version <= target)]
+
+        for migration in pending:
+            echo(f"Applying {migration.version:04d}_{migration.name} ...")
+            _apply(engine, migration, lock_timeout)
+
+        return pending
+
+    finally:
+        if postgres:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"),
+                              key=ADVISORY_LOCK_KEY)
+        lock_conn.close()
+
+
+##############################################################################
+# flask schema ...
+
+schema_cli = AppGroup('schema', help="Manage database schema migrations.")
+
+
+@schema_cli.command('upgrade')
+@click.option('--target', type=int, help="Stop after this version.")
+def upgrade_command(target):
+    """Apply pending migrations."""
+
+    from flask import current_app
+    from models import db
+
+    timeout = current_app.config.get('MIGRATION_LOCK_TIMEOUT', '5s')
+    applied = upgrade(db.engine, target=target, lock_timeout=timeout)
+
+    print(f"Applied {len(applied)} migration(s).")
+
+
+@schema_cli.command('status')
+def status_command():
+    """List migrations and whether they've been applied."""
+
+    from models import db
+
+    done = applied_versions(db.engine)
+
+    for migration in discover():
+        mark = 'x' if migration.version in done else ' '
+        print(f"[{mark}] {migration.version:04d}_{migration.name}")
@@ -0,0 +1,50 @@
+"""The original Warbler tables: users, messages, follows and likes.
+
+Every statement is IF NOT EXISTS, so databases created earlier with
+db.create_all() pick up from here without changes.
+"""
+
+
+def upgrade(ctx):
+    serial = 'SERIAL PRIMARY KEY' if ctx.is_postgres else 'INTEGER PRIMARY KEY'
+
+    ctx.execute(f"""
+        CREATE TABLE IF NOT EXISTS users (
+            id {serial},
+            email TEXT NOT NULL UNIQUE,
+            username TEXT NOT NULL UNIQUE,
+            image_url TEXT,
+            header_image_url TEXT,
+            bio TEXT,
+            location TEXT,
+            password TEXT NOT NULL
+        )
+    """)
+
+    ctx.execute(f"""
+        CREATE TABLE IF NOT EXISTS messages (
+            id {serial},
+            text VARCHAR(140) NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE
+        )
+    """)
+
+    ctx.execute("""
+        CREATE TABLE IF NOT EXISTS follows (
+            user_being_followed_id INTEGER
+                REFERENCES users (id) ON DELETE CASCADE,
+            user_following_id INTEGER
+                REFERENCES users (id) ON DELETE CASCADE,
+            PRIMARY KEY (user_being_followed_id, user_following_id)
+        )
+    """)
+
+    ctx.execute(f"""
+        CREATE TABLE IF NOT EXISTS likes (
+            id {serial},
+            user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER REFERENCES messages (id) ON DELETE CASCADE
+        )
+    """)
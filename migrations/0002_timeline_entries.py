@@ -0,0 +1,24 @@
+"""Precomputed home timelines (see timeline.py).
+
+A new, empty table; timelines are rebuilt on first read, so there's no
+backfill to do here.
+"""
+
+
+def upgrade(ctx):
+    ctx.execute("""
+        CREATE TABLE IF NOT EXISTS timeline_entries (
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER NOT NULL
+                REFERENCES messages (id) ON DELETE CASCADE,
+            author_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        )
+    """)
+
+    ctx.execute("""
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_timestamp
+        ON timeline_entries (user_id, timestamp, message_id)
+    """)
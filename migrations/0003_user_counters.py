@@ -0,0 +1,29 @@
+"""Denormalized counters on users (see counters.py).
+
+The columns are added with a constant default, which PostgreSQL 11+ does
+without rewriting the table. They are then filled in id-range batches so
+no transaction locks every user row at once.
+"""
+
+TRANSACTIONAL = False
+
+COUNTERS = {
+    'messages_count':
+        "(SELECT count(*) FROM messages WHERE messages.user_id = users.id)",
+    'following_count':
+        "(SELECT count(*) FROM follows"
+        " WHERE follows.user_following_id = users.id)",
+    'followers_count':
+        "(SELECT count(*) FROM follows"
+        " WHERE follows.user_being_followed_id = users.id)",
+    'likes_count':
+        "(SELECT count(*) FROM likes WHERE likes.user_id = users.id)",
+}
+
+
+def upgrade(ctx):
+    for column in COUNTERS:
+        ctx.add_column('users', column, "INTEGER NOT NULL DEFAULT 0")
+
+    ctx.batched_update('users', ', '.join(
+        f"{column} = {count}" for column, count in COUNTERS.items()))
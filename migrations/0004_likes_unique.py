@@ -0,0 +1,30 @@
+"""One like per (user, message).
+
+Duplicate rows from the old racy like toggle are removed first, keeping
+the earliest, in id batches so no one transaction locks the whole table;
+`likes_count` (filled in by 0003, duplicates and all) is then recomputed
+for users who have any. The unique index is then built concurrently. If a duplicate sneaks in during the build, the build fails
+and leaves an INVALID index; re-running the upgrade removes the new
+duplicates and rebuilds it.
+"""
+
+TRANSACTIONAL = False
+
+
+def upgrade(ctx):
+    ctx.batched_delete('likes', """
+        EXISTS (SELECT 1 FROM likes AS earlier
+                WHERE earlier.user_id = likes.user_id
+                  AND earlier.message_id = likes.message_id
+                  AND earlier.id < likes.id)
+    """)
+
+    ctx.batched_update(
+        'users',
+        "likes_count = (SELECT count(*) FROM likes"
+        " WHERE likes.user_id = users.id)",
+        where="likes_count > 0")
+
+    ctx.create_index('uq_likes_user_message', 'likes',
+                     'user_id, message_id', unique=True)
+    ctx.create_index('ix_likes_message', 'likes', 'message_id')
@@ -0,0 +1,19 @@
+"""Indexes for the hot read paths.
+
+- messages(user_id, timestamp DESC): a user's newest messages (profile
+  pages, timeline backfill and rebuild) without a sort.
+- follows(user_following_id, user_being_followed_id): who a user follows.
+  The primary key leads with user_being_followed_id, so this direction
+  used to be a sequential scan.
+
+likes(user_id, message_id) is covered by uq_likes_user_message (0004).
+"""
+
+TRANSACTIONAL = False
+
+
+def upgrade(ctx):
+    ctx.create_index('ix_messages_user_timestamp', 'messages',
+                     'user_id, timestamp DESC')
+    ctx.create_index('ix_follows_follower_followed', 'follows',
+                     'user_following_id, user_being_followed_id')
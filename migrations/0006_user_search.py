@@ -0,0 +1,22 @@
+"""Trigram indexes for user search (see user_search.py).
+
+PostgreSQL only: GIN indexes with pg_trgm's gin_trgm_ops answer both
+`username % q` similarity matches and `ILIKE 'q%'` prefix matches.
+Creating the extension needs sufficient privileges; if it's missing,
+user search falls back to its in-process index.
+
+Other databases get nothing here; they use the in-process index.
+"""
+
+TRANSACTIONAL = False
+
+
+def upgrade(ctx):
+    if not ctx.is_postgres:
+        return
+
+    ctx.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    for column in ('username', 'bio', 'location'):
+        ctx.create_index(f'ix_users_{column}_trgm', 'users',
+                         f'{column} gin_trgm_ops', using='gin')
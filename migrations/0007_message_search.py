@@ -0,0 +1,53 @@
+"""Full-text index on message text (see message_search.py).
+
+PostgreSQL: a nullable tsvector column, a trigger that fills it on insert
+and on text updates, a batched backfill of existing rows, then a GIN index
+built concurrently. The trigger goes in before the backfill so rows
+written during the migration aren't missed.
+
+SQLite: an external-content FTS5 table kept in step by triggers.
+"""
+
+from message_search import SQLITE_FTS_DDL
+
+TRANSACTIONAL = False
+
+
+def upgrade(ctx):
+    if ctx.is_postgres:
+        upgrade_postgres(ctx)
+    else:
+        upgrade_sqlite(ctx)
+
+
+def upgrade_postgres(ctx):
+    ctx.add_column('messages', 'search_vector', 'tsvector')
+
+    has_trigger = ctx.execute("""
+        SELECT 1 FROM pg_trigger WHERE tgname = 'messages_search_vector_update'
+    """).scalar()
+
+    if not has_trigger:
+        ctx.execute("""
+            CREATE TRIGGER messages_search_vector_update
+            BEFORE INSERT OR UPDATE OF text ON messages
+            FOR EACH ROW EXECUTE PROCEDURE
+            tsvector_update_trigger(search_vector, 'pg_catalog.english', text)
+        """)
+
+    ctx.batched_update(
+        'messages',
+        "search_vector = to_tsvector('pg_catalog.english', text)",
+        where="search_vector IS NULL")
+
+    ctx.create_index('ix_messages_search_vector', 'messages',
+                     'search_vector', using='gin')
+
+
+def upgrade_sqlite(ctx):
+    exists = ctx.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").scalar()
+
+    if not exists:
+        for statement in SQLITE_FTS_DDL:
+            ctx.execute(statement)
@@ -0,0 +1,8 @@
+"""Per-user version stamps for ETags (see conditional.py).
+
+A constant default, so on PostgreSQL 11+ this only touches the catalog.
+"""
+
+
+def upgrade(ctx):
+    ctx.add_column('users', 'version', "INTEGER NOT NULL DEFAULT 0")
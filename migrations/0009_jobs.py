@@ -0,0 +1,23 @@
+"""The background job queue (see jobs.py). A new, empty table."""
+
+
+def upgrade(ctx):
+    serial = 'SERIAL PRIMARY KEY' if ctx.is_postgres else 'INTEGER PRIMARY KEY'
+
+    ctx.execute(f"""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id {serial},
+            name VARCHAR(100) NOT NULL,
+            payload TEXT NOT NULL,
+            status VARCHAR(10) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at TIMESTAMP NOT NULL,
+            locked_until TIMESTAMP,
+            last_error TEXT
+        )
+    """)
+
+    ctx.execute("""
+        CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at
+        ON jobs (status, run_at)
+    """)
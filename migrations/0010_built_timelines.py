@@ -0,0 +1,15 @@
+"""Markers for home timelines that have been built (see timeline.py).
+
+A new, empty table: every existing timeline is rebuilt once on its next
+read, which also repairs any that were only partly filled.
+"""
+
+
+def upgrade(ctx):
+    ctx.execute("""
+        CREATE TABLE IF NOT EXISTS built_timelines (
+            user_id INTEGER PRIMARY KEY
+                REFERENCES users (id) ON DELETE CASCADE,
+            built_at TIMESTAMP NOT NULL
+        )
+    """)
@@ -0,0 +1,8 @@
+"""Per-user profile version stamps for message card caching.
+
+A constant default, so on PostgreSQL 11+ this only touches the catalog.
+"""
+
+
+def upgrade(ctx):
+    ctx.add_column('users', 'profile_version', "INTEGER NOT NULL DEFAULT 0")
@@ -0,0 +1,133 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest first on (timestamp, id). Instead of an OFFSET,
+each page hands out an opaque `before` token naming the last row shown, and
+the next page asks for rows strictly older than it. Reading page 50 costs
+the same index range scan as reading page 1.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_key(*parts):
+    """Make an opaque token from the sort key of a row."""
+
+    raw = '|'.join(str(part) for part in parts)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_key(token, *types):
+    """Turn a token from `encode_key` back into a tuple.
+
+    `types` converts each part, e.g. `decode_key(token, float, int)`.
+    Raises ValueError if the token is malformed.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        parts = raw.split('|')
+
+        if len(parts) != len(types):
+            raise ValueError("wrong number of parts")
+
+        return tuple(convert(part) for convert, part in zip(types, parts))
+    except (UnicodeError, TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {token!r}") from exc
+
+
+def _parse_time(value):
+    return datetime.strptime(value, CURSOR_TIME_FORMAT)
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque token for the row at (`timestamp`, `id`)."""
+
+    return encode_key(timestamp.strftime(CURSOR_TIME_FORMAT), id)
+
+
+def decode_cursor(token):
+    """Turn a token from `encode_cursor` back into (timestamp, id).
+
+    Raises ValueError if the token is malformed.
+    """
+
+    return decode_key(token, _parse_time, int)
+
+
+def cursor_from_request(param='before', decode=decode_cursor):
+    """Decode a cursor query param, or 400 if it's been tampered with."""
+
+    token = request.args.get(param)
+
+    if not token:
+        return None
+
+    try:
+        return decode(token)
+    except ValueError:
+        abort(400)
+
+
+def page_size():
+    """Number of messages shown per page (MESSAGES_PER_PAGE)."""
+
+    return current_app.config['MESSAGES_PER_PAGE']
+
+
+def older_than(timestamp_col, id_col, cursor):
+    """SQL filter for rows strictly older than `cursor`."""
+
+    return tuple_(timestamp_col, id_col) < tuple_(*cursor)
+
+
+class Page:
+    """One page of rows, plus the token for the next (older) page."""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def make_page(rows, size, key=lambda row: (row.timestamp, row.id)):
+    """Build a Page from up to `size` + 1 newest-first `rows`.
+
+    Callers fetch one row more than they show; if it's there, there's an
+    older page and its cursor is the last row that is shown.
+    """
+
+    rows = list(rows)
+
+    if len(rows) <= size:
+        return Page(rows)
+
+    rows = rows[:size]
+    return Page(rows, encode_cursor(*key(rows[-1])))
+
+
+def paginate(query, timestamp_col, id_col, cursor=None, size=None):
+    """Fetch one newest-first page from `query`, starting after `cursor`."""
+
+    size = size or page_size()
+
+    if cursor:
+        query = query.filter(older_than(timestamp_col, id_col, cursor))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(size + 1)
+            .all())
+
+    return make_page(rows, size)
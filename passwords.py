@@ -0,0 +1,131 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow: at the default cost a hash or check takes
+a few hundred milliseconds of CPU. Run on the request thread, a burst of
+logins kept every worker busy hashing and starved everything else. Here
+hashing and checking go to a small process pool instead, so at most
+PASSWORD_HASH_WORKERS hashes run at once however many logins arrive.
+Requests wait on the result without holding the CPU.
+
+The cost is BCRYPT_LOG_ROUNDS (default 12). Hashes made at another cost
+still verify; `needs_rehash` tells callers to store a fresh hash, which
+User.check_password does on the next successful login.
+
+With PASSWORD_HASH_WORKERS = 0 everything runs inline, e.g. in scripts.
+
+`hash_seconds` tracks how long one hash takes at the current cost, which
+throttle.py uses to size how many logins the machine can afford.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+# bcrypt only ever looked at the first 72 bytes; newer releases refuse
+# longer input instead, so cut it the same way the old hashes did
+MAX_PASSWORD_BYTES = 72
+
+# weight of the newest timing in the running average
+HASH_TIME_SMOOTHING = 0.2
+
+
+def _encode(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(_encode(password),
+                         bcrypt.gensalt(rounds)).decode('ascii')
+
+
+def _check(password, hashed):
+    try:
+        return bcrypt.checkpw(_encode(password), hashed.encode('ascii'))
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+def _timed(fn, *args):
+    """Run `fn` and also return how long it took (in the pool's process)."""
+
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def hash_cost(hashed):
+    """The cost a bcrypt hash was made with, e.g. 12 for '$2b$12$...'."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class Passwords:
+    """Hash and check passwords in a bounded process pool."""
+
+    def __init__(self):
+        self.rounds = DEFAULT_ROUNDS
+        self.workers = 0
+        self.timeout = None
+        self.hash_seconds = None
+        self._pool = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+        app.config.setdefault('PASSWORD_HASH_WORKERS',
+                              min(4, os.cpu_count() or 1))
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 30)
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            result, elapsed = _timed(fn, *args)
+        else:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                pool = self._pool
+
+            future = pool.submit(_timed, fn, *args)
+            result, elapsed = future.result(self.timeout)
+
+        if self.hash_seconds is None:
+            self.hash_seconds = elapsed
+        else:
+            self.hash_seconds += HASH_TIME_SMOOTHING * (elapsed
+                                                        - self.hash_seconds)
+
+        return result
+
+    def hash(self, password):
+        """A new bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, password, hashed):
+        """Does `password` match `hashed`?"""
+
+        if not hashed:
+            return False
+
+        return self._run(_check, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a cost other than the configured one?"""
+
+        return hash_cost(hashed) != self.rounds
+
+
+passwords = Passwords()
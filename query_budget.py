@@ -0,0 +1,103 @@
+"""Fail view tests that run more SQL than they should.
+
+N+1 queries don't break pages, they just make them slow, so tests that
+only check status codes and strings let them through. Declare how many
+statements a request may take:
+
+    class UserViewTestCase(QueryBudgetMixin, TestCase):
+
+        def test_users_show(self):
+            with self.assertMaxQueries(5):
+                resp = self.client.get(f"/users/{self.uid1}")
+
+Going over fails the test with the statements grouped by shape, literals
+and parameters blanked out, most repeated first; a shape that shows up
+once per row is the N+1.
+
+Keep only the request inside the block, since the test's own queries
+count too, and warm anything built on first use (search backends) before
+it.
+
+Budgets are measured on SQLite. Where a view takes a different path per
+database (e.g. likes.py toggles with one statement on PostgreSQL, two
+elsewhere), a count measured on the other database can be given by
+dialect name; it's picked by the dialect of the connection that ran the
+statements:
+
+    with self.assertMaxQueries(7, postgresql=6):
+        resp = self.client.post(f"/api/messages/{m_id}/like")
+"""
+
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%\(\w+\)s|\?")
+_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+_SPACE = re.compile(r'\s+')
+
+
+def shape(statement):
+    """`statement` with its literals, parameters and IN lists blanked."""
+
+    statement = _LITERALS.sub('?', statement)
+    statement = _LISTS.sub('?, ...', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+class Statements(list):
+    """Recorded SQL, and the dialect of the database that ran it."""
+
+    dialect = None
+
+
+@contextmanager
+def recorded_statements():
+    """Collect the SQL every engine runs in the block, into a list."""
+
+    statements = Statements()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+        statements.dialect = conn.dialect.name
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+
+def describe(statements, budget):
+    """A failure message listing `statements` grouped by shape."""
+
+    lines = [f"{len(statements)} SQL statements, over the budget of "
+             f"{budget}:"]
+
+    for text, count in Counter(map(shape, statements)).most_common():
+        lines.append(f"  {count:3} x {text}")
+
+    return '\n'.join(lines)
+
+
+class QueryBudgetMixin:
+    """`assertMaxQueries` for unittest TestCases."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget, **dialect_budgets):
+        """Fail if the block runs more than `budget` SQL statements.
+
+        `dialect_budgets` replace `budget` on those databases, e.g.
+        `postgresql=6`.
+        """
+
+        with recorded_statements() as statements:
+            yield statements
+
+        budget = dialect_budgets.get(statements.dialect, budget)
+
+        if len(statements) > budget:
+            self.fail(describe(statements, budget))
@@ -0,0 +1,582 @@
+"""Whole-response cache for logged-out visitors.
+
+Anonymous pages are the same for everyone, so during a link-sharing spike
+there's no reason to query and render `/users/5` for every visitor.
+Views opt in with `@anonymous_cache`:
+
+    @app.route('/users/<int:user_id>')
+    @anonymous_cache(lambda user_id: [user_tag(user_id)])
+    def users_show(user_id):
+
+Only GET requests from visitors who aren't logged in and have no flash
+messages waiting are cached, and only 200 responses that didn't touch the
+session and embed no CSRF token are stored: a token is tied to the
+session of whoever rendered the page, so it mustn't be handed to anyone
+else. Templates should only render forms for logged-in users.
+
+Invalidation is by tag. Each entry remembers the generation of every tag
+it was built from ("user:5", "message:12"); `invalidate(tag)` bumps the
+generation once the current transaction commits, and entries built from
+an older generation are treated as misses. counters.py invalidates a
+user's tag whenever it bumps their version. Views can add tags they only
+discover while rendering with `tag()`; those generations are read after
+rendering, so a change committed mid-render is caught by the TTL instead.
+
+On a miss, one request renders while the others for the same key wait
+(up to RESPONSE_CACHE_LOCK_TIMEOUT seconds) and are served its result.
+
+RESPONSE_CACHE_BACKEND picks where entries live:
+
+- 'memory': this process only, LRU with a TTL (the default);
+- 'redis': a Redis-protocol server at RESPONSE_CACHE_REDIS_URL, shared
+  by every process. Redis errors are treated as misses;
+- 'null': nothing is cached.
+
+Tests can run the Redis backend against `FakeRedis` instead of a server.
+"""
+
+import json
+import logging
+import socket
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from urllib.parse import urlparse
+
+from flask import current_app, g, has_app_context, request, session
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+PENDING_TAGS = 'response_cache_tags'
+
+# how often waiters check whether the render they're waiting on finished
+POLL_INTERVAL = 0.02
+
+
+def user_tag(user_id):
+    return f'user:{user_id}'
+
+
+def message_tag(message_id):
+    return f'message:{message_id}'
+
+
+##############################################################################
+# Backends
+
+
+class NullBackend:
+    """Caches nothing."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def add(self, key, value, ttl):
+        return True
+
+    def delete(self, key):
+        pass
+
+    def generations(self, tags):
+        return [0 for _ in tags]
+
+    def bump(self, tags):
+        pass
+
+
+class MemoryBackend:
+    """Entries in this process: an LRU of at most `max_entries`, with TTLs.
+
+    Tag generations are kept apart from entries so eviction can't reset
+    them; there's one small int per tag ever invalidated.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = Lock()
+
+    def _live(self, key):
+        item = self._entries.get(key)
+
+        if item is None:
+            return None
+
+        value, expires = item
+
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+
+        return value
+
+    def get(self, key):
+        with self._lock:
+            value = self._live(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        """Set `key` only if it isn't already set; True if it was set."""
+
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def generations(self, tags):
+        with self._lock:
+            return [self._generations.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+
+class RedisError(Exception):
+    """An error reply from a Redis-protocol server."""
+
+
+class RedisConnection:
+    """A minimal client for the Redis protocol (RESP), over one socket.
+
+    Enough for this cache: send a command, read its reply. Reconnects
+    after a network error.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, timeout=0.25):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = Lock()
+
+    @classmethod
+    def from_url(cls, url):
+        parts = urlparse(url)
+        db = int(parts.path.strip('/') or 0)
+        return cls(parts.hostname or 'localhost', parts.port or 6379, db)
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port),
+                                              self.timeout)
+        self._file = self._sock.makefile('rb')
+
+        if self.db:
+            self._send('SELECT', self.db)
+            self._read()
+
+    def _close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+        self._sock = self._file = None
+
+    def _send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+
+        self._sock.sendall(b''.join(parts))
+
+    def _read(self):
+        line = self._file.readline()
+
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by server")
+
+        kind, rest = line[:1], line[1:-2]
+
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            return self._file.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def execute(self, *args):
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._send(*args)
+                return self._read()
+            except (OSError, ConnectionError):
+                self._close()
+                raise
+
+    def subscribe(self, *channels):
+        """Yield (channel, payload) for each message published on `channels`.
+
+        Opens a connection of its own, with no read timeout since a
+        subscription is quiet between messages, and closes it when the
+        generator is closed. A network error ends it by raising;
+        resubscribing is up to the caller.
+        """
+
+        subscription = type(self)(self.host, self.port, self.db,
+                                  timeout=self.timeout)
+
+        try:
+            subscription._connect()
+            subscription._sock.settimeout(None)
+            subscription._send('SUBSCRIBE', *channels)
+
+            for _ in channels:
+                subscription._read()
+
+            while True:
+                kind, channel, payload = subscription._read()
+
+                if kind == b'message':
+                    yield channel, payload
+        finally:
+            subscription._close()
+
+
+class FakeRedis:
+    """An in-memory stand-in for RedisConnection, for tests.
+
+    Understands the commands RedisBackend sends: GET, SET (with PX and
+    NX), DEL, MGET and INCR.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+
+    def _get(self, key):
+        value, expires = self.data.get(key, (None, None))
+
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return None
+
+        return value
+
+    def execute(self, command, *args):
+        self.commands.append((command,) + args)
+        command = command.upper()
+
+        if command == 'GET':
+            return self._get(args[0])
+
+        if command == 'MGET':
+            return [self._get(key) for key in args]
+
+        if command == 'SET':
+            key, value, *options = args
+            options = [str(option).upper() for option in options]
+            expires = None
+
+            if 'PX' in options:
+                ttl_ms = int(options[options.index('PX') + 1])
+                expires = time.monotonic() + ttl_ms / 1000
+
+            if 'NX' in options and self._get(key) is not None:
+                return None
+
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+
+            self.data[key] = (value, expires)
+            return b'OK'
+
+        if command == 'DEL':
+            return sum(self.data.pop(key, None) is not None for key in args)
+
+        if command == 'INCR':
+            value = int(self._get(args[0]) or 0) + 1
+            self.data[args[0]] = (str(value).encode('utf-8'), None)
+            return value
+
+        raise RedisError(f"Unknown command '{command}'")
+
+
+class RedisBackend:
+    """Entries in a Redis-protocol server, shared across processes.
+
+    Entries expire by TTL; tag generations are plain counters with no
+    expiry (keep the server's eviction policy to volatile-* keys).
+    """
+
+    def __init__(self, connection, prefix='warbler:response:'):
+        self.connection = connection
+        self.prefix = prefix
+
+    def _execute(self, *args, default=None):
+        try:
+            return self.connection.execute(*args)
+        except (OSError, ConnectionError, RedisError) as exc:
+            logger.warning("Response cache unavailable: %s", exc)
+            return default
+
+    def get(self, key):
+        return self._execute('GET', self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self._execute('SET', self.prefix + key, value, 'PX', int(ttl * 1000))
+
+    def add(self, key, value, ttl):
+        reply = self._execute('SET', self.prefix + key, value,
+                              'PX', int(ttl * 1000), 'NX', default=b'OK')
+        return reply is not None
+
+    def delete(self, key):
+        self._execute('DEL', self.prefix + key)
+
+    def generations(self, tags):
+        if not tags:
+            return []
+
+        keys = [f'{self.prefix}gen:{tag}' for tag in tags]
+        values = self._execute('MGET', *keys) or [None] * len(tags)
+
+        return [int(value or 0) for value in values]
+
+    def bump(self, tags):
+        for tag in tags:
+            self._execute('INCR', f'{self.prefix}gen:{tag}')
+
+
+def _memory_backend(app):
+    return MemoryBackend(app.config['RESPONSE_CACHE_ENTRIES'])
+
+
+def _redis_backend(app):
+    url = app.config['RESPONSE_CACHE_REDIS_URL']
+    return RedisBackend(RedisConnection.from_url(url))
+
+
+BACKENDS = {
+    'memory': _memory_backend,
+    'redis': _redis_backend,
+    'null': lambda app: NullBackend(),
+}
+
+
+##############################################################################
+# The cache
+
+
+def _is_cacheable_request():
+    return (request.method == 'GET'
+            and g.get('user') is None
+            and not session.get('_flashes'))
+
+
+def _embeds_csrf_token():
+    """Did this request render a CSRF token (see flask_wtf.csrf)?"""
+
+    return current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token') in g
+
+
+def _flush_tags(db_session):
+    tags = db_session.info.pop(PENDING_TAGS, None)
+
+    # scripts committing outside the app have no cache of their own
+    if tags and has_app_context():
+        response_cache.backend.bump(sorted(tags))
+
+
+def _drop_tags(db_session):
+    db_session.info.pop(PENDING_TAGS, None)
+
+
+class ResponseCache:
+    """Cache whole responses for anonymous visitors."""
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', 'memory')
+        app.config.setdefault('RESPONSE_CACHE_TTL', 60)
+        app.config.setdefault('RESPONSE_CACHE_ENTRIES', 1000)
+        app.config.setdefault('RESPONSE_CACHE_REDIS_URL',
+                              'redis://localhost:6379/0')
+        app.config.setdefault('RESPONSE_CACHE_LOCK_TIMEOUT', 5.0)
+
+        event.listen(db.session, 'after_commit', _flush_tags)
+        event.listen(db.session, 'after_rollback', _drop_tags)
+
+    @property
+    def backend(self):
+        app = current_app._get_current_object()
+
+        if 'response_cache' not in app.extensions:
+            kind = app.config['RESPONSE_CACHE_BACKEND']
+            app.extensions['response_cache'] = BACKENDS[kind](app)
+
+        return app.extensions['response_cache']
+
+    def invalidate(self, *tags):
+        """Expire entries built from `tags` when this transaction commits."""
+
+        db.session.info.setdefault(PENDING_TAGS, set()).update(tags)
+
+    def tag(self, *tags):
+        """Mark the response being rendered as depending on `tags`."""
+
+        if 'response_cache_tags' in g:
+            g.response_cache_tags.update(tags)
+
+    def _key(self):
+        return 'page:' + request.full_path
+
+    def _load(self, key):
+        """The cached entry for `key`, if it's there and still current."""
+
+        raw = self.backend.get(key)
+
+        if raw is None:
+            return None
+
+        entry = json.loads(raw)
+        tags = list(entry['tags'])
+
+        if self.backend.generations(tags) != [entry['tags'][t] for t in tags]:
+            return None
+
+        return entry
+
+    def _render(self, key, view, tags, args, kwargs):
+        """Render with the view and store the result if it's cacheable."""
+
+        generations = dict(zip(tags, self.backend.generations(tags)))
+        g.response_cache_tags = set()
+
+        response = current_app.make_response(view(*args, **kwargs))
+
+        if (response.status_code != 200 or session.modified
+                or _embeds_csrf_token()):
+            return response
+
+        found = sorted(g.response_cache_tags - set(generations))
+        generations.update(zip(found, self.backend.generations(found)))
+
+        entry = {
+            'body': response.get_data(as_text=True),
+            'content_type': response.content_type,
+            'etag': g.get('etag'),
+            'tags': generations,
+        }
+        self.backend.set(key, json.dumps(entry),
+                         current_app.config['RESPONSE_CACHE_TTL'])
+
+        return response
+
+    def _respond(self, entry, status):
+        if entry['etag']:
+            g.etag = entry['etag']
+
+            if request.if_none_match.contains(entry['etag']):
+                return current_app.response_class(status=304)
+
+        response = current_app.response_class(
+            entry['body'], content_type=entry['content_type'])
+        response.headers['X-Cache'] = status
+
+        return response
+
+    def serve(self, view, tags, args, kwargs):
+        """Answer from the cache, or render once and share the result."""
+
+        key = self._key()
+        entry = self._load(key)
+
+        if entry:
+            return self._respond(entry, 'HIT')
+
+        lock_key = 'lock:' + key
+        timeout = current_app.config['RESPONSE_CACHE_LOCK_TIMEOUT']
+
+        if self.backend.add(lock_key, '1', timeout):
+            try:
+                response = self._render(key, view, tags, args, kwargs)
+            finally:
+                self.backend.delete(lock_key)
+
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        # someone else is rendering this page: wait for their result
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            entry = self._load(key)
+
+            if entry:
+                return self._respond(entry, 'HIT')
+
+            if self.backend.get(lock_key) is None:
+                break
+
+        response = current_app.make_response(view(*args, **kwargs))
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+
+response_cache = ResponseCache()
+
+
+def anonymous_cache(tags=lambda **kwargs: []):
+    """Decorate a view to cache its responses for logged-out visitors.
+
+    `tags` gets the view's keyword arguments and returns the tags its
+    page depends on.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not _is_cacheable_request():
+                return view(*args, **kwargs)
+
+            return response_cache.serve(view, tags(**kwargs), args, kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,20 +1,30 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py                          # the sample data in generator/
+    python seed.py --dir big/ --append      # add a bigger dataset
 
+See bulk_load.py for how large files are handled.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from app import app, db
+from bulk_load import DEFAULT_CHUNK_SIZE, load
+from counters import recount
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--dir', default='generator',
+                    help="directory holding users.csv, messages.csv "
+                         "and follows.csv")
+parser.add_argument('--append', action='store_true',
+                    help="add to the existing data instead of starting over")
+parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                    help="rows sent to the database at a time")
+args = parser.parse_args()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+with app.app_context():
+    load(args.dir, append=args.append, chunk_size=args.chunk_size)
 
-db.session.commit()
+    # bulk inserts skip the counter bookkeeping; fill counters in one pass
+    recount()
+    db.session.commit()
@@ -1,23 +1,44 @@
 $(async function() {  
-  let $likeButtons = $('.like-btn');
-  $likeButtons.on('click', handleLikeClick);
+  // delegated, so cards loaded later get working like buttons too
+  $(document).on('click', '.like-btn', handleLikeClick);
+
+  let $olderLinks = $('.older-link[data-api]');
+  $olderLinks.on('click', handleOlderClick);
+
+  // load the next page as the "Older" link scrolls into view
+  if ('IntersectionObserver' in window) {
+    let observer = new IntersectionObserver(entries => {
+      for (let entry of entries) {
+        if (entry.isIntersecting) $(entry.target).trigger('click');
+      }
+    });
+    $olderLinks.each((i, link) => observer.observe(link));
+  }
+
+  let stream = $('#messages').attr('data-stream');
+  if (stream && 'EventSource' in window) followTimeline(stream);
 })
 
-async function handleLikeClick(evt) {
-  evt.preventDefault();
+// Likes are sent in batches: each click updates the button straight
+// away, then clicks within LIKE_FLUSH_DELAY ms of each other go to the
+// server together as one request.
+const LIKE_FLUSH_DELAY = 500;
+
+let pendingLikes = new Map();
+let likeFlushTimer = null;
+let likesInFlight = false;
 
-  let messageId = evt.currentTarget.id;
+function handleLikeClick(evt) {
+  evt.preventDefault();
 
-  // make a post request to like route
-  let response = await axios.post(`/api/messages/${messageId}/like`);
+  let messageId = +evt.currentTarget.id;
+  let liked = !$(evt.currentTarget).hasClass("btn-primary");
 
-  // update button appearance
-  let $currentBtn = $(evt.currentTarget);
-  $currentBtn.toggleClass("btn-primary btn-secondary");
+  showLiked(messageId, liked);
 
   // remove message from list if on liked messages list
   let $likeList = $('.like-list');
-  if($likeList.length) {
+  if($likeList.length && !liked) {
 
     $currentMessage = $(`#liked-message-${messageId}`);
     $currentMessage.fadeOut();
@@ -26,7 +47,161 @@ async function handleLikeClick(evt) {
     $currentLikes -= 1;
     $(`#num-likes`).text($currentLikes); 
   }
+
+  pendingLikes.set(messageId, liked);
+
+  clearTimeout(likeFlushTimer);
+  likeFlushTimer = setTimeout(flushLikes, LIKE_FLUSH_DELAY);
+}
+
+function takePendingLikes() {
+  let likes = [...pendingLikes].map(
+    ([message_id, liked]) => ({ message_id, liked }));
+  pendingLikes.clear();
+  return likes;
+}
+
+async function flushLikes() {
+  // one batch at a time, so an older answer can't land after a newer one;
+  // clicks made meanwhile go once it's back
+  if (likesInFlight || !pendingLikes.size) return;
+  likesInFlight = true;
+
+  let likes = takePendingLikes();
+
+  try {
+    let response = await axios.post('/api/likes', { likes });
+
+    // match the server, unless the button's been clicked again since
+    for (let { message_id, liked } of response.data.likes) {
+      if (!pendingLikes.has(message_id)) showLiked(message_id, liked);
+    }
+  } catch (err) {
+    // not saved (logged out, bad request, offline): undo what we showed
+    for (let { message_id, liked } of likes) {
+      if (!pendingLikes.has(message_id)) showLiked(message_id, !liked);
+    }
+  } finally {
+    likesInFlight = false;
+  }
+
+  if (pendingLikes.size) {
+    clearTimeout(likeFlushTimer);
+    likeFlushTimer = setTimeout(flushLikes, LIKE_FLUSH_DELAY);
+  }
+}
+
+// don't lose clicks made just before leaving the page
+window.addEventListener('pagehide', () => {
+  if (!pendingLikes.size) return;
+
+  let body = JSON.stringify({ likes: takePendingLikes() });
+  navigator.sendBeacon('/api/likes',
+                       new Blob([body], { type: 'application/json' }));
+});
+
+// update a like button's appearance
+function showLiked(messageId, liked) {
+  let $button = $(`.like-btn[id="${messageId}"]`);
+  $button.toggleClass("btn-primary", liked);
+  $button.toggleClass("btn-secondary", !liked);
+}
+
+// Fetch the next page of messages from the JSON API and append it,
+// instead of loading a whole new page.
+async function handleOlderClick(evt) {
+  evt.preventDefault();
+
+  let $link = $(evt.currentTarget);
+  if ($link.hasClass('loading')) return;
+  $link.addClass('loading');
+
+  let response = await axios.get($link.attr('data-api'), {
+    params: { before: $link.attr('data-cursor') }
+  });
+  let { messages, authors, next_cursor } = response.data;
+
+  let $messages = $('#messages');
+  let viewerId = +$messages.attr('data-viewer-id') || null;
+
+  for (let message of messages) {
+    $messages.append(messageCard(message, authors[message.author_id], viewerId));
+  }
+
+  if (next_cursor) {
+    $link.attr('data-cursor', next_cursor);
+    $link.attr('href', `?before=${next_cursor}`);
+    $link.removeClass('loading');
+  } else {
+    $link.remove();
+  }
+}
+
+// Prepend new messages from the timeline's event stream as they're posted.
+function followTimeline(url) {
+  let source = new EventSource(url);
+
+  source.onmessage = evt => prependMessages(JSON.parse(evt.data));
+
+  // we fell behind and missed some: catch up from the first page
+  source.addEventListener('reset', async () => {
+    source.close();
+
+    let response = await axios.get('/api/timeline');
+    prependMessages(response.data);
+
+    followTimeline(url);
+  });
+}
+
+// Add messages (newest first) above the ones shown, skipping any already there.
+function prependMessages({ messages, authors }) {
+  let $messages = $('#messages');
+  let viewerId = +$messages.attr('data-viewer-id') || null;
+
+  for (let message of [...messages].reverse()) {
+    if ($messages.find(`.message-link[href="/messages/${message.id}"]`).length) {
+      continue;
+    }
+    $messages.prepend(messageCard(message, authors[message.author_id], viewerId));
+  }
 }
 
+// Build the same markup as templates/messages/card.html.
+function messageCard(message, author, viewerId) {
+  let $card = $('<li class="list-group-item">');
+
+  $card.append($('<a class="message-link">').attr('href', `/messages/${message.id}`));
+  $card.append(
+    $('<a>').attr('href', `/users/${author.id}`).append(
+      $('<img alt="user image" class="timeline-image">').attr('src', author.image_url)));
+
+  let $area = $('<div class="message-area">');
+  $area.append($('<a>').attr('href', `/users/${author.id}`).text(`@${author.username}`));
+  $area.append(' ', $('<span class="text-muted">').text(formatDate(message.timestamp)));
+  $area.append($('<p>').text(message.text));
+  $card.append($area);
+
+  if (viewerId && viewerId !== author.id) {
+    let $button = $('<button class="like-btn btn btn-sm">')
+      .attr('id', message.id)
+      .addClass(message.liked ? 'btn-primary' : 'btn-secondary')
+      .append('<i class="fa fa-thumbs-up"></i>');
 
-// 6~27 could have been taken out of the onload since it is not called until it listens for clicks
\ No newline at end of file
+    $card.append(
+      $('<form method="POST" class="messages-like">')
+        .attr('action', `/messages/${message.id}/like`)
+        .append($button));
+  }
+
+  return $card;
+}
+
+// "2024-03-05T..." -> "05 March 2024", as the server renders it
+function formatDate(timestamp) {
+  let [year, month, day] = timestamp.slice(0, 10).split('-').map(Number);
+
+  return new Date(Date.UTC(year, month - 1, day)).toLocaleDateString('en-GB', {
+    day: '2-digit', month: 'long', year: 'numeric', timeZone: 'UTC'
+  });
+}
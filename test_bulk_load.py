@@ -0,0 +1,121 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+
+import bulk_load
+from models import db, Message, User
+
+
+class BulkLoadTestCase(TestCase):
+    """Load CSVs into a scratch database."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=StaticPool,
+                                    connect_args={'check_same_thread': False})
+        db.Model.metadata.create_all(self.engine)
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'messages.csv')
+
+        with open(self.path, 'w') as f:
+            f.write("text,timestamp,user_id\n")
+            for n in range(25):
+                f.write(f"warble {n},2020-01-02 03:04:{n:02d}.5,1\n")
+
+        with self.engine.begin() as conn:
+            conn.execute(User.__table__.insert(),
+                         id=1, email="a@test.com", username="a", password="x")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_load_csv_in_chunks(self):
+        """Are all rows loaded, a chunk at a time, with defaults filled?"""
+
+        progress = []
+
+        with self.engine.begin() as conn:
+            loaded = bulk_load.load_csv(conn, Message.__table__, self.path,
+                                        chunk_size=10, echo=progress.append)
+
+        self.assertEqual(loaded, 25)
+        self.assertEqual(len(progress), 3)
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(Message.__table__.select()
+                                .order_by(Message.id)).fetchall()
+
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[-1].text, "warble 24")
+        self.assertEqual(rows[-1].timestamp.second, 24)
+
+    def test_deferred_indexes_restored(self):
+        """Do dropped indexes come back, even when the load fails?"""
+
+        def indexes():
+            return {i['name'] for i in
+                    inspect(self.engine).get_indexes('messages')}
+
+        before = indexes()
+        self.assertIn('ix_messages_user_timestamp', before)
+
+        with self.engine.connect() as conn:
+            with self.assertRaises(ZeroDivisionError):
+                with bulk_load.deferred_indexes(conn, ['messages'],
+                                                echo=lambda msg: None):
+                    self.assertEqual(indexes(), set())
+                    1 / 0
+
+        self.assertEqual(indexes(), before)
+
+    def test_deferred_indexes_keep_unique(self):
+        """Do unique indexes stay, so duplicates fail during the load?"""
+
+        with self.engine.begin() as conn:
+            conn.execute("CREATE UNIQUE INDEX uq_messages_text "
+                         "ON messages (text)")
+
+        with self.engine.connect() as conn:
+            with bulk_load.deferred_indexes(conn, ['messages'],
+                                            echo=lambda msg: None):
+                self.assertEqual(
+                    {i['name'] for i in
+                     inspect(self.engine).get_indexes('messages')},
+                    {'uq_messages_text'})
+
+                bulk_load.load_csv(conn, Message.__table__, self.path,
+                                   echo=lambda msg: None)
+
+                with self.assertRaises(IntegrityError):
+                    bulk_load.load_csv(conn, Message.__table__, self.path,
+                                       echo=lambda msg: None)
+
+    def test_deferred_indexes_report_lost(self):
+        """Are the other indexes rebuilt, and the lost one reported?"""
+
+        with self.engine.begin() as conn:
+            conn.execute("CREATE INDEX ix_messages_text ON messages (text)")
+
+        with self.engine.connect() as conn:
+            with self.assertRaises(RuntimeError) as raised:
+                with bulk_load.deferred_indexes(conn, ['messages'],
+                                                echo=lambda msg: None):
+                    # takes the name, so that index can't come back
+                    conn.execute("CREATE INDEX ix_messages_text "
+                                 "ON users (email)")
+
+        self.assertIn('ON messages (text)', str(raised.exception))
+        self.assertIn('ix_messages_user_timestamp',
+                      {i['name'] for i in
+                       inspect(self.engine).get_indexes('messages')})
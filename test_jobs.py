@@ -0,0 +1,138 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from jobs import backoff, jobs
+
+app.config['TESTING'] = True
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+calls = []
+
+
+@jobs.task('test.record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.task('test.explode')
+def explode():
+    raise RuntimeError("boom")
+
+
+class JobsTestCase(TestCase):
+    """Test queueing, running and retrying jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['JOBS_MAX_ATTEMPTS'] = 2
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        app.config['JOBS_MAX_ATTEMPTS'] = 5
+
+    def test_queued_on_commit_only(self):
+        """Does a rolled-back transaction take its jobs with it?"""
+
+        jobs.enqueue('test.record', value=1)
+        db.session.rollback()
+
+        self.assertEqual(Job.query.count(), 0)
+
+        jobs.enqueue('test.record', value=2)
+        db.session.commit()
+
+        self.assertEqual(Job.query.one().payload, '{"value": 2}')
+
+    def test_unknown_task(self):
+        """Is a typo caught when queueing rather than in the worker?"""
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue('test.nope')
+
+    def test_work_burst(self):
+        """Does a burst worker run everything due, then stop?"""
+
+        for value in range(3):
+            jobs.enqueue('test.record', value=value)
+        db.session.commit()
+
+        jobs.work(app, concurrency=2, burst=True)
+
+        self.assertEqual(sorted(calls), [0, 1, 2])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_retry_then_fail(self):
+        """Are failing jobs retried later, then kept as failed?"""
+
+        jobs.enqueue('test.explode')
+        db.session.commit()
+
+        self.assertFalse(jobs.run(jobs.claim()))
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn("boom", job.last_error)
+
+        # not due yet
+        self.assertIsNone(jobs.claim())
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertFalse(jobs.run(jobs.claim()))
+        self.assertEqual(Job.query.one().status, 'failed')
+
+    def test_expired_claim(self):
+        """Is a job claimed by a dead worker picked up again?"""
+
+        jobs.enqueue('test.record', value=1)
+        db.session.commit()
+
+        job = jobs.claim()
+        self.assertIsNone(jobs.claim())
+
+        job.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+        self.assertTrue(jobs.run(jobs.claim()))
+        self.assertEqual(calls, [1])
+
+    def test_backoff(self):
+        """Does the delay double, within its cap?"""
+
+        self.assertTrue(1 <= backoff(1, 2, 60) <= 2)
+        self.assertTrue(4 <= backoff(3, 2, 60) <= 8)
+        self.assertTrue(30 <= backoff(10, 2, 60) <= 60)
@@ -21,6 +21,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from hydration import hydrate, load_messages
+from likes import liked_message_ids
 
 app.config['TESTING'] = True
 
@@ -111,3 +113,65 @@ class UserModelTestCase(TestCase):
         # does the user's liked message match the original message?
         self.assertEqual(user2.likes[0].id, m.id)
 
+
+    def test_hydrate(self):
+        """ Do message views carry the author, like state and like count? """
+
+        user2 = User.signup(
+            email="test2",
+            username="test2",
+            password="password",
+            image_url="random_url"
+        )
+
+        liked = Message(text="liked", user_id=self.user1.id)
+        unliked = Message(text="unliked", user_id=self.user1.id)
+
+        db.session.add_all([liked, unliked])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=user2.id, message_id=liked.id))
+        db.session.commit()
+
+        views = hydrate(load_messages([unliked.id, liked.id]), user2)
+
+        self.assertEqual([view.text for view in views], ["unliked", "liked"])
+        self.assertEqual([view.liked for view in views], [False, True])
+        self.assertEqual([view.like_count for view in views], [0, 1])
+        self.assertEqual(views[0].author.username, "testuser1")
+
+        # anonymous viewers haven't liked anything
+        self.assertFalse(any(view.liked for view in hydrate(
+            load_messages([liked.id]))))
+
+    def test_liked_message_ids(self):
+        """ Is like state only reported for the messages asked about? """
+
+        messages = [Message(text=f"m{i}", user_id=self.user1.id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=self.user1.id, message_id=m.id)
+                            for m in messages[:2]])
+        db.session.commit()
+
+        ids = [messages[1].id, messages[2].id]
+
+        self.assertEqual(liked_message_ids(self.user1.id, ids),
+                         {messages[1].id})
+        self.assertEqual(liked_message_ids(None, ids), set())
+        self.assertEqual(liked_message_ids(self.user1.id, []), set())
+
+    def test_duplicate_like(self):
+        """ Can a user like the same message twice? """
+
+        m = Message(text="test message", user_id=self.user1.id)
+        db.session.add(m)
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user1.id, message_id=m.id))
+        db.session.add(Likes(user_id=self.user1.id, message_id=m.id))
+
+        with self.assertRaises(exc.IntegrityError):
+            db.session.commit()
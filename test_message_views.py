@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase #exc = exception class in SQL ALCHEMY
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import counters
+from live import live
+from message_search import message_search
+from query_budget import QueryBudgetMixin
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -34,7 +38,17 @@ app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
-class MessageViewTestCase(TestCase):
+# Caches and throttles would outlive each test's data
+
+app.config['RESPONSE_CACHE_BACKEND'] = 'null'
+app.config['IDENTITY_CACHE_TTL'] = 0
+app.config['THROTTLE_BACKEND'] = 'null'
+
+# Run background jobs as soon as each request commits them
+
+app.config['JOBS_INLINE'] = True
+
+class MessageViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
@@ -65,7 +79,8 @@ class MessageViewTestCase(TestCase):
             # Now, that session setting is saved, so we can have
             # the rest of ours test
 
-            resp = c.post("/messages/new", data={"text": "Hello"})
+            with self.assertMaxQueries(16):
+                resp = c.post("/messages/new", data={"text": "Hello"})
 
             # Make sure it redirects
             self.assertEqual(resp.status_code, 302)
@@ -80,7 +95,8 @@ class MessageViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser.id
 
-            resp = c.post("/messages/new")
+            with self.assertMaxQueries(1):
+                resp = c.post("/messages/new")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -96,7 +112,8 @@ class MessageViewTestCase(TestCase):
         """ Test adding a message when not logged in """
 
         with self.client as c:
-            resp = c.post("/messages/new", data={"text": "Hello"}, follow_redirects=True)
+            with self.assertMaxQueries(0):
+                resp = c.post("/messages/new", data={"text": "Hello"}, follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -113,7 +130,8 @@ class MessageViewTestCase(TestCase):
             db.session.add(m)
             db.session.commit()
 
-            resp = c.get(f"/messages/{m.id}")
+            with self.assertMaxQueries(7):
+                resp = c.get(f"/messages/{m.id}")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -124,7 +142,8 @@ class MessageViewTestCase(TestCase):
 
         with self.client as c:
 
-            resp = c.get(f"/messages/9999")
+            with self.assertMaxQueries(1):
+                resp = c.get(f"/messages/9999")
 
             self.assertEqual(resp.status_code, 404)
 
@@ -139,13 +158,47 @@ class MessageViewTestCase(TestCase):
             db.session.add(m)
             db.session.commit()
 
-            resp = c.post(f"/messages/{m.id}/delete", follow_redirects=True)
+            with self.assertMaxQueries(10):
+                resp = c.post(f"/messages/{m.id}/delete", follow_redirects=True)
 
             self.assertEqual(resp.status_code, 200)     
 
             # is message still in db?
             self.assertIsNone(Message.query.get(1234))
 
+    def test_delete_liked_message(self):
+        """Do the message's likers lose the like from their counters?"""
+
+        liker = User.signup("liker", "liker@test.com", "password", None)
+        other = User.signup("other", "other@test.com", "password", None)
+        m = Message(id=1234, text="liked message", user_id=self.testuser.id)
+        db.session.add_all([liker, other, m])
+        db.session.commit()
+        liker_id = liker.id
+        other_id = other.id
+
+        # one UPDATE for all the likers, however many there are
+        for user in (liker, other):
+            db.session.add(Likes(user_id=user.id, message_id=1234))
+            user.likes_count = 1
+        db.session.commit()
+        version = User.query.get(liker_id).version
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with self.assertMaxQueries(8):
+                c.post("/messages/1234/delete")
+
+            liker = User.query.get(liker_id)
+            self.assertEqual(liker.likes_count, 0)
+            self.assertGreater(liker.version, version)
+            self.assertEqual(User.query.get(other_id).likes_count, 0)
+
+            resp = c.get(f"/users/{liker_id}/likes")
+            self.assertNotIn("liked message", resp.get_data(as_text=True))
+
     def test_delete_invalid_message(self):
         """ Test delete on message with invalid id """
 
@@ -153,7 +206,8 @@ class MessageViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser.id
 
-            resp = c.post(f"/messages/999999/delete")
+            with self.assertMaxQueries(2):
+                resp = c.post(f"/messages/999999/delete")
 
             self.assertEqual(resp.status_code, 404)
 
@@ -167,7 +221,8 @@ class MessageViewTestCase(TestCase):
 
         with self.client as c:
                 
-            resp = c.post(f"/messages/1234/delete", follow_redirects=True)
+            with self.assertMaxQueries(0):
+                resp = c.post(f"/messages/1234/delete", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -192,7 +247,8 @@ class MessageViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = user2.id
 
-            resp = c.post(f"/messages/{m.id}/delete", follow_redirects=True)
+            with self.assertMaxQueries(10):
+                resp = c.post(f"/messages/{m.id}/delete", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
 
@@ -200,3 +256,325 @@ class MessageViewTestCase(TestCase):
             # self.assertIn('Access unauthorized.', html)            
             
 
+    def test_api_like_toggle(self):
+        """ Does the like API toggle and report the new state as JSON? """
+
+        user2 = User.signup("test2", "test2@test.com", "password", None)
+        m = Message(text="likeable", user_id=self.testuser.id)
+        db.session.add(m)
+        db.session.commit()
+
+        m_id = m.id
+        user2_id = user2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            with self.assertMaxQueries(7):
+                resp = c.post(f"/api/messages/{m_id}/like")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(),
+                             {"message_id": m_id, "liked": True, "likes": 1})
+            self.assertEqual(User.query.get(user2_id).likes_count, 1)
+
+            with self.assertMaxQueries(6):
+                resp = c.post(f"/api/messages/{m_id}/like")
+
+            self.assertEqual(resp.get_json(),
+                             {"message_id": m_id, "liked": False, "likes": 0})
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(User.query.get(user2_id).likes_count, 0)
+
+    def test_api_like_logged_out(self):
+        """ Is the like API refused when logged out? """
+
+        with self.client as c:
+            with self.assertMaxQueries(0):
+                resp = c.post("/api/messages/1/like")
+
+            self.assertEqual(resp.status_code, 401)
+
+    def test_api_set_likes(self):
+        """ Does the batch like API apply likes and unlikes together? """
+
+        user2 = User.signup("test2", "test2@test.com", "password", None)
+        m1 = Message(text="first", user_id=self.testuser.id)
+        m2 = Message(text="second", user_id=self.testuser.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        m1_id, m2_id = m1.id, m2.id
+        user2_id = user2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            with self.assertMaxQueries(8):
+                resp = c.post("/api/likes", json={"likes": [
+                    {"message_id": m1_id, "liked": True},
+                    {"message_id": m2_id, "liked": True},
+                    {"message_id": m2_id, "liked": False},
+                    {"message_id": 999999, "liked": True},
+                ]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                sorted(resp.get_json()["likes"], key=lambda l: l["message_id"]),
+                [{"message_id": m1_id, "liked": True, "likes": 1},
+                 {"message_id": m2_id, "liked": False, "likes": 0}])
+            self.assertEqual(Likes.query.count(), 1)
+            self.assertEqual(User.query.get(user2_id).likes_count, 1)
+
+            with self.assertMaxQueries(8):
+                resp = c.post("/api/likes", json={"likes": [
+                    {"message_id": m1_id, "liked": False},
+                    {"message_id": m2_id, "liked": True},
+                ]})
+
+            self.assertEqual(Likes.query.one().message_id, m2_id)
+            self.assertEqual(User.query.get(user2_id).likes_count, 1)
+
+            with self.assertMaxQueries(1):
+                resp = c.post("/api/likes", json={"likes": [{"message_id": "x"}]})
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_set_likes_logged_out(self):
+        """ Is the batch like API refused when logged out? """
+
+        with self.client as c:
+            with self.assertMaxQueries(0):
+                resp = c.post("/api/likes", json={"likes": []})
+
+            self.assertEqual(resp.status_code, 401)
+
+    def test_timeline_stream(self):
+        """ Does the stream push followed authors' new messages only? """
+
+        author = User.signup("author", "author@test.com", "password", None)
+        stranger = User.signup("stranger", "stranger@test.com", "password",
+                               None)
+        db.session.commit()
+
+        testuser_id, author_id = self.testuser.id, author.id
+        stranger_id = stranger.id
+
+        self.testuser.following.append(author)
+        db.session.commit()
+
+        app.config['LIVE_HEARTBEAT'] = 0.05
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            with self.assertMaxQueries(2):
+                resp = c.get("/api/timeline/stream", buffered=False)
+            events = iter(resp.response)
+
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            self.assertTrue(next(events).startswith(b"retry:"))
+
+        for user_id, text in [(stranger_id, "not for you"),
+                              (author_id, "hello followers")]:
+            with app.test_client() as poster:
+                with poster.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+
+                poster.post("/messages/new", data={"text": text})
+
+        while True:
+            frame = next(events).decode()
+            if not frame.startswith(": heartbeat"):
+                break
+
+        self.assertIn('"text":"hello followers"', frame)
+        self.assertIn('"username":"author"', frame)
+        self.assertEqual(len(app.extensions['live_hub']), 1)
+
+        resp.close()
+
+        self.assertEqual(len(app.extensions['live_hub']), 0)
+
+        app.config['LIVE_HEARTBEAT'] = 15
+
+    def test_timeline_stream_replays_missed(self):
+        """ Does a reconnect get what was posted since its Last-Event-ID? """
+
+        seen = Message(text="already seen", user_id=self.testuser.id)
+        db.session.add(seen)
+        db.session.commit()
+        missed = Message(text="posted while away", user_id=self.testuser.id)
+        db.session.add(missed)
+        db.session.commit()
+        seen_id, missed_id = seen.id, missed.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with self.assertMaxQueries(3):
+                resp = c.get("/api/timeline/stream", buffered=False,
+                             headers={"Last-Event-ID": str(seen_id)})
+            events = iter(resp.response)
+
+            self.assertTrue(next(events).startswith(b"retry:"))
+            frame = next(events).decode()
+            self.assertIn(f"id: {missed_id}", frame)
+            self.assertIn('"text":"posted while away"', frame)
+            resp.close()
+
+            app.config['LIVE_QUEUE_SIZE'] = 1
+
+            try:
+                resp = c.get("/api/timeline/stream", buffered=False,
+                             headers={"Last-Event-ID": "0"})
+                events = iter(resp.response)
+                next(events)
+                self.assertTrue(next(events).startswith(b"event: reset"))
+                resp.close()
+            finally:
+                app.config['LIVE_QUEUE_SIZE'] = 100
+
+    def test_timeline_stream_overflow(self):
+        """ Is a stream that falls behind reset rather than blocking? """
+
+        app.config['LIVE_QUEUE_SIZE'] = 1
+
+        with app.app_context():
+            app.extensions.pop('live_hub', None)
+            app.extensions.pop('live_broker', None)
+
+            subscriber = live.subscribe({7})
+            events = live.stream(subscriber)
+            next(events)
+
+            live.hub.dispatch(7, {"messages": [{"id": 1}]})
+            live.hub.dispatch(7, {"messages": [{"id": 2}]})
+
+            self.assertTrue(subscriber.overflowed)
+            self.assertEqual(len(live.hub), 0)
+            self.assertIn("event: reset", next(events))
+
+            app.extensions.pop('live_hub')
+            app.extensions.pop('live_broker')
+
+        app.config['LIVE_QUEUE_SIZE'] = 100
+
+    def test_timeline_stream_logged_out(self):
+        """ Is the stream refused when logged out? """
+
+        with self.client as c:
+            with self.assertMaxQueries(0):
+                resp = c.get("/api/timeline/stream")
+
+            self.assertEqual(resp.status_code, 401)
+
+    def test_message_card_cache(self):
+        """ Are cards reused until the author's profile changes? """
+
+        m = Message(text="cached warble", user_id=self.testuser.id)
+        db.session.add(m)
+        db.session.commit()
+        uid = self.testuser.id
+
+        with self.client as c:
+            c.get(f"/users/{uid}")
+            cache = app.extensions['fragment_cache']
+            hits = cache.hits
+
+            with self.assertMaxQueries(3):
+                resp = c.get(f"/users/{uid}")
+
+            self.assertIn("cached warble", resp.get_data(as_text=True))
+            self.assertEqual(cache.hits, hits + 1)
+
+            # counters don't show on cards, so they keep the cache
+            counters.adjust(uid, likes=1)
+            db.session.commit()
+            hits = cache.hits
+
+            c.get(f"/users/{uid}")
+            self.assertEqual(cache.hits, hits + 1)
+
+            user = User.query.get(uid)
+            user.image_url = "/static/images/new-avatar.png"
+            counters.profile_changed(uid)
+            db.session.commit()
+
+            with self.assertMaxQueries(3):
+                resp = c.get(f"/users/{uid}")
+
+            self.assertIn('src="/static/images/new-avatar.png" alt="user image"',
+                          resp.get_data(as_text=True))
+
+    def _add_search_messages(self):
+        user2 = User.signup("test2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        texts = [(self.testuser.id, "the birds are singing"),
+                 (self.testuser.id, "song of the bird"),
+                 (user2.id, "bird song at dawn"),
+                 (user2.id, "nothing to see here")]
+        for user_id, text in texts:
+            db.session.add(Message(text=text, user_id=user_id))
+        db.session.commit()
+
+        # built on first use, differently per database; not the view's cost
+        with app.app_context():
+            message_search.backend
+
+    def test_search_messages(self):
+        """ Does message search match words, phrases and prefixes? """
+
+        self._add_search_messages()
+
+        with self.client as c:
+            with self.assertMaxQueries(2):
+                resp = c.get("/messages/search?q=bird")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("the birds are singing", html)
+            self.assertIn("song of the bird", html)
+            self.assertIn("bird song at dawn", html)
+            self.assertNotIn("nothing to see here", html)
+
+            with self.assertMaxQueries(2):
+                resp = c.get('/messages/search?q="bird song"')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("bird song at dawn", html)
+            self.assertNotIn("song of the bird", html)
+
+            with self.assertMaxQueries(2):
+                resp = c.get("/messages/search?q=sing*")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("the birds are singing", html)
+            self.assertNotIn("bird song at dawn", html)
+
+    def test_search_messages_api(self):
+        """ Does the search API filter by author and dedupe authors? """
+
+        self._add_search_messages()
+
+        with self.client as c:
+            with self.assertMaxQueries(2):
+                resp = c.get("/api/messages/search?q=bird&author=test2")
+            data = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m["text"] for m in data["messages"]],
+                             ["bird song at dawn"])
+            self.assertEqual([a["username"] for a in data["authors"].values()],
+                             ["test2"])
+            self.assertIsNone(data["next_cursor"])
+
+            with self.assertMaxQueries(0):
+                resp = c.get("/api/messages/search?q=")
+
+            self.assertEqual(resp.status_code, 400)
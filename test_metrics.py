@@ -0,0 +1,121 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from metrics import Histogram, render
+
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_ENABLED'] = False
+app.config['RESPONSE_CACHE_BACKEND'] = 'null'
+app.config['METRICS_TOKEN'] = 'scraper-token'
+
+AUTHORIZATION = {'Authorization': 'Bearer scraper-token'}
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Server-Timing headers and the /metrics page."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        self.user = User.signup(username="testuser",
+                                email="test@test.com",
+                                password="testuser",
+                                image_url=None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_histogram_render(self):
+        """Are buckets cumulative, with a sum and count per label set?"""
+
+        histogram = Histogram('t_seconds', "Test.", ('endpoint',),
+                              buckets=(0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        histogram.observe(5, 'a')
+        histogram.observe(1, 'b"')
+
+        text = render([histogram])
+
+        self.assertIn('# TYPE t_seconds histogram\n', text)
+        self.assertIn('t_seconds_bucket{endpoint="a",le="0.1"} 1\n', text)
+        self.assertIn('t_seconds_bucket{endpoint="a",le="1"} 2\n', text)
+        self.assertIn('t_seconds_bucket{endpoint="a",le="+Inf"} 3\n', text)
+        self.assertIn('t_seconds_sum{endpoint="a"} 5.55\n', text)
+        self.assertIn('t_seconds_count{endpoint="a"} 3\n', text)
+        self.assertIn('t_seconds_bucket{endpoint="b\\"",le="1"} 1\n', text)
+
+    def test_server_timing(self):
+        """Does a response say how many queries it took?"""
+
+        resp = self.client.get(f"/users/{self.user.id}")
+
+        self.assertEqual(resp.status_code, 200)
+        timing = resp.headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="[1-9]\d* queries", '
+                                 r'app;dur=[\d.]+$')
+
+    def test_metrics_page(self):
+        """Are requests counted by endpoint on /metrics?"""
+
+        self.client.get(f"/users/{self.user.id}")
+        resp = self.client.get("/metrics", headers=AUTHORIZATION)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+
+        text = resp.get_data(as_text=True)
+        self.assertRegex(text, r'warbler_request_duration_seconds_count'
+                               r'\{endpoint="users_show",method="GET",'
+                               r'status="200"\} [1-9]')
+        self.assertIn('warbler_request_sql_queries_bucket{endpoint='
+                      '"users_show",le="+Inf"}', text)
+        self.assertIn('# TYPE warbler_auth_attempts_total counter', text)
+        self.assertIn('warbler_live_streams ', text)
+
+    def test_metrics_page_needs_token(self):
+        """Is /metrics hidden from requests without the right token?"""
+
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        resp = self.client.get("/metrics",
+                               headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(resp.status_code, 404)
+
+        app.config['METRICS_TOKEN'] = None
+        try:
+            resp = self.client.get("/metrics", headers=AUTHORIZATION)
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            app.config['METRICS_TOKEN'] = 'scraper-token'
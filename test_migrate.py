@@ -0,0 +1,147 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrate.py
+
+
+from types import SimpleNamespace
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.pool import StaticPool
+
+import migrate
+
+
+class MigrateTestCase(TestCase):
+    """Run the migrations against a scratch database."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=StaticPool,
+                                    connect_args={'check_same_thread': False})
+
+    def test_discover(self):
+        """Are migrations found in version order?"""
+
+        versions = [m.version for m in migrate.discover()]
+
+        self.assertEqual(versions, sorted(versions))
+        self.assertEqual(versions[0], 1)
+
+    def test_upgrade(self):
+        """Does upgrade build the schema and record every version?"""
+
+        applied = migrate.upgrade(self.engine, echo=lambda msg: None)
+
+        self.assertEqual([m.version for m in applied],
+                         [m.version for m in migrate.discover()])
+        self.assertEqual(migrate.applied_versions(self.engine),
+                         {m.version for m in applied})
+
+        indexes = {i['name'] for i in inspect(self.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_timestamp', indexes)
+
+    def test_upgrade_twice(self):
+        """Is a second upgrade a no-op?"""
+
+        migrate.upgrade(self.engine, echo=lambda msg: None)
+
+        self.assertEqual(migrate.upgrade(self.engine, echo=lambda msg: None), [])
+
+    def test_upgrade_target(self):
+        """Does --target stop partway?"""
+
+        migrate.upgrade(self.engine, target=2, echo=lambda msg: None)
+
+        self.assertEqual(migrate.applied_versions(self.engine), {1, 2})
+        self.assertNotIn('messages_count', {
+            c['name'] for c in inspect(self.engine).get_columns('users')})
+
+    def test_likes_deduplicated(self):
+        """Are duplicate likes removed before the unique index is built?"""
+
+        migrate.upgrade(self.engine, target=3, echo=lambda msg: None)
+
+        with self.engine.begin() as conn:
+            conn.execute("INSERT INTO users (id, email, username, password)"
+                         " VALUES (1, 'e', 'u', 'p')")
+            conn.execute("INSERT INTO messages (id, text, timestamp, user_id)"
+                         " VALUES (1, 'hi', '2020-01-01', 1)")
+            conn.execute("INSERT INTO likes (user_id, message_id)"
+                         " VALUES (1, 1), (1, 1)")
+
+        migrate.upgrade(self.engine, echo=lambda msg: None)
+
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute("SELECT count(*) FROM likes").scalar(), 1)
+
+    def test_likes_count_after_dedupe(self):
+        """Is likes_count right once duplicate likes are removed?"""
+
+        migrate.upgrade(self.engine, target=2, echo=lambda msg: None)
+
+        with self.engine.begin() as conn:
+            conn.execute("INSERT INTO users (id, email, username, password)"
+                         " VALUES (1, 'e', 'u', 'p')")
+            conn.execute("INSERT INTO messages (id, text, timestamp, user_id)"
+                         " VALUES (1, 'hi', '2020-01-01', 1)")
+            conn.execute("INSERT INTO likes (user_id, message_id)"
+                         " VALUES (1, 1), (1, 1)")
+
+        migrate.upgrade(self.engine, echo=lambda msg: None)
+
+        with self.engine.connect() as conn:
+            self.assertEqual(conn.execute(
+                "SELECT likes_count FROM users WHERE id = 1").scalar(), 1)
+
+    def test_batched_delete(self):
+        """Does a batched delete reach rows in every batch?"""
+
+        with self.engine.connect() as conn:
+            conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, n INTEGER)")
+            for id in range(1, 11):
+                conn.execute(f"INSERT INTO t VALUES ({id}, {id % 2})")
+
+            migrate.MigrationContext(conn, None).batched_delete(
+                't', "n = 1", batch_size=3)
+
+            self.assertEqual([id for id, in conn.execute("SELECT id FROM t")],
+                             [2, 4, 6, 8, 10])
+
+
+class FakePostgresConnection:
+    """Records the statements a MigrationContext sends."""
+
+    dialect = SimpleNamespace(name='postgresql')
+
+    def __init__(self, in_transaction):
+        self._in_transaction = in_transaction
+        self.statements = []
+
+    def in_transaction(self):
+        return self._in_transaction
+
+    def execute(self, statement, **params):
+        self.statements.append(str(statement))
+
+
+class LockTimeoutTestCase(TestCase):
+    """lock_timeout mustn't outlive the migration on a pooled connection."""
+
+    def test_transactional(self):
+        """Is it SET LOCAL inside a transaction?"""
+
+        conn = FakePostgresConnection(in_transaction=True)
+        migrate.MigrationContext(conn, '5s').close()
+
+        self.assertEqual(conn.statements, ["SET LOCAL lock_timeout = '5s'"])
+
+    def test_autocommit(self):
+        """Is the session setting reset afterwards in autocommit mode?"""
+
+        conn = FakePostgresConnection(in_transaction=False)
+        migrate.MigrationContext(conn, '5s').close()
+
+        self.assertEqual(conn.statements, ["SET lock_timeout = '5s'",
+                                           "RESET lock_timeout"])
@@ -0,0 +1,208 @@
+"""Home timeline store tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, BuiltTimeline, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from timeline import (DBTimelineBackend, MemoryTimelineBackend, TimelineStore,
+                      fan_out_message, timelines)
+
+app.config['TESTING'] = True
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineStoreTestCase(TestCase):
+    """Test fan-out, backfill and pruning of home timelines."""
+
+    backend_cls = DBTimelineBackend
+
+    def setUp(self):
+        """Create two users where `reader` follows `author`."""
+
+        TimelineEntry.query.delete()
+        BuiltTimeline.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.extensions['timelines'] = self.backend_cls()
+        app.config['TIMELINE_MAX_LENGTH'] = 3
+
+        reader = User(username="reader", email="r@test.com", password="x")
+        author = User(username="author", email="a@test.com", password="x")
+        db.session.add_all([reader, author])
+        db.session.commit()
+
+        reader.following.append(author)
+        db.session.commit()
+
+        self.reader_id = reader.id
+        self.author_id = author.id
+
+    def tearDown(self):
+        db.session.rollback()
+        del app.extensions['timelines']
+        app.config['TIMELINE_MAX_LENGTH'] = 800
+        self.ctx.pop()
+
+    def post(self, text, user_id=None):
+        msg = Message(text=text, user_id=user_id or self.author_id)
+        db.session.add(msg)
+        db.session.flush()
+        timelines.add_message(msg)
+        db.session.commit()
+        return msg.id
+
+    def test_fan_out(self):
+        """Are new messages pushed to followers and the author?"""
+
+        first = self.post("first")
+        second = self.post("second")
+
+        self.assertEqual(timelines.message_ids(self.reader_id, 10),
+                         [second, first])
+        self.assertEqual(timelines.message_ids(self.author_id, 10),
+                         [second, first])
+
+    def test_cap(self):
+        """Are timelines trimmed to TIMELINE_MAX_LENGTH?"""
+
+        ids = [self.post(f"msg {i}") for i in range(5)]
+
+        self.assertEqual(timelines.message_ids(self.reader_id, 10),
+                         ids[:-4:-1])
+
+    def test_unfollow_prunes(self):
+        """Are an author's messages removed when they're unfollowed?"""
+
+        self.post("hello")
+        timelines.unfollow(self.reader_id, self.author_id)
+        Follows.query.delete()
+        db.session.commit()
+
+        own = self.post("mine", user_id=self.reader_id)
+
+        self.assertEqual(timelines.message_ids(self.reader_id, 10), [own])
+
+    def test_follow_backfills(self):
+        """Are existing messages added when a user is followed?"""
+
+        other = User(username="other", email="o@test.com", password="x")
+        db.session.add(other)
+        db.session.commit()
+
+        older = self.post("older", user_id=other.id)
+        newer = self.post("newer")
+
+        timelines.follow(self.reader_id, other.id)
+        db.session.commit()
+
+        self.assertEqual(timelines.message_ids(self.reader_id, 10),
+                         [newer, older])
+
+    def test_remove_message(self):
+        """Are deleted messages taken off timelines?"""
+
+        kept = self.post("kept")
+        gone = self.post("gone")
+
+        timelines.remove_message(Message.query.get(gone))
+        db.session.commit()
+
+        self.assertEqual(timelines.message_ids(self.reader_id, 10), [kept])
+
+    def test_build(self):
+        """Is a timeline that was never built built from the messages table?"""
+
+        msg = Message(text="seeded", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertTrue(timelines.build(self.reader_id))
+        self.assertEqual(timelines.message_ids(self.reader_id, 10), [msg.id])
+
+    def test_build_once(self):
+        """Is an empty timeline built once, not on every read?"""
+
+        self.assertTrue(timelines.build(self.author_id))
+        db.session.commit()
+
+        self.assertFalse(timelines.build(self.author_id))
+        self.assertEqual(timelines.message_ids(self.author_id, 10), [])
+
+    def test_build_after_partial_fan_out(self):
+        """Does an unbuilt timeline that got fan-out still get built?"""
+
+        old = Message(text="seeded", user_id=self.author_id)
+        db.session.add(old)
+        db.session.commit()
+
+        new = self.post("new")
+
+        self.assertTrue(timelines.build(self.reader_id))
+        self.assertEqual(timelines.message_ids(self.reader_id, 10),
+                         [new, old.id])
+
+    def test_fan_out_message_bumps_version(self):
+        """Do followers' home ETags change once the fan-out job has run?"""
+
+        msg = Message(text="new", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        before = User.query.get(self.author_id).version
+
+        fan_out_message(msg.id)
+        db.session.commit()
+
+        self.assertGreater(User.query.get(self.author_id).version, before)
+        self.assertEqual(timelines.message_ids(self.reader_id, 10), [msg.id])
+
+
+class MemoryTimelineStoreTestCase(TimelineStoreTestCase):
+    """Run the same tests against the in-process backend."""
+
+    backend_cls = MemoryTimelineBackend
+
+
+class TimelineConfigTestCase(TestCase):
+    """Check the backend fits how jobs are run."""
+
+    def test_memory_needs_inline_jobs(self):
+        """Is the memory backend refused when a worker runs fan-outs?"""
+
+        other = Flask(__name__)
+        other.config['TIMELINE_BACKEND'] = 'memory'
+        other.config['JOBS_INLINE'] = False
+
+        with self.assertRaises(ValueError):
+            TimelineStore().init_app(other)
+
+        other.config['JOBS_INLINE'] = True
+        TimelineStore().init_app(other)
@@ -21,6 +21,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from counters import recount
+from passwords import hash_cost, passwords
+import follow_graph
 
 app.config['TESTING'] = True
 
@@ -102,6 +105,51 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(self.user1.is_followed_by(self.user2), False)
     
+    def test_following_among(self):
+        """Does the follow graph answer a batch of users in one go?"""
+
+        test_user_3 = User.signup("testuser3", "test3@test.com",
+                                  "HASHED_PASSWORD", "random_url")
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        ids = [self.user2.id, test_user_3.id]
+
+        with app.test_request_context():
+            self.assertEqual(follow_graph.following_among(self.user1.id, ids),
+                             {self.user2.id})
+            self.assertTrue(follow_graph.is_following(self.user1.id,
+                                                      self.user2.id))
+            self.assertFalse(follow_graph.is_following(self.user2.id,
+                                                       self.user1.id))
+
+    def test_counters_start_at_zero(self):
+        """Do new users start with zeroed counters?"""
+
+        self.assertEqual(self.user1.messages_count, 0)
+        self.assertEqual(self.user1.following_count, 0)
+        self.assertEqual(self.user1.followers_count, 0)
+        self.assertEqual(self.user1.likes_count, 0)
+
+    def test_recount(self):
+        """Does recount repair counters that have drifted?"""
+
+        self.user1.following.append(self.user2)
+        db.session.add(Message(text="hi", user_id=self.user1.id))
+        self.user2.likes_count = 7
+        db.session.commit()
+
+        self.assertEqual(recount(), 2)
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user1.messages_count, 1)
+        self.assertEqual(self.user2.followers_count, 1)
+        self.assertEqual(self.user2.likes_count, 0)
+
+        # nothing left to fix
+        self.assertEqual(recount(), 0)
+
     def test_signup(self):
         """Does User.create successfully create a new user given valid credentials?"""
 
@@ -141,3 +189,23 @@ class UserModelTestCase(TestCase):
         """Does User.authenticate fail to return a user when the password is invalid?"""
 
         self.assertEqual(User.authenticate(self.user1.username, "WRONG_PASSWORD"), False)
+
+    def test_rehash_on_login(self):
+        """Is a hash made at an outdated cost replaced on a good login?"""
+
+        rounds = passwords.rounds
+        passwords.rounds = 4
+
+        try:
+            self.user1.password = passwords.hash("HASHED_PASSWORD")
+            passwords.rounds = 5
+
+            self.assertEqual(hash_cost(self.user1.password), 4)
+            self.assertFalse(self.user1.check_password("WRONG_PASSWORD"))
+            self.assertEqual(hash_cost(self.user1.password), 4)
+
+            self.assertTrue(self.user1.check_password("HASHED_PASSWORD"))
+            self.assertEqual(hash_cost(self.user1.password), 5)
+            self.assertTrue(self.user1.check_password("HASHED_PASSWORD"))
+        finally:
+            passwords.rounds = rounds
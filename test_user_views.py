@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes
+from models import db, connect_db, Message, User, Likes, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +20,13 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from flask import session
+
+from app import app, message_form, CURR_USER_KEY
+from passwords import passwords
+from query_budget import QueryBudgetMixin
+from response_cache import FakeRedis, RedisBackend, response_cache
+from throttle import MemoryStore
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -34,8 +40,18 @@ app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
+# Caches and throttles would outlive each test's data
+
+app.config['RESPONSE_CACHE_BACKEND'] = 'null'
+app.config['IDENTITY_CACHE_TTL'] = 0
+app.config['THROTTLE_BACKEND'] = 'null'
+
+# Run background jobs as soon as each request commits them
 
-class UserViewTestCase(TestCase):
+app.config['JOBS_INLINE'] = True
+
+
+class UserViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for users."""
 
     def setUp(self):
@@ -75,7 +91,8 @@ class UserViewTestCase(TestCase):
 
         with self.client as c:
 
-            resp = c.get(f'/users/{self.uid1}')
+            with self.assertMaxQueries(1):
+                resp = c.get(f'/users/{self.uid1}')
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -83,12 +100,315 @@ class UserViewTestCase(TestCase):
             self.assertIn('fa fa-map-marker', html)
 
 
+    def test_users_show_etag(self):
+        """Is an unchanged profile answered with 304 until it changes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            resp = c.get(f'/users/{self.uid1}')
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            with self.assertMaxQueries(3):
+                resp = c.get(f'/users/{self.uid1}',
+                             headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            # user2 liking user1's message changes the page for both
+            m = Message(text="likeable", user_id=self.uid1)
+            db.session.add(m)
+            db.session.commit()
+            c.post(f'/api/messages/{m.id}/like')
+
+            with self.assertMaxQueries(7):
+                resp = c.get(f'/users/{self.uid1}',
+                             headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('likeable', resp.get_data(as_text=True))
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_homepage_etag(self):
+        """Does a followed user's new message invalidate the homepage?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            c.post(f"/users/follow/{self.uid2}")
+
+            etag = c.get('/').headers['ETag']
+            with self.assertMaxQueries(3):
+                resp = c.get('/', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            c.post('/messages/new', data={'text': 'fresh warble'})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            with self.assertMaxQueries(8):
+                resp = c.get('/', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('fresh warble', resp.get_data(as_text=True))
+
+    def test_anonymous_response_cache(self):
+        """Are logged-out profile views cached until the user changes?"""
+
+        backend = RedisBackend(FakeRedis())
+        app.extensions['response_cache'] = backend
+
+        try:
+            with self.client as c:
+                with self.assertMaxQueries(1):
+                    resp = c.get(f'/users/{self.uid1}')
+                self.assertEqual(resp.headers['X-Cache'], 'MISS')
+
+                with self.assertMaxQueries(0):
+                    resp = c.get(f'/users/{self.uid1}')
+                self.assertEqual(resp.headers['X-Cache'], 'HIT')
+                self.assertIn('@user1', resp.get_data(as_text=True))
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.uid1
+
+                c.post('/messages/new', data={'text': 'brand new warble'})
+
+                with c.session_transaction() as sess:
+                    del sess[CURR_USER_KEY]
+
+                resp = c.get(f'/users/{self.uid1}')
+                self.assertEqual(resp.headers['X-Cache'], 'MISS')
+                self.assertIn('brand new warble', resp.get_data(as_text=True))
+        finally:
+            del app.extensions['response_cache']
+
+    def test_anonymous_response_cache_shares_no_token(self):
+        """Do different logged-out visitors get the same, token-free page?"""
+
+        app.extensions['response_cache'] = RedisBackend(FakeRedis())
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            first = app.test_client().get(f'/users/{self.uid1}')
+            second = app.test_client().get(f'/users/{self.uid1}')
+
+            self.assertEqual(first.headers['X-Cache'], 'MISS')
+            self.assertEqual(second.headers['X-Cache'], 'HIT')
+            self.assertEqual(first.get_data(), second.get_data())
+            self.assertNotIn('csrf_token', second.get_data(as_text=True))
+            self.assertNotIn('Set-Cookie', first.headers)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+            del app.extensions['response_cache']
+
+    def test_response_cache_skips_csrf_token(self):
+        """Is a page that rendered a CSRF token never stored?"""
+
+        backend = RedisBackend(FakeRedis())
+        app.extensions['response_cache'] = backend
+        app.config['WTF_CSRF_ENABLED'] = True
+
+        try:
+            with app.test_request_context('/'):
+                # a returning visitor: the session already has its secret
+                session['csrf_token'] = 'secret'
+                session.modified = False
+
+                def view():
+                    return str(message_form().csrf_token)
+
+                response = response_cache.serve(view, [], (), {})
+                self.assertFalse(session.modified)
+
+            self.assertIn('csrf_token', response.get_data(as_text=True))
+            self.assertIsNone(backend.get('page:/?'))
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+            del app.extensions['response_cache']
+
+    def test_identity_cache_forgets_edits(self):
+        """Is a cached current user dropped when they edit their profile?"""
+
+        app.config['IDENTITY_CACHE_TTL'] = 60
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.uid1
+
+                c.get('/')
+
+                with self.assertMaxQueries(4):
+                    resp = c.post('/users/profile',
+                                  data={'username': 'user1',
+                                        'email': 'test1@test.com',
+                                        'bio': 'a brand new bio',
+                                        'password': 'password'})
+                self.assertEqual(resp.status_code, 302)
+
+                with self.assertMaxQueries(3):
+                    resp = c.get(f'/users/{self.uid1}')
+                self.assertIn('a brand new bio', resp.get_data(as_text=True))
+        finally:
+            app.config['IDENTITY_CACHE_TTL'] = 0
+            app.extensions.pop('identity_cache', None)
+
+    def test_identity_cache_skips_password(self):
+        """Is the password hash read fresh, not from the identity cache?"""
+
+        app.config['IDENTITY_CACHE_TTL'] = 60
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.uid1
+
+                c.get('/')
+                cached = app.extensions['identity_cache'].get(self.uid1)
+                self.assertNotIn('password', cached)
+
+                # e.g. rehashed at login, which doesn't touch the cache
+                User.query.get(self.uid1).password = passwords.hash('rehashed')
+                db.session.commit()
+
+                resp = c.post('/users/profile',
+                              data={'username': 'user1',
+                                    'email': 'test1@test.com',
+                                    'password': 'rehashed'})
+                self.assertEqual(resp.location,
+                                 f'http://localhost/users/{self.uid1}')
+        finally:
+            app.config['IDENTITY_CACHE_TTL'] = 0
+            app.extensions.pop('identity_cache', None)
+
+    def test_users_show_pagination(self):
+        """Are profile messages split into pages with an 'Older' link?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 3
+        messages = [Message(text=f"warble {i}", user_id=self.uid1)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            with self.assertMaxQueries(7):
+                resp = c.get(f'/users/{self.uid1}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count('warble '), 3)
+            self.assertIn('warble 4', html)
+            self.assertIn('?before=', html)
+
+            older = html.split('?before=')[1].split('"')[0]
+            with self.assertMaxQueries(7):
+                resp = c.get(f'/users/{self.uid1}?before={older}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('warble '), 2)
+            self.assertIn('warble 0', html)
+            self.assertNotIn('?before=', html)
+
+        app.config['MESSAGES_PER_PAGE'] = 20
+
+    def test_api_user_messages(self):
+        """Does the messages API page with a cursor and list authors once?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 3
+        messages = [Message(text=f"warble {i}", user_id=self.uid1)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with self.client as c:
+            with self.assertMaxQueries(3):
+                data = c.get(f'/api/users/{self.uid1}/messages').get_json()
+
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ['warble 4', 'warble 3', 'warble 2'])
+            self.assertEqual(list(data['authors']), [str(self.uid1)])
+            self.assertEqual(data['authors'][str(self.uid1)]['username'],
+                             'user1')
+
+            with self.assertMaxQueries(3):
+                data = c.get(f'/api/users/{self.uid1}/messages',
+                             query_string={'before': data['next_cursor']}
+                             ).get_json()
+
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ['warble 1', 'warble 0'])
+            self.assertIsNone(data['next_cursor'])
+
+        app.config['MESSAGES_PER_PAGE'] = 20
+
+    def test_api_timeline_and_follows(self):
+        """Do the timeline and follow-list APIs answer logged-in users?"""
+
+        with self.client as c:
+            self.assertEqual(c.get('/api/timeline').status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            c.post(f"/users/follow/{self.uid2}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            c.post('/messages/new', data={'text': 'followed warble'})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            with self.assertMaxQueries(12):
+                data = c.get('/api/timeline').get_json()
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ['followed warble'])
+
+            with self.assertMaxQueries(3):
+                data = c.get(f'/api/users/{self.uid2}/followers').get_json()
+            self.assertEqual([u['username'] for u in data['users']], ['user1'])
+
+            with self.assertMaxQueries(2):
+                data = c.get(f'/api/users/{self.uid1}/following').get_json()
+            self.assertEqual([u['username'] for u in data['users']], ['user2'])
+
+            self.assertEqual(c.get('/api/users/9999/following').status_code,
+                             404)
+
+    def test_users_show_bad_cursor(self):
+        """Is a tampered-with cursor rejected?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            with self.assertMaxQueries(3):
+                resp = c.get(f'/users/{self.uid1}?before=not-a-cursor')
+
+            self.assertEqual(resp.status_code, 400)
+
     def test_invalid_user_profile(self):
         """test invalid user profile page"""
 
         with self.client as c:
 
-            resp = c.get(f"/users/9999")
+            with self.assertMaxQueries(1):
+                resp = c.get(f"/users/9999")
 
             self.assertEqual(resp.status_code, 404)
 
@@ -100,7 +420,8 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.uid1
 
-            resp = c.get(f"/")
+            with self.assertMaxQueries(10):
+                resp = c.get(f"/")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -111,7 +432,8 @@ class UserViewTestCase(TestCase):
 
         with self.client as c:
 
-            resp = c.get(f"/")
+            with self.assertMaxQueries(0):
+                resp = c.get(f"/")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -121,7 +443,8 @@ class UserViewTestCase(TestCase):
         """Test if all the users show up on the /users"""
         with self.client as c:
 
-            resp = c.get(f"/users")
+            with self.assertMaxQueries(2):
+                resp = c.get(f"/users")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -133,12 +456,57 @@ class UserViewTestCase(TestCase):
 
         with self.client as c:  
 
-            resp = c.get(f"/users?q=user1")
+            with self.assertMaxQueries(3):
+                resp = c.get(f"/users?q=user1")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn('@user1', html)
 
+    def test_user_search_ranking(self):
+        """Are exact and prefix matches ranked first, by bio too?"""
+
+        user3 = User.signup("user1fan", "test3@test.com", "password", None)
+        user4 = User.signup("birdwatcher", "test4@test.com", "password", None)
+        user4.bio = "I love user1"
+        db.session.commit()
+
+        with self.client as c:
+
+            with self.assertMaxQueries(3):
+                resp = c.get("/users?q=user1")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertLess(html.index('@user1<'), html.index('@user1fan'))
+            self.assertIn('@birdwatcher', html)
+
+            with self.assertMaxQueries(2):
+                resp = c.get("/users?q=zzzz")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('Sorry, no users found', html)
+
+    def test_users_list_pagination(self):
+        """Is /users paged, with a 'More' link to the rest?"""
+
+        with self.client as c:
+
+            with self.assertMaxQueries(2):
+                resp = c.get("/users?per_page=1")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('@user1', html)
+            self.assertNotIn('@user2', html)
+
+            after = html.split('after=')[1].split('"')[0]
+            with self.assertMaxQueries(2):
+                resp = c.get(f"/users?per_page=1&after={after}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('@user2', html)
+            self.assertNotIn('@user1', html)
+
     ##test for searching user that does not exist
 
     def test_user_follow(self):
@@ -150,17 +518,64 @@ class UserViewTestCase(TestCase):
                 sess[CURR_USER_KEY] = self.uid1
 
             ##user 1 follows user 2
-            resp = c.post(f"/users/follow/{self.uid2}", follow_redirects=True)
+            with self.assertMaxQueries(14):
+                resp = c.post(f"/users/follow/{self.uid2}", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             ##check if user 2 is followed by user 1
-            resp = c.get(f"/users/{self.uid1}/followers")
+            with self.assertMaxQueries(4):
+                resp = c.get(f"/users/{self.uid1}/followers")
             html_user2 = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn('@user2', html)
             self.assertIn('@user1',html_user2)
 
+    def test_show_following(self):
+        """Does the following page list who a user follows?"""
+
+        user1 = User.query.get(self.uid1)
+        user1.following.append(User.query.get(self.uid2))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            with self.assertMaxQueries(6):
+                resp = c.get(f"/users/{self.uid1}/following")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('@user2', html)
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+            with self.assertMaxQueries(0):
+                resp = c.get(f"/users/{self.uid1}/following")
+
+            self.assertEqual(resp.status_code, 302)
+
+    def test_follow_counters(self):
+        """Do follow and unfollow keep both users' counters in step?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            with self.assertMaxQueries(9):
+                c.post(f"/users/follow/{self.uid2}")
+
+            self.assertEqual(User.query.get(self.uid1).following_count, 1)
+            self.assertEqual(User.query.get(self.uid2).followers_count, 1)
+
+            with self.assertMaxQueries(8):
+                c.post(f"/users/stop-following/{self.uid2}")
+
+            self.assertEqual(User.query.get(self.uid1).following_count, 0)
+            self.assertEqual(User.query.get(self.uid2).followers_count, 0)
+
     def test_user_unfollow(self):
         """Check if user 1 unfollows user2, user1 does not exist in the following list of user 2. """
 
@@ -176,11 +591,13 @@ class UserViewTestCase(TestCase):
             db.session.commit()
 
             #user 1 unfollows user2, user 2 does not existi in user 1 following list.
-            resp = c.post(f"/users/stop-following/{self.uid2}", follow_redirects=True)
+            with self.assertMaxQueries(12):
+                resp = c.post(f"/users/stop-following/{self.uid2}", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             #checking if user 1 does not exist in user 2 follower list.
-            resp = c.get(f"/users/{self.uid2}/followers")
+            with self.assertMaxQueries(6):
+                resp = c.get(f"/users/{self.uid2}/followers")
             html_user2 = resp.get_data(as_text=True)
             
             self.assertEqual(resp.status_code, 200)
@@ -193,7 +610,8 @@ class UserViewTestCase(TestCase):
 
         with self.client as c:  
 
-            resp = c.post(f"/users/follow/{self.uid2}", follow_redirects=True)
+            with self.assertMaxQueries(0):
+                resp = c.post(f"/users/follow/{self.uid2}", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -210,7 +628,8 @@ class UserViewTestCase(TestCase):
 
             self.setup_messages_and_likes()
 
-            resp = c.get(f"/users/{self.uid1}/likes", follow_redirects=True)
+            with self.assertMaxQueries(4):
+                resp = c.get(f"/users/{self.uid1}/likes", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -228,7 +647,8 @@ class UserViewTestCase(TestCase):
 
             #user 2 likes the message of user1    
 
-            resp = c.post(f"/messages/{self.m1_id}/like", follow_redirects=True)
+            with self.assertMaxQueries(12):
+                resp = c.post(f"/messages/{self.m1_id}/like", follow_redirects=True)
             html = resp.get_data(as_text=True) 
 
             self.assertEqual(resp.status_code, 200)
@@ -243,18 +663,83 @@ class UserViewTestCase(TestCase):
             
             self.setup_messages_and_likes()
 
-            resp = c.post(f"/messages/{self.m2_id}/like", follow_redirects=True)
+            with self.assertMaxQueries(20):
+                resp = c.post(f"/messages/{self.m2_id}/like", follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('user2 message', html)
 
+    def test_signup(self):
+        """Does signing up create the user and log them in?"""
+
+        with self.client as c:
+
+            with self.assertMaxQueries(2):
+                resp = c.post("/signup", data={"username": "user3",
+                                               "email": "test3@test.com",
+                                               "password": "password"})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "http://localhost/")
+
+            user = User.query.filter_by(username="user3").one()
+            with c.session_transaction() as sess:
+                self.assertEqual(sess[CURR_USER_KEY], user.id)
+
+    def test_signup_taken(self):
+        """Is a taken username turned away without creating anyone?"""
+
+        with self.client as c:
+
+            with self.assertMaxQueries(1):
+                resp = c.post("/signup", data={"username": "user1",
+                                               "email": "new@test.com",
+                                               "password": "password"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Username already taken", resp.get_data(as_text=True))
+            self.assertEqual(User.query.count(), 2)
+
+    def test_delete_user(self):
+        """Does deleting your account remove it and log you out?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            self.setup_messages_and_likes()
+            user2 = User.query.get(self.uid2)
+            user2.following.append(User.query.get(self.uid1))
+            user2.following_count = 1
+            db.session.add(Likes(user_id=self.uid2, message_id=self.m1_id))
+            user2.likes_count = 1
+            db.session.commit()
+
+            with self.assertMaxQueries(7):
+                resp = c.post("/users/delete")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, "http://localhost/signup")
+            self.assertIsNone(User.query.get(self.uid1))
+            self.assertIsNone(Message.query.get(self.m1_id))
+            self.assertEqual(Likes.query.filter_by(user_id=self.uid1).count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+
+            user2 = User.query.get(self.uid2)
+            self.assertEqual(user2.following_count, 0)
+            self.assertEqual(user2.likes_count, 0)
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
     def test_log_in(self):
         """check if user can log in with the right password and username"""
 
         with self.client as c:
 
-            resp = c.post("/login", data = {"username":"user1", "password":"password" }, follow_redirects=True)
+            with self.assertMaxQueries(11):
+                resp = c.post("/login", data = {"username":"user1", "password":"password" }, follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -263,6 +748,61 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 self.assertEqual(sess.get("CURR_USER_KEY"), self.uid1)
 
+    def test_login_throttled(self):
+        """Are repeated guesses at one username turned away with a 429?"""
+
+        store = MemoryStore()
+        app.extensions['throttle'] = store
+        app.config['THROTTLE_USERNAME_BURST'] = 2
+
+        try:
+            with self.client as c:
+                for _ in range(2):
+                    resp = c.post("/login", data={"username": "user1",
+                                                  "password": "wrong!!"})
+                    self.assertEqual(resp.status_code, 200)
+
+                with self.assertMaxQueries(0):
+                    resp = c.post("/login", data={"username": "user1",
+                                                  "password": "password"})
+
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn('Retry-After', resp.headers)
+                self.assertIn('Too many attempts', resp.get_data(as_text=True))
+
+                # other usernames from the same IP aren't affected
+                resp = c.post("/login", data={"username": "user2",
+                                              "password": "password"})
+
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(store.metrics(), {'login_allowed': 3,
+                                                   'login_throttled': 1})
+        finally:
+            app.config['THROTTLE_USERNAME_BURST'] = 5
+            del app.extensions['throttle']
+
+    def test_login_throttled_per_client(self):
+        """Are clients behind the proxy throttled by their own address?"""
+
+        app.extensions['throttle'] = MemoryStore()
+        app.config['THROTTLE_IP_BURST'] = 1
+
+        try:
+            def log_in(client_ip, username):
+                return self.client.post(
+                    "/login", data={"username": username,
+                                    "password": "wrong!!"},
+                    headers={'X-Forwarded-For': client_ip})
+
+            self.assertEqual(log_in('203.0.113.1', 'user1').status_code, 200)
+            self.assertEqual(log_in('203.0.113.1', 'user2').status_code, 429)
+
+            # same proxy, another client
+            self.assertEqual(log_in('203.0.113.2', 'user2').status_code, 200)
+        finally:
+            app.config['THROTTLE_IP_BURST'] = 20
+            del app.extensions['throttle']
+
     def test_log_out(self):
         """check if user can logout"""
 
@@ -270,7 +810,8 @@ class UserViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.uid1
 
-            resp = c.get("/logout", follow_redirects=True)
+            with self.assertMaxQueries(1):
+                resp = c.get("/logout", follow_redirects=True)
 
             self.assertEqual(resp.status_code, 200)
 
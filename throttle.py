@@ -0,0 +1,267 @@
+"""Token-bucket throttling for login and signup.
+
+Every login or signup attempt costs a full bcrypt hash (see passwords.py),
+even for a username that doesn't exist. Attempts are checked here first,
+and turned away before any hashing if they'd overdraw one of:
+
+- the client IP's bucket (THROTTLE_IP_BURST, refilled at
+  THROTTLE_IP_RATE tokens a second). Behind a reverse proxy the client
+  IP comes from X-Forwarded-For, trusting TRUSTED_PROXIES hops (see
+  app.py); otherwise every client would share the proxy's bucket;
+- the username's bucket (THROTTLE_USERNAME_BURST / THROTTLE_USERNAME_RATE);
+- the machine's bucket, sized from what bcrypt costs: THROTTLE_CPU_SHARE
+  of the host's cores divided by the measured seconds per hash, so a
+  burst can't use more than that share of the CPU however many IPs it
+  comes from. Until a hash has been timed, this bucket doesn't apply.
+
+An attempt takes a token from each bucket or from none of them, so being
+throttled on one bucket doesn't drain the others.
+
+Buckets (and the allowed / throttled counts in `metrics()`) have to be
+shared by every worker process, so by default they live in a small SQLite
+database at THROTTLE_SQLITE_PATH. THROTTLE_BACKEND can instead be
+'memory' (one process only) or 'null' (no throttling).
+"""
+
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from threading import Lock, local
+
+from flask import current_app, request
+
+from passwords import passwords
+
+# seconds of machine-wide hashing capacity a burst may use up front
+CPU_BURST_SECONDS = 2
+
+# chance per attempt of clearing out buckets idle long enough to be full
+PRUNE_CHANCE = 0.001
+
+
+def refill(state, burst, rate, now):
+    """Tokens in a bucket at `now`, given its (tokens, updated) `state`."""
+
+    if state is None:
+        return burst
+
+    tokens, updated = state
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def _take(states, buckets, now):
+    """Try to take a token from every bucket.
+
+    `states` maps bucket keys to their stored (tokens, updated).
+    Returns (new states to store or None if refused, seconds to wait).
+    """
+
+    updated = {}
+    wait = 0.0
+
+    for key, burst, rate in buckets:
+        tokens = refill(states.get(key), burst, rate, now)
+
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+
+        updated[key] = (tokens - 1, now)
+
+    if wait:
+        return None, wait
+
+    return updated, 0.0
+
+
+def _metric(action, allowed):
+    return f'{action}_{"allowed" if allowed else "throttled"}'
+
+
+class NullStore:
+    """Allows everything and counts nothing."""
+
+    def take(self, buckets, action, now):
+        return 0.0
+
+    def metrics(self):
+        return {}
+
+
+class MemoryStore:
+    """Buckets in this process only."""
+
+    def __init__(self):
+        self._states = {}
+        self._counts = {}
+        self._lock = Lock()
+
+    def take(self, buckets, action, now):
+        with self._lock:
+            updated, wait = _take(self._states, buckets, now)
+
+            if updated:
+                self._states.update(updated)
+
+            name = _metric(action, not wait)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+        return wait
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class SqliteStore:
+    """Buckets in a SQLite file shared by the processes on this machine."""
+
+    SCHEMA = [
+        """
+        CREATE TABLE IF NOT EXISTS throttle_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS throttle_counts (
+            name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        )
+        """,
+    ]
+
+    def __init__(self, path, idle_after=3600):
+        self.path = path
+        self.idle_after = idle_after
+        self._local = local()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+
+        return conn
+
+    def take(self, buckets, action, now):
+        conn = self.connection
+        keys = [key for key, _, _ in buckets]
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            marks = ', '.join('?' * len(keys))
+            states = {key: (tokens, updated) for key, tokens, updated in
+                      conn.execute(f"SELECT key, tokens, updated "
+                                   f"FROM throttle_buckets "
+                                   f"WHERE key IN ({marks})", keys)}
+
+            updated, wait = _take(states, buckets, now)
+
+            if updated:
+                conn.executemany("""
+                    INSERT INTO throttle_buckets (key, tokens, updated)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE
+                    SET tokens = excluded.tokens, updated = excluded.updated
+                """, [(key, tokens, at)
+                      for key, (tokens, at) in updated.items()])
+
+            conn.execute("""
+                INSERT INTO throttle_counts (name, count) VALUES (?, 1)
+                ON CONFLICT (name) DO UPDATE SET count = count + 1
+            """, (_metric(action, not wait),))
+
+            if random.random() < PRUNE_CHANCE:
+                conn.execute("DELETE FROM throttle_buckets WHERE updated < ?",
+                             (now - self.idle_after,))
+
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def metrics(self):
+        return dict(self.connection.execute(
+            "SELECT name, count FROM throttle_counts"))
+
+
+BACKENDS = {
+    'sqlite': lambda app: SqliteStore(app.config['THROTTLE_SQLITE_PATH']),
+    'memory': lambda app: MemoryStore(),
+    'null': lambda app: NullStore(),
+}
+
+
+class Throttle:
+    """Rate-limit expensive authentication attempts."""
+
+    def init_app(self, app):
+        app.config.setdefault('THROTTLE_BACKEND', 'sqlite')
+        app.config.setdefault('THROTTLE_SQLITE_PATH', os.path.join(
+            tempfile.gettempdir(), 'warbler-throttle.sqlite3'))
+        app.config.setdefault('THROTTLE_IP_BURST', 20)
+        app.config.setdefault('THROTTLE_IP_RATE', 0.2)
+        app.config.setdefault('THROTTLE_USERNAME_BURST', 5)
+        app.config.setdefault('THROTTLE_USERNAME_RATE', 1 / 60)
+        app.config.setdefault('THROTTLE_CPU_SHARE', 0.5)
+
+    @property
+    def store(self):
+        app = current_app._get_current_object()
+
+        if 'throttle' not in app.extensions:
+            kind = app.config['THROTTLE_BACKEND']
+            app.extensions['throttle'] = BACKENDS[kind](app)
+
+        return app.extensions['throttle']
+
+    def _buckets(self, action, ip, username):
+        config = current_app.config
+
+        buckets = [
+            (f'{action}:ip:{ip}',
+             config['THROTTLE_IP_BURST'], config['THROTTLE_IP_RATE']),
+            (f'{action}:user:{username.lower()}',
+             config['THROTTLE_USERNAME_BURST'],
+             config['THROTTLE_USERNAME_RATE']),
+        ]
+
+        if passwords.hash_seconds:
+            cores = (os.cpu_count() or 1) * config['THROTTLE_CPU_SHARE']
+            rate = cores / passwords.hash_seconds
+            buckets.append(('cpu', max(1, rate * CPU_BURST_SECONDS), rate))
+
+        return buckets
+
+    def attempt(self, action, username):
+        """Record an attempt at `action` ('login', 'signup') by this client.
+
+        Returns 0 if it may go ahead, otherwise the number of seconds to
+        wait before trying again.
+        """
+
+        buckets = self._buckets(action, request.remote_addr, username or '')
+        wait = self.store.take(buckets, action, time.time())
+
+        return int(wait) + 1 if wait else 0
+
+    def metrics(self):
+        """Allowed and throttled attempts so far, by action."""
+
+        return self.store.metrics()
+
+
+throttle = Throttle()
@@ -0,0 +1,378 @@
+"""Precomputed home timelines for Warbler.
+
+Rather than building each user's home feed when it is read, new messages
+are pushed ("fanned out") onto the timeline of every follower when they
+are written. Reading the homepage is then one ordered list of message ids
+followed by a primary-key fetch.
+
+Each timeline is capped at TIMELINE_MAX_LENGTH entries. Following,
+unfollowing and deleting messages backfill or prune the affected entries.
+A timeline is built from the messages table on its first read (`build`)
+and marked as built, so one that is simply empty isn't rebuilt again.
+
+Fanning out a new message can mean thousands of rows, so `messages_add`
+leaves it to the 'timeline.fan_out' background job (see jobs.py).
+"""
+
+from collections import defaultdict
+from datetime import datetime
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import func, literal, or_, select, tuple_
+
+import counters
+from jobs import jobs
+from models import db, BuiltTimeline, Follows, Message, TimelineEntry
+from pagination import older_than
+
+
+def latest_entries(user_id, limit):
+    """Build timeline entries for `user_id` from the messages table.
+
+    Returns up to `limit` (timestamp, message_id, author_id) tuples for the
+    user's own messages and those of everyone they follow, newest first.
+    """
+
+    following_ids = (db.session
+                     .query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == user_id))
+
+    rows = (db.session
+            .query(Message.timestamp, Message.id, Message.user_id)
+            .filter(or_(Message.user_id == user_id,
+                        Message.user_id.in_(following_ids.subquery())))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit)
+            .all())
+
+    return [tuple(row) for row in rows]
+
+
+class DBTimelineBackend:
+    """Timelines stored in the `timeline_entries` table.
+
+    Writes join the caller's transaction; nothing here commits.
+    """
+
+    table = TimelineEntry.__table__
+
+    def fan_out(self, message, cap):
+        """Push `message` onto its author's and all followers' timelines."""
+
+        followers = select([
+            Follows.user_following_id,
+            literal(message.id),
+            literal(message.user_id),
+            literal(message.timestamp, db.DateTime),
+        ]).where(Follows.user_being_followed_id == message.user_id)
+
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+        db.session.execute(self.table.insert().from_select(columns, followers))
+        db.session.execute(self.table.insert().values(
+            user_id=message.user_id,
+            message_id=message.id,
+            author_id=message.user_id,
+            timestamp=message.timestamp,
+        ))
+
+        recipients = select([Follows.user_following_id]).where(
+            Follows.user_being_followed_id == message.user_id)
+        self._trim(or_(self.table.c.user_id == message.user_id,
+                       self.table.c.user_id.in_(recipients)), cap)
+
+    def backfill(self, user_id, author_id, cap):
+        """Copy `author_id`'s latest messages onto `user_id`'s timeline."""
+
+        existing = (select([self.table.c.message_id])
+                    .where(self.table.c.user_id == user_id))
+
+        latest = (select([
+            literal(user_id),
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        ])
+            .where(Message.user_id == author_id)
+            .where(Message.id.notin_(existing))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(cap))
+
+        columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+        db.session.execute(self.table.insert().from_select(columns, latest))
+        self._trim(self.table.c.user_id == user_id, cap)
+
+    def prune(self, user_id, author_id):
+        """Remove every message by `author_id` from `user_id`'s timeline."""
+
+        db.session.execute(self.table.delete()
+                           .where(self.table.c.user_id == user_id)
+                           .where(self.table.c.author_id == author_id))
+
+    def remove_message(self, message_id):
+        """Remove a message from every timeline it was pushed to."""
+
+        db.session.execute(self.table.delete()
+                           .where(self.table.c.message_id == message_id))
+
+    def replace(self, user_id, entries):
+        """Overwrite `user_id`'s timeline with `entries`; mark it built."""
+
+        built = BuiltTimeline.__table__
+
+        db.session.execute(self.table.delete()
+                           .where(self.table.c.user_id == user_id))
+        db.session.execute(built.delete()
+                           .where(built.c.user_id == user_id))
+
+        if entries:
+            db.session.execute(self.table.insert(), [
+                dict(user_id=user_id, timestamp=timestamp,
+                     message_id=message_id, author_id=author_id)
+                for timestamp, message_id, author_id in entries
+            ])
+
+        db.session.execute(built.insert().values(user_id=user_id,
+                                                 built_at=datetime.utcnow()))
+
+    def is_built(self, user_id):
+        """Has `user_id`'s timeline been built since it was created?"""
+
+        return db.session.query(
+            BuiltTimeline.query.filter_by(user_id=user_id).exists()).scalar()
+
+    def read(self, user_id, limit, before=None):
+        """Return up to `limit` message ids from `user_id`'s timeline.
+
+        If `before` is a (timestamp, message_id) cursor, only entries older
+        than it are returned.
+        """
+
+        rows = (db.session
+                .query(TimelineEntry.message_id)
+                .filter(TimelineEntry.user_id == user_id))
+
+        if before:
+            rows = rows.filter(older_than(TimelineEntry.timestamp,
+                                          TimelineEntry.message_id,
+                                          before))
+
+        rows = (rows
+                .order_by(TimelineEntry.timestamp.desc(),
+                          TimelineEntry.message_id.desc())
+                .limit(limit))
+
+        return [message_id for message_id, in rows]
+
+    def _trim(self, which_users, cap):
+        """Delete entries past the `cap` newest for the matching users."""
+
+        ranked = select([
+            self.table.c.user_id,
+            self.table.c.message_id,
+            func.row_number().over(
+                partition_by=self.table.c.user_id,
+                order_by=(self.table.c.timestamp.desc(),
+                          self.table.c.message_id.desc()),
+            ).label('position'),
+        ]).where(which_users).alias('ranked')
+
+        overflow = (select([ranked.c.user_id, ranked.c.message_id])
+                    .where(ranked.c.position > cap))
+
+        db.session.execute(self.table.delete().where(
+            tuple_(self.table.c.user_id, self.table.c.message_id)
+            .in_(overflow)))
+
+
+class MemoryTimelineBackend:
+    """Timelines held in a dict in this process. Useful for tests."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._timelines = defaultdict(list)
+        self._built = set()
+
+    def fan_out(self, message, cap):
+        follower_ids = [user_id for user_id, in (db.session
+                        .query(Follows.user_following_id)
+                        .filter(Follows.user_being_followed_id == message.user_id))]
+
+        entry = (message.timestamp, message.id, message.user_id)
+
+        with self._lock:
+            for user_id in follower_ids + [message.user_id]:
+                self._push(user_id, [entry], cap)
+
+    def backfill(self, user_id, author_id, cap):
+        entries = [tuple(row) for row in (db.session
+                   .query(Message.timestamp, Message.id, Message.user_id)
+                   .filter(Message.user_id == author_id)
+                   .order_by(Message.timestamp.desc(), Message.id.desc())
+                   .limit(cap))]
+
+        with self._lock:
+            self._push(user_id, entries, cap)
+
+    def prune(self, user_id, author_id):
+        with self._lock:
+            self._timelines[user_id] = [
+                entry for entry in self._timelines[user_id]
+                if entry[2] != author_id
+            ]
+
+    def remove_message(self, message_id):
+        with self._lock:
+            for user_id, entries in self._timelines.items():
+                self._timelines[user_id] = [
+                    entry for entry in entries if entry[1] != message_id
+                ]
+
+    def replace(self, user_id, entries):
+        with self._lock:
+            self._timelines[user_id] = list(entries)
+            self._built.add(user_id)
+
+    def is_built(self, user_id):
+        return user_id in self._built
+
+    def read(self, user_id, limit, before=None):
+        with self._lock:
+            entries = self._timelines[user_id]
+
+            if before:
+                entries = [entry for entry in entries
+                           if (entry[0], entry[1]) < before]
+
+            return [entry[1] for entry in entries[:limit]]
+
+    def clear(self):
+        with self._lock:
+            self._timelines.clear()
+            self._built.clear()
+
+    def _push(self, user_id, entries, cap):
+        timeline = self._timelines[user_id]
+        seen = {entry[1] for entry in timeline}
+        timeline.extend(entry for entry in entries if entry[1] not in seen)
+        timeline.sort(key=lambda entry: (entry[0], entry[1]), reverse=True)
+        del timeline[cap:]
+
+
+BACKENDS = {
+    'db': DBTimelineBackend,
+    'memory': MemoryTimelineBackend,
+}
+
+
+def _check_config(app):
+    # a worker process would fan messages out into its own memory
+    if (app.config['TIMELINE_BACKEND'] == 'memory'
+            and not app.config.get('JOBS_INLINE', False)):
+        raise ValueError("TIMELINE_BACKEND = 'memory' needs JOBS_INLINE: "
+                         "fan-out jobs must run in the web process")
+
+
+class TimelineStore:
+    """Bounded per-user home timelines, filled when messages are written.
+
+    The backend is picked from the TIMELINE_BACKEND config key ('db' or
+    'memory') the first time the store is used by an app.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_BACKEND', 'db')
+        app.config.setdefault('TIMELINE_MAX_LENGTH', 800)
+
+        _check_config(app)
+
+    @property
+    def backend(self):
+        app = current_app._get_current_object()
+
+        if 'timelines' not in app.extensions:
+            _check_config(app)
+            backend_cls = BACKENDS[app.config['TIMELINE_BACKEND']]
+            app.extensions['timelines'] = backend_cls()
+
+        return app.extensions['timelines']
+
+    @property
+    def cap(self):
+        return current_app.config['TIMELINE_MAX_LENGTH']
+
+    def add_message(self, message):
+        """Fan a newly-flushed message out to its readers."""
+
+        self.backend.fan_out(message, self.cap)
+
+    def remove_message(self, message):
+        """Take a message off every timeline."""
+
+        self.backend.remove_message(message.id)
+
+    def follow(self, user_id, followed_id):
+        """Backfill `user_id`'s timeline after they follow `followed_id`."""
+
+        self.backend.backfill(user_id, followed_id, self.cap)
+
+    def unfollow(self, user_id, followed_id):
+        """Prune `followed_id`'s messages after `user_id` unfollows them."""
+
+        self.backend.prune(user_id, followed_id)
+
+    def rebuild(self, user_id):
+        """Recompute `user_id`'s timeline from the messages table."""
+
+        entries = latest_entries(user_id, self.cap)
+        self.backend.replace(user_id, entries)
+        return entries
+
+    def build(self, user_id):
+        """Build `user_id`'s timeline if it never has been.
+
+        Timelines start out unbuilt (e.g. after seeding, or a restart of
+        the memory backend), and fan-out and backfill only ever add to
+        them. Returns True if it had to build; the writes join the
+        caller's transaction, for the caller to commit.
+        """
+
+        if self.backend.is_built(user_id):
+            return False
+
+        self.rebuild(user_id)
+        return True
+
+    def message_ids(self, user_id, limit, before=None):
+        """Newest-first message ids on `user_id`'s home timeline.
+
+        `before` is an optional (timestamp, message_id) cursor; only older
+        entries are returned. Call `build` first.
+        """
+
+        return self.backend.read(user_id, limit, before)
+
+
+timelines = TimelineStore()
+
+
+@jobs.task('timeline.fan_out')
+def fan_out_message(message_id):
+    """Put a new message on its readers' timelines.
+
+    Safe to run twice: any entries from an earlier run are replaced.
+    """
+
+    message = Message.query.get(message_id)
+
+    # deleted before we got to it
+    if message is None:
+        return
+
+    timelines.remove_message(message)
+    timelines.add_message(message)
+
+    # followers' home ETags include the author's version, bumped when the
+    # message was posted; a home page loaded before this ran has that
+    # version but not the message, so bump it again now that it's there
+    counters.touch(message.user_id)
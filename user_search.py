@@ -0,0 +1,318 @@
+"""Ranked, paginated user search for /users.
+
+`username LIKE '%q%'` can't use a B-tree index, and listing users without
+a query rendered every row in the table on one page. Searches here match
+on trigrams, so they can be answered from an index:
+
+- on PostgreSQL, GIN trigram indexes (pg_trgm) on username, bio and
+  location (see migrations/0006_user_search.py);
+- elsewhere (e.g. SQLite in development), an n-gram index held in this
+  process. It is rebuilt whenever users are added or removed (including
+  by other processes), and profile edits are applied with `index_user`.
+
+Results are ranked (exact username, then username prefix, then trigram
+similarity, with bio and location counting for half) and paginated with
+an opaque cursor on (score, id). Pages never exceed USERS_PAGE_MAX rows.
+"""
+
+import re
+from collections import defaultdict
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import case, func, or_, text, tuple_
+
+from models import db, User
+from pagination import Page, decode_key, encode_key
+
+# same default as pg_trgm's similarity_threshold
+SIMILARITY_THRESHOLD = 0.3
+
+EXACT_BOOST = 3.0
+PREFIX_BOOST = 2.0
+PROFILE_WEIGHT = 0.5
+
+WORD = re.compile(r'\w+')
+
+
+def trigrams(value):
+    """The set of trigrams pg_trgm would extract from `value`.
+
+    Each word is lower-cased and padded with two spaces in front and one
+    behind, so short queries still match the start of words.
+    """
+
+    grams = set()
+
+    for word in WORD.findall((value or '').lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+def similarity(a, b):
+    """Share of trigrams in common, as pg_trgm's similarity()."""
+
+    if not a or not b:
+        return 0.0
+
+    return len(a & b) / len(a | b)
+
+
+def escape_like(value):
+    return (value
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def decode_search_cursor(token):
+    return decode_key(token, float, int)
+
+
+def decode_browse_cursor(token):
+    return decode_key(token, int)
+
+
+def _page(ranked, size, scored=True):
+    """Build a Page of Users from up to `size` + 1 (id, score) pairs."""
+
+    ranked = list(ranked)
+    next_cursor = None
+
+    if len(ranked) > size:
+        ranked = ranked[:size]
+        id, score = ranked[-1]
+        next_cursor = encode_key(score, id) if scored else encode_key(id)
+
+    ids = [id for id, _ in ranked]
+    by_id = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+
+    return Page([by_id[id] for id in ids if id in by_id], next_cursor)
+
+
+def browse(after=None, size=20):
+    """All users in id order, a page at a time."""
+
+    query = db.session.query(User.id)
+
+    if after:
+        query = query.filter(User.id > after[0])
+
+    ids = query.order_by(User.id).limit(size + 1)
+    return _page(((id, None) for id, in ids), size, scored=False)
+
+
+class PostgresUserSearch:
+    """Search with pg_trgm, answered from GIN trigram indexes."""
+
+    def search(self, q, after, size):
+        prefix = escape_like(q) + '%'
+
+        score = (
+            case([(func.lower(User.username) == q.lower(), EXACT_BOOST)],
+                 else_=0.0)
+            + case([(User.username.ilike(prefix, escape='\\'), PREFIX_BOOST)],
+                   else_=0.0)
+            + func.similarity(User.username, q)
+            + PROFILE_WEIGHT * func.similarity(func.coalesce(User.bio, ''), q)
+            + PROFILE_WEIGHT * func.similarity(
+                func.coalesce(User.location, ''), q)
+        ).label('score')
+
+        matches = or_(
+            User.username.op('%')(q),
+            User.username.ilike(prefix, escape='\\'),
+            User.bio.op('%')(q),
+            User.location.op('%')(q),
+        )
+
+        ranked = db.session.query(User.id, score).filter(matches).subquery()
+        query = db.session.query(ranked.c.id, ranked.c.score)
+
+        if after:
+            query = query.filter(
+                tuple_(ranked.c.score, ranked.c.id) < tuple_(*after))
+
+        rows = (query
+                .order_by(ranked.c.score.desc(), ranked.c.id.desc())
+                .limit(size + 1))
+
+        return _page(((id, score) for id, score in rows), size)
+
+    def index_user(self, user):
+        """Nothing to do; the database maintains its own indexes."""
+
+    def remove_user(self, user_id):
+        """Nothing to do; the database maintains its own indexes."""
+
+
+class NgramUserSearch:
+    """Search with an n-gram index held in this process."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._fingerprint = None
+        self._usernames = {}
+        self._grams = {}
+        self._postings = defaultdict(set)
+
+    def _refresh(self):
+        """(Re)build the index if users were added or removed."""
+
+        fingerprint = tuple(db.session
+                            .query(func.count(User.id), func.max(User.id))
+                            .one())
+
+        if fingerprint == self._fingerprint:
+            return
+
+        self._usernames.clear()
+        self._grams.clear()
+        self._postings.clear()
+
+        rows = db.session.query(User.id, User.username, User.bio,
+                                User.location)
+
+        for row in rows:
+            self._add(*row)
+
+        self._fingerprint = fingerprint
+
+    def _add(self, id, username, bio, location):
+        self._remove(id)
+
+        grams = (trigrams(username), trigrams(bio), trigrams(location))
+        self._usernames[id] = username.lower()
+        self._grams[id] = grams
+
+        for gram in set().union(*grams):
+            self._postings[gram].add(id)
+
+    def _remove(self, id):
+        for gram in set().union(*self._grams.pop(id, [set()])):
+            self._postings[gram].discard(id)
+        self._usernames.pop(id, None)
+
+    def _score(self, id, q, q_grams):
+        username = self._usernames[id]
+        name_grams, bio_grams, location_grams = self._grams[id]
+
+        name_sim = similarity(name_grams, q_grams)
+        bio_sim = similarity(bio_grams, q_grams)
+        location_sim = similarity(location_grams, q_grams)
+        prefix = username.startswith(q)
+
+        if not (prefix or max(name_sim, bio_sim, location_sim)
+                >= SIMILARITY_THRESHOLD):
+            return None
+
+        return ((EXACT_BOOST if username == q else 0.0)
+                + (PREFIX_BOOST if prefix else 0.0)
+                + name_sim
+                + PROFILE_WEIGHT * (bio_sim + location_sim))
+
+    def search(self, q, after, size):
+        q = q.lower()
+        q_grams = trigrams(q)
+
+        with self._lock:
+            self._refresh()
+
+            # padded leading trigrams mean prefix matches are candidates too
+            candidates = set()
+            for gram in q_grams:
+                candidates |= self._postings.get(gram, set())
+
+            scored = []
+            for id in candidates:
+                score = self._score(id, q, q_grams)
+                if score is not None:
+                    scored.append((score, id))
+
+        scored.sort(reverse=True)
+
+        if after:
+            scored = [key for key in scored if key < tuple(after)]
+
+        return _page(((id, score) for score, id in scored[:size + 1]), size)
+
+    def index_user(self, user):
+        """Add or refresh `user` after signup or a profile edit."""
+
+        with self._lock:
+            if self._fingerprint is not None:
+                self._add(user.id, user.username, user.bio, user.location)
+
+    def remove_user(self, user_id):
+        """Forget a deleted user."""
+
+        with self._lock:
+            self._remove(user_id)
+
+
+def _has_pg_trgm():
+    query = text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    return db.session.execute(query).scalar() is not None
+
+
+class UserSearch:
+    """Pick a search backend for the app's database and run searches.
+
+    USER_SEARCH_BACKEND may be 'postgres' or 'ngram'; by default PostgreSQL
+    databases with pg_trgm installed use it, and everything else uses the
+    in-process index.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('USER_SEARCH_BACKEND', None)
+        app.config.setdefault('USERS_PER_PAGE', 24)
+        app.config.setdefault('USERS_PAGE_MAX', 100)
+
+    @property
+    def backend(self):
+        app = current_app._get_current_object()
+
+        if 'user_search' not in app.extensions:
+            kind = app.config['USER_SEARCH_BACKEND']
+
+            if kind is None:
+                postgres = db.engine.dialect.name == 'postgresql'
+                kind = 'postgres' if postgres and _has_pg_trgm() else 'ngram'
+
+            backend_cls = {'postgres': PostgresUserSearch,
+                           'ngram': NgramUserSearch}[kind]
+            app.extensions['user_search'] = backend_cls()
+
+        return app.extensions['user_search']
+
+    def page_size(self, requested=None):
+        """USERS_PER_PAGE, or `requested`, but never over USERS_PAGE_MAX."""
+
+        size = requested or current_app.config['USERS_PER_PAGE']
+        return max(1, min(size, current_app.config['USERS_PAGE_MAX']))
+
+    def search(self, q=None, after=None, size=None):
+        """One page of users matching `q`, best match first.
+
+        With no `q`, every user in id order. `after` is the decoded cursor
+        from the previous page.
+        """
+
+        size = self.page_size(size)
+        q = (q or '').strip()
+
+        if not q:
+            return browse(after, size)
+
+        return self.backend.search(q, after, size)
+
+    def index_user(self, user):
+        self.backend.index_user(user)
+
+    def remove_user(self, user_id):
+        self.backend.remove_user(user_id)
+
+
+user_search = UserSearch()